@@ -0,0 +1,78 @@
+import math
+
+import vtk
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+
+class BudgetReducer(VTKPythonAlgorithmBase):
+    """
+    Decimates a triangle mesh down to a triangle budget instead of by a fixed fraction. The target reduction is
+    computed from the extracted cell count when the filter executes, surfaces within the budget pass unchanged.
+    vtkDecimatePro is used up to clustering_cells input triangles, above that vtkQuadricClustering takes over since
+    it runs in a fraction of the time on the very large surfaces where vtkDecimatePro becomes the bottleneck.
+    Used like the VTK reducers: SetInputConnection, SetTriangleBudget, Update.
+    """
+
+    def __init__(self):
+        VTKPythonAlgorithmBase.__init__(self, nInputPorts=1, inputType='vtkPolyData',
+                                        nOutputPorts=1, outputType='vtkPolyData')
+        self.triangle_budget = 100000
+        self.clustering_cells = 300000
+        self.target_reduction = 0.0  # the reduction of the last execution
+
+    def SetTriangleBudget(self, triangle_budget):
+        if triangle_budget != self.triangle_budget:
+            self.triangle_budget = triangle_budget
+            self.Modified()
+
+    def GetTriangleBudget(self):
+        return self.triangle_budget
+
+    def SetClusteringCells(self, clustering_cells):
+        """ The input triangles above which quadric clustering replaces vtkDecimatePro, None never clusters."""
+        if clustering_cells != self.clustering_cells:
+            self.clustering_cells = clustering_cells
+            self.Modified()
+
+    def GetTargetReduction(self):
+        return self.target_reduction
+
+    def GetOutput(self):
+        return self.GetOutputDataObject(0)
+
+    def RequestData(self, request, in_info, out_info):
+        surface = vtk.vtkPolyData.GetData(in_info[0])
+        output = vtk.vtkPolyData.GetData(out_info)
+        cells = surface.GetNumberOfCells()
+        self.target_reduction = max(0.0, 1.0 - float(self.triangle_budget) / cells) if cells else 0.0
+        if not self.target_reduction:
+            output.ShallowCopy(surface)
+            return 1
+
+        if self.clustering_cells is not None and cells > self.clustering_cells:
+            reducer = self.create_clustering(surface)
+        else:
+            reducer = vtk.vtkDecimatePro()
+            reducer.SetTargetReduction(self.target_reduction)
+            reducer.PreserveTopologyOff()  # preserving it stops around a 0.5 reduction on extracted surfaces
+        reducer.SetInputData(surface)
+        reducer.Update()
+        output.ShallowCopy(reducer.GetOutput())
+        return 1
+
+    def create_clustering(self, surface):
+        """
+        Sizes the clustering bins so the output lands close to the budget. A surface of area A cut by bins of
+        edge h keeps about 2 A / h^2 triangles (two per bin face it crosses).
+        (https://www.vtk.org/doc/nightly/html/classvtkQuadricClustering.html)
+        """
+        mass = vtk.vtkMassProperties()
+        mass.SetInputData(surface)
+        mass.Update()
+        bin_size = math.sqrt(2.0 * mass.GetSurfaceArea() / self.triangle_budget)
+        bounds = surface.GetBounds()
+        divisions = [max(1, int(math.ceil((bounds[2 * i + 1] - bounds[2 * i]) / bin_size))) for i in range(3)]
+        reducer = vtk.vtkQuadricClustering()
+        reducer.AutoAdjustNumberOfDivisionsOff()
+        reducer.SetNumberOfDivisions(divisions)
+        return reducer
@@ -0,0 +1,154 @@
+import PyQt5.QtCore as Qt
+
+from vtkUtils import *
+from SurfaceLoader import *
+from SurfaceRebuilder import *
+
+
+def open_case(brain_files, mask_file):
+    """
+    Reads the volumes of a case, see vtkUtils.open_study and open_mask. The files of a case list may be gone by the
+    time the case is opened, VTK only logs a missing file.
+    :return: (brains, mask)
+    """
+    for file in brain_files + [mask_file]:
+        if not os.path.exists(file):
+            raise FileNotFoundError("{} not found".format(file))
+    return open_study(brain_files), open_mask(mask_file)
+
+
+class CaseReader(Qt.QThread):
+    """ Opens the volumes of a case (see open_case) on a worker thread."""
+
+    def __init__(self, brain_files, mask_file):
+        Qt.QThread.__init__(self)
+        self.brain_files = brain_files
+        self.mask_file = mask_file
+        self.brains, self.mask = None, None
+        self.error = None  # raised again when the case is taken
+
+    def run(self):
+        try:
+            self.brains, self.mask = open_case(self.brain_files, self.mask_file)
+        except (OSError, ValueError) as e:
+            self.error = e
+
+
+class CaseBrowser(Qt.QObject):
+    """
+    Keeps the cases next to the shown one read and extracted in the background, so that stepping to them is
+    immediate. The volumes of a neighbor are opened on a low priority CaseReader thread, then its surfaces are
+    extracted by a SurfaceLoader of its own on the low priority worker threads of a separate SurfaceRebuilder. That
+    loader skips the previews, and leaves the mesh cache writes and the levels of detail to the window loader once
+    the case is taken. The window swaps the NiiObjects of a taken case in and loads whatever the prefetch has not
+    finished yet, the surfaces extracted so far are kept. Only the shown case and its wanted neighbors stay in
+    memory.
+    """
+    changed = Qt.pyqtSignal()  # a neighbor was read or got another surface
+
+    def __init__(self, cases, prefetch_previous=CASE_PREFETCH_PREVIOUS):
+        """
+        :param cases: the (name, brain files, mask file) of each case, see batch_export.read_cases
+        :param prefetch_previous: prefetch the case before the shown one too, not only the next one
+        """
+        Qt.QObject.__init__(self)
+        self.cases = cases
+        self.prefetch_previous = prefetch_previous
+        self.current = 0
+        self.opened = {}  # case index -> (brains, mask) of the shown case and the read neighbors
+        self.readers = {}  # case index -> CaseReader still opening the case
+        self.failed = set()  # indices of the cases that could not be read, only retried when they are taken
+        self.prepare = None  # called with (brains, mask) of a case before its surfaces are extracted
+        self.surface_rebuilder = SurfaceRebuilder(Qt.QThread.LowPriority)
+        self.surface_loader = SurfaceLoader(self.surface_rebuilder, previews=False, deferred=True)
+        self.surface_loader.progress.connect(lambda loaded, total: self.changed.emit())
+
+    def neighbors(self):
+        """ The cases to prefetch, the next one first."""
+        indices = [self.current + 1] + ([self.current - 1] if self.prefetch_previous else [])
+        return [index for index in indices if 0 <= index < len(self.cases)]
+
+    def prefetch(self):
+        """ Starts reading the neighbors of the shown case that are not read yet and forgets the other cases."""
+        neighbors = self.neighbors()
+        for index in list(self.opened):
+            if index != self.current and index not in neighbors:
+                self.forget(index)
+        for index in neighbors:
+            if index not in self.opened and index not in self.readers and index not in self.failed:
+                _, brain_files, mask_file = self.cases[index]
+                reader = CaseReader(brain_files, mask_file)
+                reader.finished.connect(lambda index=index, reader=reader: self.case_read(index, reader))
+                self.readers[index] = reader
+                reader.start(Qt.QThread.LowPriority)
+
+    def case_read(self, index, reader):
+        if self.readers.get(index) is not reader:  # taken meanwhile
+            return
+        del self.readers[index]
+        if reader.error:
+            self.failed.add(index)
+        if reader.error or index not in self.neighbors():  # the user moved on meanwhile
+            self.changed.emit()
+            return
+        self.opened[index] = reader.brains, reader.mask
+        if self.prepare:
+            self.prepare(reader.brains, reader.mask)
+        self.surface_loader.load(reader.brains[0], reader.mask)
+        self.changed.emit()
+
+    def forget(self, index):
+        brains, mask = self.opened.pop(index)
+        for nii_object in brains + [mask]:
+            self.surface_loader.cancel(nii_object)
+
+    def state(self, index):
+        """ 'reading', 'extracting', 'ready' or 'failed' for a prefetched case, None otherwise."""
+        if index in self.failed:
+            return 'failed'
+        if index in self.readers:
+            return 'reading'
+        if index not in self.opened:
+            return None
+        brains, mask = self.opened[index]
+        loading = self.surface_loader.is_loading(brains[0]) or self.surface_loader.is_loading(mask)
+        return 'extracting' if loading else 'ready'
+
+    def take(self, index):
+        """
+        Makes a case the shown one. A case that is neither read nor being read is read here, blocking like at
+        startup. Its background extraction stops, the window loads the surfaces that are still missing.
+        :return: the (brains, mask) of the case
+        """
+        reader = self.readers.pop(index, None)
+        self.failed.discard(index)
+        if index in self.opened:
+            brains, mask = self.opened[index]
+        elif reader:
+            reader.wait()
+            if reader.error:
+                self.failed.add(index)
+                raise reader.error
+            brains, mask = reader.brains, reader.mask
+            if self.prepare:
+                self.prepare(brains, mask)
+        else:
+            try:
+                brains, mask = open_case(*self.cases[index][1:])
+            except (OSError, ValueError):
+                self.failed.add(index)
+                raise
+            if self.prepare:
+                self.prepare(brains, mask)
+        for nii_object in brains + [mask]:
+            self.surface_loader.cancel(nii_object)
+        self.current = index
+        self.opened[index] = brains, mask
+        return brains, mask
+
+    def shutdown(self):
+        """ Waits for the readers and the extraction threads, a QThread must not be destroyed while running."""
+        for reader in self.readers.values():
+            reader.wait()
+        self.readers = {}
+        self.surface_rebuilder.shutdown()
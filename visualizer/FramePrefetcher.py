@@ -0,0 +1,108 @@
+import threading
+
+import PyQt5.QtCore as Qt
+
+from vtkUtils import *
+
+
+class FramePrefetcher(Qt.QThread):
+    """
+    Reads the frames of a time series (see TimeSeries) and extracts their brain surfaces ahead of the playhead on a
+    worker thread. Frame i is kept in slot i % capacity of a ring buffer. The frames from the playhead on therefore
+    use distinct slots and a new frame only overwrites one the playhead has passed, so memory stays at capacity
+    frames and surfaces however long the series is. Playback takes frames with get and moves the playhead with seek.
+    """
+    frame_ready = Qt.pyqtSignal(int)  # index of a frame put into the buffer
+
+    def __init__(self, time_series, capacity=TIME_SERIES_BUFFER_FRAMES):
+        Qt.QThread.__init__(self)
+        self.time_series = time_series
+        self.capacity = max(1, min(capacity, time_series.frames))
+        self.slots = [None] * self.capacity  # (frame index, surface key, vtkImageData, surface vtkPolyData)
+        self.playhead = 0
+        self.surface_key = None  # (threshold, smoothness, smoothing, triangle budget) the surfaces are extracted at
+        self.filters = []  # the pipeline extracting the current frame
+        self.condition = threading.Condition()
+        self.running = True
+
+    def set_surface_key(self, surface_key):
+        """ Extracts the frames at other settings, the buffered frames are extracted again from their volumes."""
+        with self.condition:
+            if surface_key == self.surface_key:
+                return
+            self.surface_key = surface_key
+            for vtk_filter in self.filters:
+                vtk_filter.AbortExecuteOn()
+            self.condition.notify()
+
+    def seek(self, index):
+        """ Moves the playhead, the prefetcher works on from there."""
+        with self.condition:
+            self.playhead = index
+            self.condition.notify()
+
+    def window(self):
+        """ The frames to keep buffered, from the playhead on and wrapping around for looped playback."""
+        return [(self.playhead + step) % self.time_series.frames for step in range(self.capacity)]
+
+    def get(self, index):
+        """
+        :return: (vtkImageData, surface vtkPolyData, surface key) of a frame, None if it is not buffered at the
+                 current surface key yet
+        """
+        with self.condition:
+            if self.is_buffered(index):
+                return self.slots[index % self.capacity][2:] + (self.surface_key,)
+        return None
+
+    def buffered(self):
+        """ The number of frames ready from the playhead on."""
+        with self.condition:
+            return sum(1 for index in self.window() if self.is_buffered(index))
+
+    def is_buffered(self, index):
+        slot = self.slots[index % self.capacity]
+        return bool(slot) and slot[0] == index and slot[1] == self.surface_key
+
+    def next_frame(self):
+        """ The first frame from the playhead on that is not buffered, None once the buffer is full."""
+        if self.surface_key is None:
+            return None
+        return next((index for index in self.window() if not self.is_buffered(index)), None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                index = self.next_frame()
+                while self.running and index is None:
+                    self.condition.wait()
+                    index = self.next_frame()
+                if not self.running:
+                    return
+                surface_key, slot = self.surface_key, self.slots[index % self.capacity]
+            # a frame already read only needs its surface extracted again after a settings change
+            image = slot[2] if slot and slot[0] == index else self.time_series.read_frame(index)
+            threshold, smoothness, smoothing, triangle_budget = surface_key
+            filters = create_brain_surface_filters(image, threshold, smoothness, smoothing, triangle_budget)
+            with self.condition:
+                if surface_key != self.surface_key or not self.running:
+                    continue
+                self.filters = filters
+            filters[-1].Update()
+            with self.condition:
+                self.filters = []
+                # the playhead may have moved past the frame meanwhile, its slot belongs to a frame ahead then
+                if surface_key != self.surface_key or index not in self.window() or not self.running:
+                    continue
+                self.slots[index % self.capacity] = (index, surface_key, image, filters[-1].GetOutput())
+            self.frame_ready.emit(index)
+
+    def stop(self):
+        """ Stops the worker thread and waits for it, the frame being extracted is aborted."""
+        with self.condition:
+            self.running = False
+            for vtk_filter in self.filters:
+                vtk_filter.AbortExecuteOn()
+            self.condition.notify()
+        self.wait()
+        self.time_series.close()
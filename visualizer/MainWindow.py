@@ -1,12 +1,18 @@
 import math
-import time
 import os
+import time
 
 import PyQt5.QtWidgets as QtWidgets
 import PyQt5.QtCore as Qt
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+import vtkUtils
 from vtkUtils import *
 from config import *
+from CaseBrowser import *
+from FramePrefetcher import *
+from SurfaceLoader import *
+from SurfaceRebuilder import *
+from UpdateScheduler import *
 
 
 class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
@@ -15,28 +21,79 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         QtWidgets.QMainWindow.__init__(self, None)
 
         # base setup
+        self.surface_rebuilder = SurfaceRebuilder()
+        self.update_scheduler = UpdateScheduler(UPDATE_DEBOUNCE_INTERVAL, self.render)
+        self.update_scheduler.updated.connect(self.show_update_time)
+        # steps the surfaces to the next finer pyramid level once the user idles, see refine_surfaces
+        self.refine_timer = Qt.QTimer()
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(PYRAMID_REFINE_DELAY)
+        self.refine_timer.timeout.connect(self.refine_surfaces)
+        # shows the next prefetched frame of a time series brain at a steady rate, see play_next_frame
+        self.playback_timer = Qt.QTimer()
+        self.playback_timer.setInterval(int(round(1000.0 / TIME_SERIES_FRAME_RATE)))
+        self.playback_timer.timeout.connect(self.play_next_frame)
+        self.frame_prefetcher = None  # prefetches the frames of the brain shown if it is a time series
+        self.pending_frame = None  # a frame sought to that was not buffered yet, shown once it is
         self.renderer, self.frame, self.vtk_widget, self.interactor, self.render_window = self.setup()
-        self.brain, self.mask = setup_brain(self.renderer, self.app.BRAIN_FILE), setup_mask(self.renderer,
-                                                                                            self.app.MASK_FILE)
+        # only the volumes are read here, the surfaces are streamed in by the surface loader once the window is shown
+        # every modality of the case is read, the one shown is self.brain. The mask is shared by all of them.
+        self.case_browser = CaseBrowser(self.app.CASES, self.app.PREFETCH_PREVIOUS)
+        self.brains, self.mask = self.case_browser.take(0)
+        self.case_browser.prepare = self.prepare_case
+        self.case_browser.changed.connect(self.show_case_info)
+        self.brain = self.brains[0]
+        share_study_triangle_budget(self.brains, self.mask, vtkUtils.triangle_budget)
+        # per modality (threshold, smoothness, smoothing) -> brain vtkPolyData, switching back reuses them
+        self.modality_surfaces = {brain: SurfaceMemory(BRAIN_SURFACE_MEMORY // len(self.brains))
+                                  for brain in self.brains}
+        self.modality_thresholds = {}  # applied threshold of the modalities not shown
+        self.brain_surfaces = self.modality_surfaces[self.brain]
+        self.prepare_brain_views(self.brain)
+        self.surface_loader = SurfaceLoader(self.surface_rebuilder)
+        self.surface_loader.preview_ready.connect(self.preview_ready)
+        self.surface_loader.preview_expired.connect(self.preview_expired)
+        self.surface_loader.surface_loaded.connect(self.surface_loaded)
+        self.surface_loader.progress.connect(self.show_load_progress)
+        self.surface_loader.all_loaded.connect(self.case_browser.prefetch)  # the neighbors once the case is complete
+        self.load_progress = QtWidgets.QProgressBar()
+        self.load_progress.setFormat("Loading surfaces %v/%m")
+        self.statusBar().addPermanentWidget(self.load_progress)
 
         # setup brain projection and slicer
-        self.brain_image_prop = setup_projection(self.brain, self.renderer)
+        self.brain_projection = setup_projection(self.brain, self.renderer)
         self.brain_slicer_props = setup_slicer(self.renderer, self.brain)  # causing issues with rotation
+        self.profile_overlay = create_profile_overlay(self.renderer) if self.app.PROFILE_OVERLAY else None
         self.slicer_widgets = []
 
         # brain pickers
+        self.modality_combo = self.add_modality_combo()
         self.brain_threshold_sp = self.create_new_picker(self.brain.scalar_range[1], self.brain.scalar_range[0], 5.0,
                                                          sum(self.brain.scalar_range) / 2, self.brain_threshold_vc)
+        self.brain_threshold_sp.editingFinished.connect(self.apply_brain_threshold)
+        self.brain_threshold = self.brain_threshold_sp.value()  # the applied threshold, the picker only previews
+        self.brain_threshold_info = QtWidgets.QLabel()
+        self.brain_threshold_buttons = self.add_brain_threshold_buttons()
         self.brain_opacity_sp = self.create_new_picker(1.0, 0.0, 0.1, BRAIN_OPACITY, self.brain_opacity_vc)
         self.brain_smoothness_sp = self.create_new_picker(1000, 100, 100, BRAIN_SMOOTHNESS, self.brain_smoothness_vc)
+        self.brain_smoothing_combo = self.create_smoothing_combo(self.brain_smoothness_vc)
         self.brain_lut_sp = self.create_new_picker(3.0, 0.0, 0.1, 2.0, self.lut_value_changed)
         self.brain_projection_cb = self.add_brain_projection()
         self.brain_slicer_cb = self.add_brain_slicer()
+        self.brain_probe_cb = QtWidgets.QCheckBox("Probe")
+        self.brain_probe_cb.setToolTip("Read the intensity and label under the mouse and move the slices there")
+        self.probed_voxel = None
+        self.interacting = False  # the camera is being moved, nothing is probed
+        self.slicer_while_loading = True  # the slices stand in for the brain surface until it arrives
+        self.swapping_case = False  # the prefetched surfaces of a case are shown with one render, see show_case
 
         # mask pickers
         self.mask_opacity_sp = self.create_new_picker(1.0, 0.0, 0.1, MASK_OPACITY, self.mask_opacity_vc)
         self.mask_smoothness_sp = self.create_new_picker(1000, 100, 100, MASK_SMOOTHNESS, self.mask_smoothness_vc)
+        self.mask_smoothing_combo = self.create_smoothing_combo(self.mask_smoothness_vc)
         self.mask_label_cbs = []
+        self.label_voxel_statistics = None  # see compute_label_statistics, measured once the window is shown
+        self.label_statistics_table = self.add_label_statistics_table()
 
         # create grid for all widgets
         self.grid = QtWidgets.QGridLayout()
@@ -46,6 +103,8 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         self.add_brain_settings_widget()
         self.add_mask_settings_widget()
         self.add_views_widget()
+        self.add_time_series_widget()
+        self.add_case_browser_widget()
 
         #  set layout and show
         self.render_window.Render()
@@ -53,8 +112,15 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         self.frame.setLayout(self.grid)
         self.setCentralWidget(self.frame)
         self.set_axial_view()
+        self.interactor.AddObserver('StartInteractionEvent', self.interaction_started)
+        self.interactor.AddObserver('EndInteractionEvent', self.interaction_ended)
+        self.interactor.AddObserver('MouseMoveEvent', self.probe_cursor)
         self.interactor.Initialize()
+        self.brain_slicer_cb.setChecked(True)
+        self.set_slicer_visible(True)
         self.show()
+        Qt.QTimer.singleShot(0, lambda: self.surface_loader.load(self.brain, self.mask))
+        Qt.QTimer.singleShot(0, self.show_label_statistics)
 
     @staticmethod
     def setup():
@@ -72,6 +138,8 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         render_window.AddRenderer(renderer)
         interactor.SetRenderWindow(render_window)
         interactor.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+        # the level of detail actors switch to their decimated surfaces to keep up with this rate while interacting
+        interactor.SetDesiredUpdateRate(LOD_DESIRED_UPDATE_RATE)
 
         # required to enable overlapping actors with opacity < 1.0
         # this is causing some issues with flashing objects
@@ -82,90 +150,248 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
 
         return renderer, frame, vtk_widget, interactor, render_window
 
-    def lut_value_changed(self):
-        lut = self.brain.image_mapper.GetLookupTable()
-        new_lut_value = self.brain_lut_sp.value()
-        lut.SetValueRange(0.0, new_lut_value)
-        lut.Build()
-        self.brain.image_mapper.SetLookupTable(lut)
-        self.brain.image_mapper.Update()
+    def interaction_started(self, obj, event):
+        self.interacting = True
+        self.refine_timer.stop()
+        select_lod_levels(self.brain.labels + self.mask.labels, self.interactor.GetDesiredUpdateRate())
+
+    def interaction_ended(self, obj, event):
+        self.interacting = False
+        select_lod_levels(self.brain.labels + self.mask.labels, self.interactor.GetStillUpdateRate())
+        self.render_window.Render()
+        if self.zoomed_past_level():
+            self.refine_surfaces()
+        else:
+            self.refine_timer.start()
+
+    def zoomed_past_level(self):
+        """ True when a voxel of a pyramid level still to refine covers more than PYRAMID_PIXELS_PER_VOXEL pixels."""
+        coarse = [nii_object for nii_object in (self.brain, self.mask) if nii_object.level > nii_object.finest_level]
+        if not coarse:
+            return False
+        camera = self.renderer.GetActiveCamera()
+        height = max(self.render_window.GetSize()[1], 1)
+        if camera.GetParallelProjection():
+            pixel_size = 2.0 * camera.GetParallelScale() / height
+        else:
+            pixel_size = 2.0 * camera.GetDistance() * math.tan(math.radians(camera.GetViewAngle()) / 2.0) / height
+        voxel_size = min(min(get_level_image(nii_object).GetSpacing()) for nii_object in coarse)
+        return voxel_size > PYRAMID_PIXELS_PER_VOXEL * pixel_size
+
+    def refine_surfaces(self):
+        """
+        Re-extracts the surfaces of the brain and the mask from the next finer pyramid level, down to the finest level
+        within PYRAMID_EXTRACTION_VOXELS, skipping the levels released for PYRAMID_MEMORY_BUDGET. One level per step,
+        the next step is taken once the user idles again after the refined surfaces arrived (see surface_rebuilt).
+        """
+        brain_loaded = self.brain.labels[0].actor and not self.surface_loader.is_loading(self.brain)
+        if brain_loaded and self.brain.level > self.brain.finest_level and 'brain' not in self.surface_rebuilder.jobs:
+            self.brain.level = get_finer_level(self.brain)
+            self.brain_surfaces.clear()  # the kept surfaces are from the coarser level
+            for key in list(self.surface_rebuilder.jobs):
+                if key[0] == 'speculate':
+                    self.surface_rebuilder.cancel(key)
+            self.rebuild_brain_surface()
+        if self.mask.level > self.mask.finest_level and not self.is_rebuilding_mask() and \
+                not self.surface_loader.is_loading(self.mask):
+            self.mask.level = get_finer_level(self.mask)
+            self.rebuild_mask_surfaces()  # hidden labels are refined when they are shown again
+
+    def preview_ready(self, actor):
+        self.renderer.AddActor(actor)
+        self.render()
+
+    def preview_expired(self, actor):
+        self.renderer.RemoveActor(actor)
+        self.render()
+
+    def surface_loaded(self, nii_object, label_idx):
+        """ Shows a surface delivered by the surface loader, applying the settings changed while it was loading."""
+        label = nii_object.labels[label_idx]
+        if label.actor:
+            self.renderer.AddActor(label.actor)
+        if nii_object is self.brain:
+            self.update_brain_opacity()
+            if self.slicer_while_loading:
+                self.brain_slicer_cb.setChecked(False)
+                self.set_slicer_visible(False)
+                self.slicer_while_loading = False  # modalities loaded later keep the views chosen by then
+            threshold = round(label.value, self.brain_threshold_sp.decimals())  # as shown by the picker
+            if (threshold, label.smoothness, label.smoothing) != self.brain_surface_key():
+                self.rebuild_brain_surface()
+            elif label.actor:
+                label.value = threshold
+                self.brain_surfaces.put(self.brain_surface_key(), get_label_surface(label))
+                self.speculate_brain_surfaces()
+            if label.actor:
+                self.start_time_series()
+        elif label.actor:
+            self.mask_label_cbs[label_idx].setEnabled(True)
+            self.mask_label_cbs[label_idx].setChecked(True)
+            label.property.SetOpacity(self.mask_opacity_sp.value())
+            label.property.SetColor(MASK_COLORS[0] if self.mask_single_color_radio.isChecked() else label.color)
+            self.update_mask_label_visibility(label_idx)  # also rebuilds it if the smoothness changed meanwhile
+            self.update_scheduler.schedule('label_statistics', self.show_label_statistics)
+        self.refine_timer.start()
+        if not self.swapping_case:
+            self.render()
+
+    def show_load_progress(self, loaded, total):
+        self.load_progress.setMaximum(total)
+        self.load_progress.setValue(loaded)
+        self.load_progress.setVisible(loaded < total)
+
+    def render(self):
+        if self.profile_overlay:
+            update_profile_overlay(self.profile_overlay)
         self.render_window.Render()
 
+    def show_update_time(self, keys, seconds):
+        self.statusBar().showMessage("Applied {} in {:.0f} ms".format(", ".join(map(str, keys)), seconds * 1000))
+
+    def lut_value_changed(self):
+        self.update_scheduler.schedule('brain_lut', self.update_brain_lut)
+
+    def update_brain_lut(self):
+        # the slice mappers recolor the displayed slices from the modified table on the next render
+        preview = self.brain_threshold_sp.value()
+        update_brain_table(self.brain, self.brain_lut_sp.value(), preview if preview != self.brain_threshold else None)
+
+    def add_brain_threshold_buttons(self):
+        otsu_button = QtWidgets.QPushButton("Otsu")
+        otsu_button.setToolTip("Suggest the threshold best separating dark and bright voxels")
+        otsu_button.clicked.connect(lambda: self.brain_threshold_sp.setValue(otsu_threshold(self.brain.histogram)))
+        percentile_button = QtWidgets.QPushButton("{:g}th Percentile".format(BRAIN_THRESHOLD_PERCENTILE))
+        percentile_button.setToolTip("Suggest the threshold with {:g}% of the foreground voxels below it".format(
+            BRAIN_THRESHOLD_PERCENTILE))
+        percentile_button.clicked.connect(
+            lambda: self.brain_threshold_sp.setValue(percentile_threshold(self.brain.histogram)))
+        apply_button = QtWidgets.QPushButton("Apply Threshold")
+        apply_button.clicked.connect(self.apply_brain_threshold)
+        self.show_brain_threshold_info()
+        return otsu_button, percentile_button, apply_button
+
     def add_brain_slicer(self):
         slicer_cb = QtWidgets.QCheckBox("Slicer")
         slicer_cb.clicked.connect(self.brain_slicer_vc)
         return slicer_cb
 
+    def add_modality_combo(self):
+        modality_combo = QtWidgets.QComboBox()
+        modality_combo.addItems([get_modality_name(brain.file) for brain in self.brains])
+        modality_combo.setEnabled(len(self.brains) > 1)
+        modality_combo.currentIndexChanged.connect(self.select_modality)
+        return modality_combo
+
     def add_vtk_window_widget(self):
-        base_brain_file = os.path.basename(self.app.BRAIN_FILE)
-        base_mask_file = os.path.basename(self.app.MASK_FILE)
-        object_title = "Brain: {0} (min: {1:.2f}, max: {2:.2f})        Mask: {3}".format(base_brain_file,
-                                                                                         self.brain.scalar_range[0],
-                                                                                         self.brain.scalar_range[1],
-                                                                                         base_mask_file)
-        object_group_box = QtWidgets.QGroupBox(object_title)
+        self.object_group_box = QtWidgets.QGroupBox(self.describe_objects())
         object_layout = QtWidgets.QVBoxLayout()
         object_layout.addWidget(self.vtk_widget)
-        object_group_box.setLayout(object_layout)
-        self.grid.addWidget(object_group_box, 0, 2, 5, 5)
+        self.object_group_box.setLayout(object_layout)
+        self.grid.addWidget(self.object_group_box, 0, 2, 5, 5)
         # must manually set column width for vtk_widget to maintain height:width ratio
         self.grid.setColumnMinimumWidth(2, 700)
 
+    def describe_objects(self):
+        return "Brain: {0} (min: {1:.2f}, max: {2:.2f})        Mask: {3}".format(os.path.basename(self.brain.file),
+                                                                              self.brain.scalar_range[0],
+                                                                              self.brain.scalar_range[1],
+                                                                              os.path.basename(self.mask.file))
+
     def add_brain_settings_widget(self):
         brain_group_box = QtWidgets.QGroupBox("Brain Settings")
         brain_group_layout = QtWidgets.QGridLayout()
-        brain_group_layout.addWidget(QtWidgets.QLabel("Brain Threshold"), 0, 0)
-        brain_group_layout.addWidget(QtWidgets.QLabel("Brain Opacity"), 1, 0)
-        brain_group_layout.addWidget(QtWidgets.QLabel("Brain Smoothness"), 2, 0)
-        brain_group_layout.addWidget(QtWidgets.QLabel("Image Intensity"), 3, 0)
-        brain_group_layout.addWidget(self.brain_threshold_sp, 0, 1, 1, 2)
-        brain_group_layout.addWidget(self.brain_opacity_sp, 1, 1, 1, 2)
-        brain_group_layout.addWidget(self.brain_smoothness_sp, 2, 1, 1, 2)
-        brain_group_layout.addWidget(self.brain_lut_sp, 3, 1, 1, 2)
-        brain_group_layout.addWidget(self.brain_projection_cb, 4, 0)
-        brain_group_layout.addWidget(self.brain_slicer_cb, 4, 1)
-        brain_group_layout.addWidget(self.create_new_separator(), 5, 0, 1, 3)
-        brain_group_layout.addWidget(QtWidgets.QLabel("Axial Slice"), 6, 0)
-        brain_group_layout.addWidget(QtWidgets.QLabel("Coronal Slice"), 7, 0)
-        brain_group_layout.addWidget(QtWidgets.QLabel("Sagittal Slice"), 8, 0)
-
-        # order is important
-        slicer_funcs = [self.axial_slice_changed, self.coronal_slice_changed, self.sagittal_slice_changed]
-        current_label_row = 6
-        # data extent is array [xmin, xmax, ymin, ymax, zmin, zmax)
-        # we want all the max values for the range
-        extent_index = 5
-        for func in slicer_funcs:
+        brain_group_layout.addWidget(QtWidgets.QLabel("Modality"), 0, 0)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Brain Threshold"), 1, 0)
+        brain_group_layout.addWidget(self.brain_threshold_info, 2, 0)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Brain Opacity"), 4, 0)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Brain Smoothness"), 5, 0)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Image Intensity"), 6, 0)
+        brain_group_layout.addWidget(self.modality_combo, 0, 1, 1, 2)
+        brain_group_layout.addWidget(self.brain_threshold_sp, 1, 1, 1, 2)
+        otsu_button, percentile_button, apply_button = self.brain_threshold_buttons
+        brain_group_layout.addWidget(otsu_button, 2, 1)
+        brain_group_layout.addWidget(percentile_button, 2, 2)
+        brain_group_layout.addWidget(apply_button, 3, 1, 1, 2)
+        brain_group_layout.addWidget(self.brain_opacity_sp, 4, 1, 1, 2)
+        brain_group_layout.addWidget(self.brain_smoothness_sp, 5, 1)
+        brain_group_layout.addWidget(self.brain_smoothing_combo, 5, 2)
+        brain_group_layout.addWidget(self.brain_lut_sp, 6, 1, 1, 2)
+        brain_group_layout.addWidget(self.brain_projection_cb, 7, 0)
+        brain_group_layout.addWidget(self.brain_slicer_cb, 7, 1)
+        brain_group_layout.addWidget(self.brain_probe_cb, 7, 2)
+        brain_group_layout.addWidget(self.create_new_separator(), 8, 0, 1, 3)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Axial Slice"), 9, 0)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Coronal Slice"), 10, 0)
+        brain_group_layout.addWidget(QtWidgets.QLabel("Sagittal Slice"), 11, 0)
+
+        # order is important: axial, coronal, sagittal
+        current_label_row = 9
+        for _ in range(3):
             slice_widget = QtWidgets.QSlider(Qt.Qt.Horizontal)
             slice_widget.setDisabled(True)
             self.slicer_widgets.append(slice_widget)
             brain_group_layout.addWidget(slice_widget, current_label_row, 1, 1, 2)
-            slice_widget.valueChanged.connect(func)
-            slice_widget.setRange(self.brain.extent[extent_index - 1], self.brain.extent[extent_index])
-            slice_widget.setValue(self.brain.extent[extent_index] / 2)
+            slice_widget.valueChanged.connect(self.slice_changed)
             current_label_row += 1
-            extent_index -= 2
+        self.reset_slice_widgets()
 
         brain_group_box.setLayout(brain_group_layout)
         self.grid.addWidget(brain_group_box, 0, 0, 1, 2)
 
-    def axial_slice_changed(self):
-        pos = self.slicer_widgets[0].value()
-        self.brain_slicer_props[0].SetDisplayExtent(self.brain.extent[0], self.brain.extent[1], self.brain.extent[2],
-                                                    self.brain.extent[3], pos, pos)
-        self.render_window.Render()
+    def reset_slice_widgets(self):
+        """ Fits the slider ranges to the brain extent, with the slices in the middle where setup_slicer puts them."""
+        # data extent is array [xmin, xmax, ymin, ymax, zmin, zmax), axial slices along z, sagittal along x
+        extent_index = 5
+        for slice_widget in self.slicer_widgets:
+            slice_widget.blockSignals(True)
+            slice_widget.setRange(self.brain.extent[extent_index - 1], self.brain.extent[extent_index])
+            slice_widget.setValue(self.brain.extent[extent_index] // 2)
+            slice_widget.blockSignals(False)
+            extent_index -= 2
 
-    def coronal_slice_changed(self):
-        pos = self.slicer_widgets[1].value()
-        self.brain_slicer_props[1].SetDisplayExtent(self.brain.extent[0], self.brain.extent[1], pos, pos,
-                                                    self.brain.extent[4], self.brain.extent[5])
+    def slice_changed(self):
+        self.update_slice_extents()
         self.render_window.Render()
 
-    def sagittal_slice_changed(self):
-        pos = self.slicer_widgets[2].value()
-        self.brain_slicer_props[2].SetDisplayExtent(pos, pos, self.brain.extent[2], self.brain.extent[3],
-                                                    self.brain.extent[4], self.brain.extent[5])
-        self.render_window.Render()
+    def update_slice_extents(self):
+        """ Shows the axial, coronal and sagittal slices at the slider positions."""
+        axial, coronal, sagittal = (widget.value() for widget in self.slicer_widgets)
+        x_min, x_max, y_min, y_max, z_min, z_max = self.brain.extent
+        self.brain_slicer_props[0].SetDisplayExtent(x_min, x_max, y_min, y_max, axial, axial)
+        self.brain_slicer_props[1].SetDisplayExtent(x_min, x_max, coronal, coronal, z_min, z_max)
+        self.brain_slicer_props[2].SetDisplayExtent(sagittal, sagittal, y_min, y_max, z_min, z_max)
+
+    def probe_cursor(self, obj, event):
+        """
+        Reads the brain intensity and mask label of the voxel under the mouse on every move while Probe is checked.
+        It costs one depth buffer value and two array lookups, no pipeline executes. The slices are moved to the
+        probed voxel when the slicer is shown, the slice under the mouse stays where it is.
+        """
+        if not self.brain_probe_cb.isChecked() or self.interacting:
+            return
+        start = time.perf_counter()
+        position = pick_world_position(self.renderer, *self.interactor.GetEventPosition())
+        brain_image, mask_image = self.brain.reader.GetOutput(), self.mask.reader.GetOutput()
+        voxel = world_to_voxel(brain_image, position) if position else None
+        if voxel is None:
+            self.statusBar().clearMessage()
+            return
+        intensity = probe_voxel(brain_image, voxel)
+        mask_voxel = world_to_voxel(mask_image, position)
+        label_value = probe_voxel(mask_image, mask_voxel) if mask_voxel else 0
+        seconds = time.perf_counter() - start
+        self.statusBar().showMessage("({:.1f}, {:.1f}, {:.1f}) mm  voxel ({}, {}, {})  {} {:g}  label {}  [{:.2f} ms]"
+                                     .format(*position, *voxel, get_modality_name(self.brain.file), intensity,
+                                             "{:g}".format(label_value) if label_value else "-", seconds * 1000))
+        if self.brain_slicer_cb.isChecked() and voxel != self.probed_voxel:
+            self.probed_voxel = voxel
+            for widget, index in zip(self.slicer_widgets, reversed(voxel)):  # axial k, coronal j, sagittal i
+                widget.blockSignals(True)
+                widget.setValue(index)
+                widget.blockSignals(False)
+            self.update_slice_extents()
+            self.render_window.Render()
 
     def add_mask_settings_widget(self):
         mask_settings_group_box = QtWidgets.QGroupBox("Mask Settings")
@@ -174,32 +400,82 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         mask_settings_layout.addWidget(QtWidgets.QLabel("Mask Smoothness"), 1, 0)
         mask_settings_layout.addWidget(self.mask_opacity_sp, 0, 1)
         mask_settings_layout.addWidget(self.mask_smoothness_sp, 1, 1)
+        mask_settings_layout.addWidget(self.mask_smoothing_combo, 1, 2)
         mask_multi_color_radio = QtWidgets.QRadioButton("Multi Color")
         mask_multi_color_radio.setChecked(True)
         mask_multi_color_radio.clicked.connect(self.mask_multi_color_radio_checked)
-        mask_single_color_radio = QtWidgets.QRadioButton("Single Color")
-        mask_single_color_radio.clicked.connect(self.mask_single_color_radio_checked)
+        self.mask_single_color_radio = QtWidgets.QRadioButton("Single Color")
+        self.mask_single_color_radio.clicked.connect(self.mask_single_color_radio_checked)
         mask_settings_layout.addWidget(mask_multi_color_radio, 2, 0)
-        mask_settings_layout.addWidget(mask_single_color_radio, 2, 1)
-        mask_settings_layout.addWidget(self.create_new_separator(), 3, 0, 1, 2)
+        mask_settings_layout.addWidget(self.mask_single_color_radio, 2, 1)
+        mask_settings_layout.addWidget(self.create_new_separator(), 3, 0, 1, 3)
+
+        # one checkbox per label found in the mask, scrollable since masks may have dozens of labels
+        self.labels_scroll_area = QtWidgets.QScrollArea()
+        self.labels_scroll_area.setWidget(self.add_mask_label_checkboxes())
+        self.labels_scroll_area.setWidgetResizable(True)
+        self.labels_scroll_area.setFrameShape(QtWidgets.QFrame.NoFrame)
+        mask_settings_layout.addWidget(self.labels_scroll_area, 4, 0, 1, 3)
+        mask_settings_layout.addWidget(self.label_statistics_table, 5, 0, 1, 3)
+        export_statistics_button = QtWidgets.QPushButton("Export Statistics")
+        export_statistics_button.clicked.connect(self.export_label_statistics)
+        mask_settings_layout.addWidget(export_statistics_button, 6, 0, 1, 3)
+
+        mask_settings_group_box.setLayout(mask_settings_layout)
+        self.grid.addWidget(mask_settings_group_box, 1, 0, 2, 2)
 
+    def add_mask_label_checkboxes(self):
         self.mask_label_cbs = []
-        c_col, c_row = 0, 4  # c_row must always be (+1) of last row
-        for i in range(1, 11):
-            self.mask_label_cbs.append(QtWidgets.QCheckBox("Label {}".format(i)))
-            mask_settings_layout.addWidget(self.mask_label_cbs[i - 1], c_row, c_col)
+        labels_widget = QtWidgets.QWidget()
+        labels_layout = QtWidgets.QGridLayout()
+        labels_layout.setContentsMargins(0, 0, 0, 0)
+        c_col, c_row = 0, 0
+        for label in self.mask.labels:
+            self.mask_label_cbs.append(QtWidgets.QCheckBox("Label {:g}".format(label.value)))
+            labels_layout.addWidget(self.mask_label_cbs[-1], c_row, c_col)
             c_row = c_row + 1 if c_col == 1 else c_row
             c_col = 0 if c_col == 1 else 1
+        labels_widget.setLayout(labels_layout)
 
-        mask_settings_group_box.setLayout(mask_settings_layout)
-        self.grid.addWidget(mask_settings_group_box, 1, 0, 2, 2)
+        # enabled by surface_loaded once the surface of the label arrived
+        for cb in self.mask_label_cbs:
+            cb.setDisabled(True)
+            cb.clicked.connect(self.mask_label_checked)
+        return labels_widget
 
-        for i, cb in enumerate(self.mask_label_cbs):
-            if i < len(self.mask.labels) and self.mask.labels[i].actor:
-                cb.setChecked(True)
-                cb.clicked.connect(self.mask_label_checked)
-            else:
-                cb.setDisabled(True)
+    @staticmethod
+    def add_label_statistics_table():
+        headers = ["Label", "Volume (ml)", "Area (mm\u00b2)", "Centroid (mm)", "Bounding Box (mm)"]
+        table = QtWidgets.QTableWidget(0, len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.verticalHeader().hide()
+        table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+        return table
+
+    def show_label_statistics(self):
+        """ Fills the statistics table, the voxel measures are computed once and the areas on the shown surfaces."""
+        if self.label_voxel_statistics is None:
+            self.label_voxel_statistics = compute_label_statistics(self.mask.reader.GetOutput(),
+                                                                   [label.value for label in self.mask.labels])
+        rows = collect_label_statistics(self.mask, self.label_voxel_statistics)
+        self.label_statistics_table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            cells = ["{:g}".format(row['label']),
+                     "{:.2f}".format(row['volume_ml']),
+                     "{:.1f}".format(row['area_mm2']) if row['area_mm2'] is not None else "-",
+                     "{:.1f}, {:.1f}, {:.1f}".format(row['centroid_x'], row['centroid_y'], row['centroid_z']),
+                     "{:.0f}-{:.0f}, {:.0f}-{:.0f}, {:.0f}-{:.0f}".format(*[row[axis + bound] for axis in 'xyz'
+                                                                          for bound in ('_min', '_max')])]
+            for column, text in enumerate(cells):
+                self.label_statistics_table.setItem(i, column, QtWidgets.QTableWidgetItem(text))
+
+    def export_label_statistics(self):
+        default_name = get_modality_name(self.mask.file) + '_statistics.csv'
+        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export Label Statistics", default_name,
+                                                             "CSV (*.csv)")
+        if file_name:
+            write_label_statistics(file_name, collect_label_statistics(self.mask, self.label_voxel_statistics))
 
     def add_views_widget(self):
         axial_view = QtWidgets.QPushButton("Axial")
@@ -216,6 +492,15 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         coronal_view.clicked.connect(self.set_coronal_view)
         sagittal_view.clicked.connect(self.set_sagittal_view)
 
+    @staticmethod
+    def create_smoothing_combo(value_changed_func):
+        combo = QtWidgets.QComboBox()
+        combo.addItems(SMOOTHING_METHODS)
+        combo.setCurrentText(SMOOTHING_METHOD)
+        combo.setToolTip("Smoothing method, the smoothness is given in Laplacian iterations for every method")
+        combo.currentIndexChanged.connect(value_changed_func)
+        return combo
+
     @staticmethod
     def create_new_picker(max_value, min_value, step, picker_value, value_changed_func):
         if isinstance(max_value, int):
@@ -237,12 +522,27 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
 
     def mask_label_checked(self):
         for i, cb in enumerate(self.mask_label_cbs):
-            if cb.isChecked():
-                self.mask.labels[i].property.SetOpacity(self.mask_opacity_sp.value())
-            elif cb.isEnabled():  # labels without data are disabled
-                self.mask.labels[i].property.SetOpacity(0)
+            if cb.isEnabled():  # labels without data are disabled
+                self.update_mask_label_visibility(i)
         self.render_window.Render()
 
+    def update_mask_label_visibility(self, label_idx):
+        """
+        Hides a label by turning its actor off instead of making it transparent, so it is skipped when rendering.
+        The surface of a hidden label is not rebuilt, smoothness changes catch up when it is shown again.
+        """
+        label = self.mask.labels[label_idx]
+        visible = self.mask_label_cbs[label_idx].isChecked() and self.mask_opacity_sp.value() > 0
+        label.actor.SetVisibility(visible)
+        if not visible:
+            self.surface_rebuilder.cancel(('mask', label_idx))
+            return
+        smoothing = self.mask_smoothness_sp.value(), self.mask_smoothing_combo.currentText()
+        rebuilding = ('mask', label_idx) in self.surface_rebuilder.jobs  # already at the current smoothness
+        stale = (label.smoothness, label.smoothing, label.level) != smoothing + (self.mask.level,)
+        if stale and not rebuilding:
+            self.rebuild_mask_surface(label_idx, *smoothing)
+
     def mask_single_color_radio_checked(self):
         for label in self.mask.labels:
             if label.property:
@@ -255,83 +555,442 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
                 label.property.SetColor(label.color)
         self.render_window.Render()
 
+    @staticmethod
+    def prepare_brain_views(brain):
+        """ The gray level table and intensity histogram of a modality, computed when it is first shown."""
+        if not brain.lookup_table:
+            create_brain_table(brain)
+            brain.histogram = compute_intensity_histogram(brain.reader.GetOutput())
+
+    def select_modality(self, index):
+        """
+        Shows another modality of the case. The mask surfaces, the camera and the slice positions stay, the slicer
+        and projection are pointed at the new volume and the brain surface is taken from what the modality kept:
+        its actor, its applied threshold and its surface memory. A modality shown for the first time is loaded.
+        """
+        brain = self.brains[index]
+        if brain is self.brain:
+            return
+        self.stop_time_series()  # a series keeps its frame and is prefetched from there when shown again
+        self.surface_rebuilder.cancel('brain')
+        for key in list(self.surface_rebuilder.jobs):
+            if key[0] == 'speculate':
+                self.surface_rebuilder.cancel(key)
+        self.surface_loader.cancel(self.brain)  # its surface is loaded again when it is shown next
+        if self.brain.labels[0].actor:
+            self.renderer.RemoveActor(self.brain.labels[0].actor)
+        self.modality_thresholds[self.brain] = self.brain_threshold
+
+        self.brain, self.brain_surfaces = brain, self.modality_surfaces[brain]
+        self.show_brain_views(self.modality_thresholds.get(brain, brain.labels[0].value))
+
+        label = brain.labels[0]
+        if label.actor:
+            self.renderer.AddActor(label.actor)
+            self.update_brain_opacity()
+            if (label.value, label.smoothness, label.smoothing) != self.brain_surface_key():
+                self.rebuild_brain_surface()
+            else:
+                self.speculate_brain_surfaces()
+            self.start_time_series()
+        else:
+            self.surface_loader.load(brain)
+        self.render()
+
+    def show_brain_views(self, threshold):
+        """ Points the slicer, the projection and the threshold picker at the brain shown."""
+        self.prepare_brain_views(self.brain)
+        for prop in self.brain_slicer_props + [self.brain_projection]:
+            prop.GetMapper().SetInputConnection(self.brain.reader.GetOutputPort())
+            set_brain_table(prop.GetProperty(), self.brain)
+        self.brain_threshold = threshold
+        self.brain_threshold_sp.setRange(self.brain.scalar_range[0], self.brain.scalar_range[1])
+        self.brain_threshold_sp.setValue(self.brain_threshold)
+        self.brain_threshold = self.brain_threshold_sp.value()  # as rounded by the picker
+        self.show_brain_threshold_info()
+        self.update_brain_lut()
+        self.object_group_box.setTitle(self.describe_objects())
+
     def brain_projection_vc(self):
         projection_checked = self.brain_projection_cb.isChecked()
         self.brain_slicer_cb.setDisabled(projection_checked)  # disable slicer checkbox, cant use both at same time
-        self.brain_image_prop.SetOpacity(projection_checked)
+        self.brain_projection.SetVisibility(projection_checked)
         self.render_window.Render()
 
     def brain_slicer_vc(self):
-        slicer_checked = self.brain_slicer_cb.isChecked()
+        self.slicer_while_loading = False
+        self.set_slicer_visible(self.brain_slicer_cb.isChecked())
 
+    def set_slicer_visible(self, slicer_checked):
         for widget in self.slicer_widgets:
             widget.setEnabled(slicer_checked)
 
         self.brain_projection_cb.setDisabled(slicer_checked)  # disable projection checkbox, cant use both at same time
         for prop in self.brain_slicer_props:
-            prop.GetProperty().SetOpacity(slicer_checked)
+            prop.SetVisibility(slicer_checked)
         self.render_window.Render()
 
     def brain_opacity_vc(self):
+        self.update_scheduler.schedule('brain_opacity', self.update_brain_opacity)
+
+    def update_brain_opacity(self):
         opacity = round(self.brain_opacity_sp.value(), 2)
-        self.brain.labels[0].property.SetOpacity(opacity)
-        self.render_window.Render()
+        if self.brain.labels[0].property:
+            self.brain.labels[0].property.SetOpacity(opacity)
+            self.brain.labels[0].actor.SetVisibility(opacity > 0)
 
     def brain_threshold_vc(self):
-        self.process_changes()
-        threshold = self.brain_threshold_sp.value()
-        self.brain.labels[0].extractor.SetValue(0, threshold)
-        self.render_window.Render()
+        """ Only previews the threshold (voxel fraction, tinted slices), apply_brain_threshold rebuilds the surface."""
+        self.show_brain_threshold_info()
+        self.update_brain_lut()
+        self.render()
+
+    def show_brain_threshold_info(self):
+        above = fraction_above(self.brain.histogram, self.brain_threshold_sp.value())
+        self.brain_threshold_info.setText("{:.1%} of voxels above".format(above))
+
+    def apply_brain_threshold(self):
+        if self.brain_threshold_sp.value() == self.brain_threshold:
+            return
+        self.brain_threshold = self.brain_threshold_sp.value()
+        self.update_brain_lut()
+        self.update_scheduler.schedule('brain_surface', self.rebuild_brain_surface, deferred=True)
 
     def brain_smoothness_vc(self):
-        self.process_changes()
-        smoothness = self.brain_smoothness_sp.value()
-        self.brain.labels[0].smoother.SetNumberOfIterations(smoothness)
-        self.render_window.Render()
+        self.update_scheduler.schedule('brain_surface', self.rebuild_brain_surface, deferred=True)
+
+    def rebuild_brain_surface(self):
+        """ Recompute the brain surface in the background, a newer value cancels a rebuild that is still running."""
+        if not self.brain.labels[0].actor:  # still loading, surface_loaded rebuilds it if the values changed
+            return
+        key = self.brain_surface_key()
+        if self.frame_prefetcher:
+            self.frame_prefetcher.set_surface_key(key + (self.brain.labels[0].triangle_budget,))
+        surface = self.brain_surfaces.get(key)
+        if surface or ('speculate',) + key in self.surface_rebuilder.jobs:
+            # precomputed, or brain_surface_speculated swaps it in as soon as it is
+            self.surface_rebuilder.cancel('brain')
+            if surface:
+                self.brain_surface_rebuilt(surface, *key)
+            return
+        filters = create_brain_surface_filters(get_level_image(self.brain), *key,
+                                               triangle_budget=self.brain.labels[0].triangle_budget)
+        set_stage_label(describe_label(self.brain, self.brain.labels[0]), *filters)
+        self.surface_rebuilder.rebuild('brain', filters, lambda surface: self.brain_surface_rebuilt(surface, *key))
+
+    def brain_surface_key(self):
+        """ The (threshold, smoothness, smoothing) applied to the brain surface."""
+        return self.brain_threshold, self.brain_smoothness_sp.value(), self.brain_smoothing_combo.currentText()
+
+    def brain_surface_rebuilt(self, surface, threshold, smoothness, smoothing):
+        self.brain_surfaces.put((threshold, smoothness, smoothing), surface)
+        self.brain.labels[0].level = self.brain.level  # jobs of other levels are cancelled when the level changes
+        self.surface_rebuilt(self.brain.labels[0], surface, smoothness, smoothing, threshold)
+        self.update_scheduler.finish('brain_surface')  # a threshold or smoothness change shows up
+        self.speculate_brain_surfaces()
+
+    def speculate_brain_surfaces(self):
+        """
+        Precomputes the brain surfaces of the thresholds next to the applied one on worker threads, users tend to
+        step back and forth around a value. Speculative jobs for thresholds that are no longer neighbors are
+        cancelled.
+        """
+        threshold, smoothness, smoothing = self.brain_threshold, self.brain.labels[0].smoothness, \
+            self.brain.labels[0].smoothing
+        step, decimals = self.brain_threshold_sp.singleStep(), self.brain_threshold_sp.decimals()
+        low, high = self.brain.scalar_range
+        neighbors = [round(threshold + i * step, decimals) for i in range(-BRAIN_SPECULATIVE_STEPS,
+                                                                          BRAIN_SPECULATIVE_STEPS + 1) if i]
+        wanted = {('speculate', neighbor, smoothness, smoothing) for neighbor in neighbors if low <= neighbor <= high}
+        for key in list(self.surface_rebuilder.jobs):
+            if key[0] == 'speculate' and key not in wanted:
+                self.surface_rebuilder.cancel(key)
+        for key in sorted(wanted):
+            if key[1:] in self.brain_surfaces or key in self.surface_rebuilder.jobs:
+                continue
+            filters = create_brain_surface_filters(get_level_image(self.brain), *key[1:],
+                                                   triangle_budget=self.brain.labels[0].triangle_budget)
+            set_stage_label(describe_label(self.brain, self.brain.labels[0]), *filters)
+            self.surface_rebuilder.rebuild(key, filters, lambda surface, key=key: self.brain_surface_speculated(
+                surface, *key[1:]))
+
+    def brain_surface_speculated(self, surface, threshold, smoothness, smoothing):
+        key = (threshold, smoothness, smoothing)
+        self.brain_surfaces.put(key, surface)
+        label = self.brain.labels[0]
+        if key == self.brain_surface_key() and (label.value, label.smoothness, label.smoothing) != key:
+            self.brain_surface_rebuilt(surface, *key)
+
+    def surface_rebuilt(self, label, surface, smoothness, smoothing, value=None):
+        set_label_surface(label, surface)
+        label.smoothness = smoothness
+        label.smoothing = smoothing
+        label.value = label.value if value is None else value
+        if label in self.mask.labels:  # the surface area changed with the smoothness
+            self.update_scheduler.schedule('label_statistics', self.show_label_statistics)
+        self.refine_timer.start()
+        self.render()
+        if label in self.mask.labels and not self.is_rebuilding_mask():
+            self.update_scheduler.finish('mask_surfaces')
+
+    def is_rebuilding_mask(self):
+        return any(key[0] == 'mask' for key in self.surface_rebuilder.jobs)
 
     def mask_opacity_vc(self):
+        self.update_scheduler.schedule('mask_opacity', self.update_mask_opacity)
+
+    def update_mask_opacity(self):
         opacity = round(self.mask_opacity_sp.value(), 2)
         for i, label in enumerate(self.mask.labels):
-            if label.property and self.mask_label_cbs[i].isChecked():
+            if label.property:
                 label.property.SetOpacity(opacity)
-        self.render_window.Render()
+                self.update_mask_label_visibility(i)
 
     def mask_smoothness_vc(self):
-        self.process_changes()
-        smoothness = self.mask_smoothness_sp.value()
-        for label in self.mask.labels:
-            if label.smoother:
-                label.smoother.SetNumberOfIterations(smoothness)
-        self.render_window.Render()
+        self.update_scheduler.schedule('mask_surfaces', self.rebuild_mask_surfaces, deferred=True)
+
+    def rebuild_mask_surfaces(self):
+        """ Recompute the label surfaces in the background, a newer value cancels rebuilds that are still running."""
+        smoothness, smoothing = self.mask_smoothness_sp.value(), self.mask_smoothing_combo.currentText()
+        for i, label in enumerate(self.mask.labels):
+            # labels still loading are rebuilt by surface_loaded, hidden ones once they are shown again
+            if label.actor and label.actor.GetVisibility():
+                self.rebuild_mask_surface(i, smoothness, smoothing)
+        if not self.is_rebuilding_mask():  # no label shown
+            self.update_scheduler.finish('mask_surfaces')
+
+    def rebuild_mask_surface(self, label_idx, smoothness, smoothing):
+        """ Smooths the decimated surface of the label again, or extracts it anew if the pyramid level changed."""
+        label = self.mask.labels[label_idx]
+        if label.level == self.mask.level:
+            filters = create_label_surface_filters(get_reduced_surface(label), smoothness, smoothing)
+            set_stage_label(describe_label(self.mask, label), *filters)
+            self.surface_rebuilder.rebuild(('mask', label_idx), filters,
+                                           lambda surface: self.surface_rebuilt(label, surface, smoothness, smoothing))
+            return
+        level, image = self.mask.level, get_level_image(self.mask)
+        filters = create_mask_label_filters(image, label.value, scale_extent(label.extent, level, image.GetExtent()),
+                                            smoothness, smoothing, label.triangle_budget)
+        set_stage_label(describe_label(self.mask, label), *filters)
+        self.surface_rebuilder.rebuild(('mask', label_idx), filters, lambda surface: self.mask_label_refined(
+            label, filters[-3].GetOutput(), surface, smoothness, smoothing, level))
+
+    def mask_label_refined(self, label, reduced, surface, smoothness, smoothing, level):
+        label.reducer = create_source(reduced)  # later smoothness changes start from the refined level
+        label.level = level
+        self.surface_rebuilt(label, surface, smoothness, smoothing)
+
+    def add_time_series_widget(self):
+        self.play_button = QtWidgets.QPushButton("Play")
+        self.play_button.clicked.connect(self.toggle_playback)
+        self.frame_slider = QtWidgets.QSlider(Qt.Qt.Horizontal)
+        self.frame_slider.valueChanged.connect(self.seek_frame)
+        self.frame_info = QtWidgets.QLabel()
+        self.time_series_box = QtWidgets.QGroupBox("Time Series")
+        time_series_layout = QtWidgets.QHBoxLayout()
+        time_series_layout.addWidget(self.play_button)
+        time_series_layout.addWidget(self.frame_slider)
+        time_series_layout.addWidget(self.frame_info)
+        self.time_series_box.setLayout(time_series_layout)
+        self.time_series_box.setVisible(any(brain.time_series for brain in self.brains))
+        self.time_series_box.setEnabled(False)  # enabled by start_time_series once the brain surface arrived
+        self.grid.addWidget(self.time_series_box, 5, 2, 1, 5)
+
+    def start_time_series(self):
+        """ Prefetches the frames of the brain shown if it is a time series, from the frame it shows on."""
+        series = self.brain.time_series
+        if not series or self.frame_prefetcher:
+            return
+        self.frame_prefetcher = FramePrefetcher(series)
+        self.frame_prefetcher.frame_ready.connect(self.frame_prefetched)
+        self.frame_prefetcher.seek(series.frame)
+        self.frame_prefetcher.set_surface_key(self.brain_surface_key() + (self.brain.labels[0].triangle_budget,))
+        self.frame_prefetcher.start()
+        self.frame_slider.blockSignals(True)
+        self.frame_slider.setRange(0, series.frames - 1)
+        self.frame_slider.setValue(series.frame)
+        self.frame_slider.blockSignals(False)
+        self.time_series_box.setEnabled(True)
+        self.show_frame_info()
+
+    def stop_time_series(self):
+        self.playback_timer.stop()
+        self.play_button.setText("Play")
+        self.pending_frame = None
+        if self.frame_prefetcher:
+            self.frame_prefetcher.stop()
+            self.frame_prefetcher = None
+        self.time_series_box.setEnabled(False)
+
+    def toggle_playback(self):
+        if self.playback_timer.isActive():
+            self.playback_timer.stop()
+            self.play_button.setText("Play")
+            self.speculate_brain_surfaces()  # skipped while playing, the frame changes too often
+        else:
+            self.playback_timer.start()
+            self.play_button.setText("Pause")
+
+    def play_next_frame(self):
+        """
+        Shows the next frame if the prefetcher has it. Otherwise the current frame is held for another tick, the
+        playback slows down while the prefetcher catches up instead of skipping frames or bursting to catch up.
+        """
+        series = self.brain.time_series
+        index = (series.frame + 1) % series.frames
+        frame = self.frame_prefetcher.get(index)
+        if frame:
+            self.show_frame(index, *frame)
+        else:
+            self.show_frame_info()
+
+    def seek_frame(self, index):
+        frame = self.frame_prefetcher.get(index)
+        if frame:
+            self.show_frame(index, *frame)
+        else:  # frame_prefetched shows it as soon as it is extracted
+            self.pending_frame = index
+            self.frame_prefetcher.seek(index)
+            self.show_frame_info()
+
+    def frame_prefetched(self, index):
+        frame = self.frame_prefetcher.get(index) if index == self.pending_frame else None
+        if frame:
+            self.show_frame(index, *frame)
+        else:
+            self.show_frame_info()
+
+    def show_frame(self, index, image, surface, surface_key):
+        """
+        Swaps a prefetched frame in. The slices, projection and later surface rebuilds follow the series output, the
+        brain surface is replaced by the prefetched one.
+        """
+        self.pending_frame = None
+        self.brain.time_series.show(index, image)
+        self.frame_prefetcher.seek(index)
+        self.surface_rebuilder.cancel('brain')  # rebuilds and speculation of the previous frame
+        for key in list(self.surface_rebuilder.jobs):
+            if key[0] == 'speculate':
+                self.surface_rebuilder.cancel(key)
+        threshold, smoothness, smoothing, _ = surface_key
+        self.brain_surfaces.clear()  # the kept surfaces are from another frame
+        self.brain_surfaces.put((threshold, smoothness, smoothing), surface)
+        self.frame_slider.blockSignals(True)
+        self.frame_slider.setValue(index)
+        self.frame_slider.blockSignals(False)
+        self.show_frame_info()
+        self.surface_rebuilt(self.brain.labels[0], surface, smoothness, smoothing, threshold)
+        if not self.playback_timer.isActive():
+            self.speculate_brain_surfaces()
+
+    def show_frame_info(self):
+        series = self.brain.time_series
+        if series and self.frame_prefetcher:
+            self.frame_info.setText("Frame {}/{} ({} buffered)".format(series.frame + 1, series.frames,
+                                                                      self.frame_prefetcher.buffered()))
+
+    def add_case_browser_widget(self):
+        self.case_list = QtWidgets.QListWidget()
+        for name, brain_files, mask_file in self.case_browser.cases:
+            item = QtWidgets.QListWidgetItem(name)
+            item.setToolTip("\n".join(brain_files + [mask_file]))
+            self.case_list.addItem(item)
+        self.case_list.setCurrentRow(self.case_browser.current)
+        self.case_list.setMaximumHeight(120)
+        self.case_list.currentRowChanged.connect(self.show_case)
+        previous_button = QtWidgets.QPushButton("Previous")
+        previous_button.setShortcut("PgUp")
+        previous_button.clicked.connect(lambda: self.case_list.setCurrentRow(max(self.case_browser.current - 1, 0)))
+        next_button = QtWidgets.QPushButton("Next")
+        next_button.setShortcut("PgDown")
+        next_button.clicked.connect(lambda: self.case_list.setCurrentRow(
+            min(self.case_browser.current + 1, self.case_list.count() - 1)))
+        self.case_info = QtWidgets.QLabel()
+        case_box = QtWidgets.QGroupBox("Cases")
+        case_layout = QtWidgets.QGridLayout()
+        case_layout.addWidget(self.case_list, 0, 0, 1, 2)
+        case_layout.addWidget(previous_button, 1, 0)
+        case_layout.addWidget(next_button, 1, 1)
+        case_layout.addWidget(self.case_info, 2, 0, 1, 2)
+        case_box.setLayout(case_layout)
+        case_box.setVisible(len(self.case_browser.cases) > 1)
+        self.grid.addWidget(case_box, 5, 0, 1, 2)
+
+    def prepare_case(self, brains, mask):
+        """ Gives the NiiObjects of a case the current settings before its surfaces are extracted."""
+        share_study_triangle_budget(brains, mask, vtkUtils.triangle_budget)
+        for brain in brains:
+            brain.labels[0].smoothness = self.brain_smoothness_sp.value()
+            brain.labels[0].smoothing = self.brain_smoothing_combo.currentText()
+        for label in mask.labels:
+            label.smoothness = self.mask_smoothness_sp.value()
+            label.smoothing = self.mask_smoothing_combo.currentText()
+
+    def show_case(self, index):
+        """
+        Shows another case of the case list without tearing down the render window. The camera and the settings
+        stay, the NiiObjects of the case are swapped in like the modalities in select_modality. What the case browser
+        prefetched is shown right away, the missing surfaces are loaded.
+        """
+        if index == self.case_browser.current:
+            return
+        try:
+            brains, mask = self.case_browser.take(index)
+        except (OSError, ValueError) as e:
+            self.statusBar().showMessage("Cannot open {}: {}".format(self.case_browser.cases[index][0], e))
+            self.case_list.blockSignals(True)
+            self.case_list.setCurrentRow(self.case_browser.current)
+            self.case_list.blockSignals(False)
+            return
+        self.stop_time_series()
+        self.refine_timer.stop()
+        for nii_object in self.brains + [self.mask]:
+            self.surface_loader.cancel(nii_object)
+            for label in nii_object.labels:
+                if label.actor:
+                    self.renderer.RemoveActor(label.actor)
+        self.surface_rebuilder.cancel_all()
+
+        self.brains, self.mask = brains, mask
+        self.brain = brains[0]
+        self.modality_surfaces = {brain: SurfaceMemory(BRAIN_SURFACE_MEMORY // len(brains)) for brain in brains}
+        self.modality_thresholds = {}
+        self.brain_surfaces = self.modality_surfaces[self.brain]
+        self.modality_combo.blockSignals(True)
+        self.modality_combo.clear()
+        self.modality_combo.addItems([get_modality_name(brain.file) for brain in brains])
+        self.modality_combo.setEnabled(len(brains) > 1)
+        self.modality_combo.blockSignals(False)
+        self.show_brain_views(self.brain.labels[0].value)
+        self.reset_slice_widgets()
+        self.update_slice_extents()
+        self.probed_voxel = None
+        self.labels_scroll_area.setWidget(self.add_mask_label_checkboxes())
+        self.label_voxel_statistics = None
+        self.label_statistics_table.setRowCount(0)
+        self.time_series_box.setVisible(any(brain.time_series for brain in brains))
+        self.swapping_case = True
+        self.surface_loader.load(self.brain, self.mask)  # prefetched surfaces arrive in surface_loaded right away
+        self.swapping_case = False
+        self.update_scheduler.schedule('label_statistics', self.show_label_statistics)
+        self.show_case_info()
+        self.render()
+
+    def show_case_info(self):
+        names = {self.case_browser.current - 1: "Previous", self.case_browser.current + 1: "Next"}
+        self.case_info.setText(", ".join("{} {}".format(names[index], self.case_browser.state(index) or "waiting")
+                                         for index in self.case_browser.neighbors()))
 
     def set_axial_view(self):
-        self.renderer.ResetCamera()
-        fp = self.renderer.GetActiveCamera().GetFocalPoint()
-        p = self.renderer.GetActiveCamera().GetPosition()
-        dist = math.sqrt((p[0] - fp[0]) ** 2 + (p[1] - fp[1]) ** 2 + (p[2] - fp[2]) ** 2)
-        self.renderer.GetActiveCamera().SetPosition(fp[0], fp[1], fp[2] + dist)
-        self.renderer.GetActiveCamera().SetViewUp(0.0, 1.0, 0.0)
-        self.renderer.GetActiveCamera().Zoom(1.8)
+        set_camera_view(self.renderer, 'axial')
         self.render_window.Render()
 
     def set_coronal_view(self):
-        self.renderer.ResetCamera()
-        fp = self.renderer.GetActiveCamera().GetFocalPoint()
-        p = self.renderer.GetActiveCamera().GetPosition()
-        dist = math.sqrt((p[0] - fp[0]) ** 2 + (p[1] - fp[1]) ** 2 + (p[2] - fp[2]) ** 2)
-        self.renderer.GetActiveCamera().SetPosition(fp[0], fp[2] - dist, fp[1])
-        self.renderer.GetActiveCamera().SetViewUp(0.0, 0.5, 0.5)
-        self.renderer.GetActiveCamera().Zoom(1.8)
+        set_camera_view(self.renderer, 'coronal')
         self.render_window.Render()
 
     def set_sagittal_view(self):
-        self.renderer.ResetCamera()
-        fp = self.renderer.GetActiveCamera().GetFocalPoint()
-        p = self.renderer.GetActiveCamera().GetPosition()
-        dist = math.sqrt((p[0] - fp[0]) ** 2 + (p[1] - fp[1]) ** 2 + (p[2] - fp[2]) ** 2)
-        self.renderer.GetActiveCamera().SetPosition(fp[2] + dist, fp[0], fp[1])
-        self.renderer.GetActiveCamera().SetViewUp(0.0, 0.0, 1.0)
-        self.renderer.GetActiveCamera().Zoom(1.6)
+        set_camera_view(self.renderer, 'sagittal')
         self.render_window.Render()
 
     @staticmethod
@@ -342,7 +1001,9 @@ class MainWindow(QtWidgets.QMainWindow, QtWidgets.QApplication):
         horizontal_line.setStyleSheet("background-color: #c8c8c8;")
         return horizontal_line
 
-    def process_changes(self):
-        for _ in range(10):
-            self.app.processEvents()
-            time.sleep(0.1)
+    def closeEvent(self, event):
+        self.update_scheduler.timer.stop()
+        self.stop_time_series()
+        self.surface_rebuilder.shutdown()
+        self.case_browser.shutdown()
+        QtWidgets.QMainWindow.closeEvent(self, event)
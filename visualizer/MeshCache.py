@@ -0,0 +1,133 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import vtk
+
+
+class MeshCache:
+    """
+    On-disk cache of extracted surfaces stored as compressed .vtp files. Entries are keyed by the path, size and
+    modification time of the NIfTI file and the pipeline parameters used to produce the surface. The least recently
+    used entries are evicted once the cache grows past max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def file_digest(file_name):
+        """
+        Identifies a file by path, size and modification time like VolumeStore.key. Hashing its content would read
+        every input again on each launch.
+        """
+        stat = os.stat(file_name)
+        description = '{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def key(self, file_name, **params):
+        """
+        :param file_name: the NIfTI file the surface is extracted from
+        :param params: everything else that changes the surface (iso value/label, reduction, smoothing, ...)
+        :return: the cache key
+        """
+        description = json.dumps(params, sort_keys=True)
+        return hashlib.sha1((self.file_digest(file_name) + description).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.vtp')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        """
+        :return: the cached vtkPolyData or None on a cache miss
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(path)
+        reader.Update()
+        os.utime(path)  # the modification time doubles as the last access time for LRU eviction
+        return reader.GetOutput()
+
+    def store(self, key, surface):
+        path = self.path(key)
+        partial_path = '{}.{}.{}.partial'.format(path, os.getpid(), threading.get_ident())  # written from workers
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetFileName(partial_path)
+        writer.SetInputData(surface)
+        writer.SetCompressorTypeToZLib()
+        writer.SetDataModeToAppended()
+        writer.Write()
+        os.replace(partial_path, path)  # readers (other processes included) never see a half written file
+        self.evict()
+
+    def entries(self):
+        """ Cached files sorted from least to most recently used."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.vtp'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:  # evicted by another process in the meantime
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total_size <= self.max_size:
+                break
+            self.remove(name)
+            total_size -= size
+
+    def clear(self):
+        for _, _, name in self.entries():
+            self.remove(name)
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class SurfaceMemory:
+    """
+    Bounded in-memory LRU of finished surfaces (vtkPolyData) keyed by their pipeline parameters, e.g. the
+    (threshold, smoothness) of a brain surface. The least recently used surfaces are dropped once the kept
+    surfaces take more than max_size bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.surfaces = collections.OrderedDict()  # key -> (vtkPolyData, bytes), least recently used first
+
+    def __contains__(self, key):
+        return key in self.surfaces
+
+    def get(self, key):
+        if key not in self.surfaces:
+            return None
+        self.surfaces.move_to_end(key)
+        return self.surfaces[key][0]
+
+    def put(self, key, surface):
+        self.surfaces[key] = (surface, surface.GetActualMemorySize() * 1024)
+        self.surfaces.move_to_end(key)
+        total_size = sum(size for _, size in self.surfaces.values())
+        while total_size > self.max_size and len(self.surfaces) > 1:
+            _, (_, size) = self.surfaces.popitem(last=False)
+            total_size -= size
+
+    def clear(self):
+        self.surfaces.clear()
@@ -1,8 +1,21 @@
 class NiiLabel:
-    def __init__(self, color, opacity, smoothness):
+    def __init__(self, color, opacity, smoothness, smoothing):
         self.actor = None
+        self.mapper = None
+        self.lod_ids = []
+        self.lod_reducers = []
+        self.lod_normals = []  # the pipelines of the levels of detail, see vtkUtils.set_label_surface
         self.property = None
+        self.reducer = None
         self.smoother = None
+        self.value = None  # the iso value (brain) or label value (mask) the surface is extracted at
+        self.voxel_count = 0
+        self.extent = None  # voxel bounding box of a mask label, see vtkUtils.compute_label_extents
         self.color = color
         self.opacity = opacity
-        self.smoothness = smoothness
\ No newline at end of file
+        self.smoothness = smoothness
+        self.smoothing = smoothing  # the smoothing method, see vtkUtils.create_smoother
+        self.level = 0  # the pyramid level of the shown surface, see NiiObject.pyramid
+        self.deferred = False  # extracted in the background, mesh cache entry and levels of detail still missing
+        self.cell_count = 0  # predicted extracted triangles (with a budget), see vtkUtils.estimate_extracted_cells
+        self.triangle_budget = None  # triangles the surface is reduced to, see vtkUtils.share_triangle_budget
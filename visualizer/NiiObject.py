@@ -4,5 +4,10 @@ class NiiObject:
         self.reader = None
         self.extent = ()
         self.labels = []
-        self.image_mapper = None
+        self.lookup_table = None
         self.scalar_range = None
+        self.pyramid = []  # vtkImageData per level, the first is the reader output, None if released (build_pyramid)
+        self.level = 0  # the pyramid level the surfaces are extracted from
+        self.finest_level = 0  # the finest level the surfaces are extracted from, see PYRAMID_EXTRACTION_VOXELS
+        self.time_series = None  # the frames of a 4D brain, see TimeSeries
+        self.histogram = None  # intensity histogram of a brain, see vtkUtils.compute_intensity_histogram
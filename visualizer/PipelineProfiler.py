@@ -0,0 +1,106 @@
+import collections
+import csv
+import json
+import threading
+import time
+
+
+def count_points_and_cells(data):
+    if data is None or not hasattr(data, 'GetNumberOfPoints'):
+        return None, None
+    return data.GetNumberOfPoints(), data.GetNumberOfCells()
+
+
+class PipelineProfiler:
+    """
+    Records the wall time, input/output point and cell counts and output memory of every pipeline stage it observes
+    through the StartEvent/EndEvent of the VTK filters. Filters may execute on worker threads. The per stage totals
+    cover the whole session, only the last max_records executions are kept as records.
+    """
+    FIELDS = ['stage', 'label', 'filter', 'seconds', 'input_points', 'input_cells', 'output_points', 'output_cells',
+              'output_kib', 'thread']
+
+    def __init__(self, max_records=100000):
+        self.records = collections.deque(maxlen=max_records)
+        self.totals = {}  # stage -> [executions, seconds]
+        self.labels = {}
+        self.starts = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def filter_key(vtk_filter):
+        return vtk_filter.__this__
+
+    def observe(self, vtk_filter, stage):
+        """
+        :param vtk_filter: the vtkAlgorithm to time
+        :param stage: the pipeline stage name (reader, extractor, decimate, ...)
+        """
+        vtk_filter.AddObserver('StartEvent', lambda obj, event: self.stage_started(obj))
+        vtk_filter.AddObserver('EndEvent', lambda obj, event: self.stage_ended(obj, stage))
+
+    def set_label(self, vtk_filter, label):
+        """ Attribute the executions of an observed filter to a label (e.g. a mask label)."""
+        self.labels[self.filter_key(vtk_filter)] = label
+
+    def stage_started(self, vtk_filter):
+        with self.lock:
+            self.starts[(threading.get_ident(), self.filter_key(vtk_filter))] = time.perf_counter()
+
+    def stage_ended(self, vtk_filter, stage):
+        end = time.perf_counter()
+        key = self.filter_key(vtk_filter)
+        with self.lock:
+            start = self.starts.pop((threading.get_ident(), key), None)
+        if start is None:
+            return
+
+        input_data = vtk_filter.GetInputDataObject(0, 0) if vtk_filter.GetNumberOfInputPorts() else None
+        output_data = vtk_filter.GetOutputDataObject(0) if vtk_filter.GetNumberOfOutputPorts() else None
+        input_points, input_cells = count_points_and_cells(input_data)
+        output_points, output_cells = count_points_and_cells(output_data)
+        record = {
+            'stage': stage,
+            'label': self.labels.get(key, ''),
+            'filter': vtk_filter.GetClassName(),
+            'seconds': end - start,
+            'input_points': input_points,
+            'input_cells': input_cells,
+            'output_points': output_points,
+            'output_cells': output_cells,
+            'output_kib': output_data.GetActualMemorySize() if output_data else None,
+            'thread': threading.current_thread().name,
+        }
+        with self.lock:
+            self.records.append(record)
+            total = self.totals.setdefault(stage, [0, 0.0])
+            total[0] += 1
+            total[1] += record['seconds']
+
+    def summary(self):
+        """
+        :return: OrderedDict stage -> (executions, total seconds), slowest stage first
+        """
+        with self.lock:
+            totals = [(stage, tuple(total)) for stage, total in self.totals.items()]
+        ordered = sorted(totals, key=lambda item: item[1][1], reverse=True)
+        return collections.OrderedDict(ordered)
+
+    def summary_text(self):
+        lines = ['{:<12} {:>8.2f} s  ({}x)'.format(stage, seconds, count)
+                 for stage, (count, seconds) in self.summary().items()]
+        return '\n'.join(lines)
+
+    def write(self, file_name):
+        """ Write the records as CSV when file_name ends with .csv, as JSON otherwise."""
+        with self.lock:
+            records = list(self.records)
+        with open(file_name, 'w', newline='') as f:
+            if file_name.lower().endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                summary = [{'stage': stage, 'executions': count, 'seconds': seconds}
+                           for stage, (count, seconds) in self.summary().items()]
+                json.dump({'summary': summary, 'records': records}, f, indent=2)
@@ -0,0 +1,248 @@
+import os
+
+import PyQt5.QtCore as Qt
+
+import vtkUtils
+from vtkUtils import *
+
+
+class SurfaceLoader(Qt.QObject):
+    """
+    Brings in the surfaces of an opened brain and mask (see vtkUtils.open_brain and open_mask) progressively, so the
+    window can show the slices as soon as the volumes are read. Cached surfaces are read first. For the others a
+    coarse preview is computed and the full surfaces follow one by one as they finish, all on the worker threads of a
+    SurfaceRebuilder. The workers also write the mesh cache and compute the levels of detail, the GUI thread only
+    creates the actors. Surfaces are extracted from the current pyramid level of each volume. Labels that already
+    have a surface (extracted by the loader of a CaseBrowser) count as loaded, what that loader deferred is finished
+    in the background.
+    """
+    preview_ready = Qt.pyqtSignal(object)  # a preview vtkActor to show
+    preview_expired = Qt.pyqtSignal(object)  # a preview vtkActor to remove, the full surfaces it stands for arrived
+    surface_loaded = Qt.pyqtSignal(object, int)  # NiiObject, label index, the label actor is None if it has no data
+    progress = Qt.pyqtSignal(int, int)  # surfaces loaded, surfaces in total
+    all_loaded = Qt.pyqtSignal()  # every surface asked for arrived, not emitted when loading is cancelled
+
+    def __init__(self, surface_rebuilder, previews=True, deferred=False):
+        """
+        :param previews: compute the coarse previews, not needed when nothing is shown while loading
+        :param deferred: leave the mesh cache writes and the levels of detail to the next load of the surfaces (a
+        prefetched case may never be shown), the labels are marked NiiLabel.deferred
+        """
+        Qt.QObject.__init__(self)
+        self.surface_rebuilder = surface_rebuilder
+        self.previews_enabled = previews
+        self.deferred = deferred
+        self.pending = {}  # NiiObject -> indices of the labels still loading
+        self.previews = {}  # NiiObject -> preview vtkActor
+        self.loaded = 0
+        self.total = 0
+
+    def load(self, brain, mask=None):
+        """
+        :param brain: the brain to load
+        :param mask: the mask to load, None when only another modality of the case is loaded
+        """
+        nii_objects = [nii_object for nii_object in (brain, mask) if nii_object]
+        if not self.pending:
+            self.loaded, self.total = 0, 0
+        self.total += sum(len(nii_object.labels) for nii_object in nii_objects)
+        for nii_object in nii_objects:
+            pending = [i for i, label in enumerate(nii_object.labels) if not label.actor]
+            for label_idx in range(len(nii_object.labels)):
+                if label_idx not in pending:  # already extracted
+                    self.finish(nii_object, label_idx)
+            for label_idx in pending:
+                nii_object.labels[label_idx].level = nii_object.level  # loaded at the current pyramid level
+            if pending:
+                self.pending[nii_object] = set(pending)
+            if not self.deferred:
+                self.complete_deferred(nii_object)
+        self.progress.emit(self.loaded, self.total)
+        if not self.pending:
+            self.all_loaded.emit()
+
+        extract = {brain: lambda label_indices: self.load_brain(brain),
+                   mask: lambda label_indices: self.load_mask(mask, label_indices)}
+        for nii_object in nii_objects:
+            if nii_object in self.pending:
+                if vtkUtils.mesh_cache:
+                    self.load_cached(nii_object, extract[nii_object])
+                else:
+                    extract[nii_object](sorted(self.pending[nii_object]))
+
+    def is_loading(self, nii_object=None):
+        return nii_object in self.pending if nii_object else bool(self.pending)
+
+    def cancel(self, nii_object):
+        """ Stops loading the surfaces of a NiiObject (a modality switched away from), its preview expires."""
+        pending = self.pending.pop(nii_object, set())
+        for key in [('cache', nii_object.file), ('complete', nii_object.file), ('preview', nii_object.file),
+                    ('load', nii_object.file)] + \
+                [('load', nii_object.file, i) for i in pending]:
+            self.surface_rebuilder.cancel(key)
+        self.total -= len(pending)
+        if nii_object in self.previews:
+            self.preview_expired.emit(self.previews.pop(nii_object))
+        self.progress.emit(self.loaded, self.total)
+
+    def load_cached(self, nii_object, extract):
+        """
+        Reads the cached surfaces of the pending labels on a worker thread, the others are extracted afterwards.
+        :param extract: called with the indices of the labels missing from the cache
+        """
+        label_indices = sorted(self.pending[nii_object])
+        self.surface_rebuilder.rebuild(('cache', nii_object.file), [],
+                                       lambda surfaces: self.cached_surfaces_ready(nii_object, surfaces, extract),
+                                       work=lambda _: self.read_cached_surfaces(nii_object, label_indices))
+
+    def read_cached_surfaces(self, nii_object, label_indices):
+        """
+        Runs on a worker thread.
+        :return: label index -> (reduced, surface, lod_surfaces) for the labels found in the mesh cache
+        """
+        surfaces = {}
+        for label_idx in label_indices:
+            cached = load_cached_surface(nii_object, nii_object.labels[label_idx])
+            if cached:
+                surfaces[label_idx] = cached + (self.compute_lod_surfaces(cached[1]),)
+        return surfaces
+
+    def compute_lod_surfaces(self, surface):
+        return create_lod_surfaces(surface) if LOD_DIVISIONS and not self.deferred else None
+
+    def cached_surfaces_ready(self, nii_object, surfaces, extract):
+        for label_idx, (reduced, surface, lod_surfaces) in sorted(surfaces.items()):
+            self.attach(nii_object.labels[label_idx], reduced, surface, lod_surfaces)
+            self.finish(nii_object, label_idx)
+        if nii_object in self.pending:
+            extract(sorted(self.pending[nii_object]))
+
+    def load_brain(self, brain):
+        label = brain.labels[0]
+        image = get_level_image(brain)
+        if self.previews_enabled:
+            preview_filters = create_preview_filters(image, [label.value], discrete=False)
+            set_stage_label(describe_label(brain, label), *preview_filters)
+            self.surface_rebuilder.rebuild(('preview', brain.file), preview_filters,
+                                           lambda surface: self.show_preview(brain, surface, label.color))
+
+        filters = create_brain_surface_filters(image, label.value, label.smoothness, label.smoothing,
+                                               label.triangle_budget)
+        set_stage_label(describe_label(brain, label), *filters)
+        self.surface_rebuilder.rebuild(('load', brain.file), filters,
+                                       lambda result: self.surface_ready(brain, 0, result),
+                                       work=lambda surface: self.store_surface(brain, 0, filters[-3].GetOutput(),
+                                                                               surface))
+
+    def load_mask(self, mask, label_indices):
+        image = get_level_image(mask)
+        label_values = [mask.labels[i].value for i in label_indices]
+        extents = {i: scale_extent(mask.labels[i].extent, mask.level, image.GetExtent()) for i in label_indices}
+        extent = merge_extents(extents.values())
+        if self.previews_enabled:
+            preview_filters = create_preview_filters(image, label_values, discrete=True, extent=extent)
+            set_stage_label(os.path.basename(mask.file), *preview_filters)
+            colors = {mask.labels[i].value: mask.labels[i].color for i in label_indices}
+            self.surface_rebuilder.rebuild(('preview', mask.file), preview_filters,
+                                           lambda surface: self.show_preview(mask, surface, colors))
+
+        if MASK_SINGLE_PASS:
+            # one traversal for every label, the labels are split and smoothed in parallel afterwards
+            filters = create_multi_label_filters(image, label_values, extent)
+            set_stage_label(os.path.basename(mask.file), *filters)
+            self.surface_rebuilder.rebuild(('load', mask.file), filters,
+                                           lambda combined: self.split_mask(mask, label_indices, combined))
+        else:
+            for i in label_indices:
+                label = mask.labels[i]
+                self.load_mask_label(mask, i, create_mask_label_filters(image, label.value, extents[i],
+                                                                        label.smoothness, label.smoothing,
+                                                                        label.triangle_budget))
+
+    def split_mask(self, mask, label_indices, combined):
+        for i in label_indices:
+            label = mask.labels[i]
+            self.load_mask_label(mask, i, create_split_label_filters(combined, label.value, label.smoothness,
+                                                                     label.smoothing, label.triangle_budget))
+
+    def load_mask_label(self, mask, label_idx, filters):
+        set_stage_label(describe_label(mask, mask.labels[label_idx]), *filters)
+        self.surface_rebuilder.rebuild(('load', mask.file, label_idx), filters,
+                                       lambda result: self.surface_ready(mask, label_idx, result),
+                                       work=lambda surface: self.store_surface(mask, label_idx,
+                                                                               filters[-3].GetOutput(), surface))
+
+    def show_preview(self, nii_object, surface, colors):
+        if nii_object not in self.pending:  # the full surfaces were faster
+            return
+        self.previews[nii_object] = create_preview_actor(surface, nii_object.labels[0].opacity, colors)
+        self.preview_ready.emit(self.previews[nii_object])
+
+    def store_surface(self, nii_object, label_idx, reduced, surface):
+        """
+        Runs on a worker thread once a surface is extracted: writes it to the mesh cache and computes its levels of
+        detail, unless deferred.
+        :return: (reduced, surface, lod_surfaces), None if the label has no data
+        """
+        if not surface.GetNumberOfCells():
+            return None
+        if vtkUtils.mesh_cache and not self.deferred:
+            store_cached_surface(nii_object, nii_object.labels[label_idx], reduced, surface)
+        return reduced, surface, self.compute_lod_surfaces(surface)
+
+    def surface_ready(self, nii_object, label_idx, result):
+        if result:
+            self.attach(nii_object.labels[label_idx], *result)
+        self.finish(nii_object, label_idx)
+
+    def attach(self, label, reduced, surface, lod_surfaces):
+        attach_surface(label, reduced, surface, lod_surfaces)
+        label.deferred = self.deferred
+
+    def complete_deferred(self, nii_object):
+        """ Stores and computes the levels of detail of the surfaces a deferred loader left unfinished."""
+        label_indices = [i for i, label in enumerate(nii_object.labels) if label.actor and label.deferred]
+        if not label_indices:
+            return
+        surfaces = {i: (get_reduced_surface(nii_object.labels[i]), get_label_surface(nii_object.labels[i]))
+                    for i in label_indices}
+        self.surface_rebuilder.rebuild(('complete', nii_object.file), [],
+                                       lambda lod_surfaces: self.deferred_completed(nii_object, lod_surfaces),
+                                       work=lambda _: self.complete_surfaces(nii_object, surfaces))
+
+    def complete_surfaces(self, nii_object, surfaces):
+        """
+        Runs on a worker thread.
+        :param surfaces: label index -> (reduced, surface) of the labels to complete
+        :return: label index -> lod_surfaces
+        """
+        lod_surfaces = {}
+        for label_idx, (reduced, surface) in surfaces.items():
+            label = nii_object.labels[label_idx]
+            if vtkUtils.mesh_cache and surface_cache_keys(nii_object, label)[1] not in vtkUtils.mesh_cache:
+                store_cached_surface(nii_object, label, reduced, surface)
+            lod_surfaces[label_idx] = self.compute_lod_surfaces(surface)
+        return lod_surfaces
+
+    def deferred_completed(self, nii_object, lod_surfaces):
+        for label_idx, label_lod_surfaces in lod_surfaces.items():
+            label = nii_object.labels[label_idx]
+            if label.actor and label.deferred:  # not replaced meanwhile
+                if label_lod_surfaces:
+                    set_lod_surfaces(label, label_lod_surfaces)
+                label.deferred = False
+
+    def finish(self, nii_object, label_idx):
+        self.loaded += 1
+        self.surface_loaded.emit(nii_object, label_idx)
+        pending = self.pending.get(nii_object)
+        if pending is not None:
+            pending.discard(label_idx)
+            if not pending:
+                del self.pending[nii_object]
+                self.surface_rebuilder.cancel(('preview', nii_object.file))
+                if nii_object in self.previews:
+                    self.preview_expired.emit(self.previews.pop(nii_object))
+                if not self.pending:
+                    self.all_loaded.emit()
+        self.progress.emit(self.loaded, self.total)
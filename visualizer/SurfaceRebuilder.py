@@ -0,0 +1,90 @@
+import PyQt5.QtCore as Qt
+
+
+class SurfaceJob(Qt.QThread):
+    """
+    Runs a standalone surface pipeline (see vtkUtils.create_brain_surface_filters) off the GUI thread.
+    The last filter is updated, which pulls the whole chain, and its output is emitted when it finishes. An optional
+    work function takes the output on the worker thread and emits its result instead (e.g. cache I/O).
+    """
+    surface_ready = Qt.pyqtSignal(object)
+
+    def __init__(self, filters, work=None):
+        Qt.QThread.__init__(self)
+        self.filters = filters
+        self.work = work
+        self.cancelled = False
+
+    def run(self):
+        result = None
+        if self.filters:
+            self.filters[-1].Update()
+            result = self.filters[-1].GetOutput()
+        if self.work and not self.cancelled:
+            result = self.work(result)
+        if not self.cancelled:
+            self.surface_ready.emit(result)
+
+    def cancel(self):
+        """ Ask every filter of the pipeline to stop, the partial output is discarded."""
+        self.cancelled = True
+        for vtk_filter in self.filters:
+            vtk_filter.AbortExecuteOn()
+
+
+class SurfaceRebuilder(Qt.QObject):
+    """
+    Schedules surface rebuilds on worker threads. There is at most one live job per key (e.g. 'brain' or a mask
+    label index), a newer rebuild for the same key cancels the one that is still running.
+    """
+
+    def __init__(self, priority=Qt.QThread.InheritPriority):
+        """
+        :param priority: of the worker threads, background work (see CaseBrowser) yields to the shown surfaces
+        """
+        Qt.QObject.__init__(self)
+        self.priority = priority
+        self.jobs = {}
+        self.threads = []  # every started job must stay referenced until its thread actually stops
+
+    def rebuild(self, key, filters, callback, work=None):
+        """
+        :param key: identifies the surface being rebuilt
+        :param filters: the standalone pipeline to run, the last filter produces the surface, may be empty with work
+        :param callback: called on the GUI thread with the new vtkPolyData, or with the result of work
+        :param work: called on the worker thread with the new vtkPolyData (None without filters)
+        """
+        self.cancel(key)
+        job = SurfaceJob(filters, work)
+        job.surface_ready.connect(lambda surface: self.job_finished(key, job, surface, callback))
+        job.finished.connect(lambda: self.job_stopped(job))
+        self.jobs[key] = job
+        self.threads.append(job)
+        job.start(self.priority)
+
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job:
+            job.cancel()
+
+    def cancel_all(self):
+        for key in list(self.jobs):
+            self.cancel(key)
+
+    def shutdown(self):
+        """ Cancel everything and wait for the worker threads, a QThread must not be destroyed while running."""
+        self.cancel_all()
+        for job in list(self.threads):
+            job.wait()
+
+    def is_busy(self):
+        return bool(self.jobs)
+
+    def job_finished(self, key, job, surface, callback):
+        # a newer rebuild may have been requested after this job emitted its surface
+        if self.jobs.get(key) is job:
+            del self.jobs[key]
+            callback(surface)
+
+    def job_stopped(self, job):
+        self.threads.remove(job)
@@ -0,0 +1,72 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+
+class TaubinSmoother(VTKPythonAlgorithmBase):
+    """
+    Taubin lambda/mu smoothing of a triangle mesh, vectorized with NumPy. Every iteration moves the points towards the
+    average of their neighbors (lambda > 0) and then slightly away from it (mu < -lambda), which removes the high
+    frequency noise of the extracted surfaces without the shrinking of plain Laplacian smoothing.
+    (G. Taubin, "A signal processing approach to fair surface design", SIGGRAPH 1995)
+    Used like the VTK smoothers: SetInputConnection, SetNumberOfIterations, Update.
+    """
+
+    def __init__(self):
+        VTKPythonAlgorithmBase.__init__(self, nInputPorts=1, inputType='vtkPolyData',
+                                        nOutputPorts=1, outputType='vtkPolyData')
+        self.iterations = 20
+        self.pass_band = 0.1
+
+    def SetNumberOfIterations(self, iterations):
+        if iterations != self.iterations:
+            self.iterations = iterations
+            self.Modified()
+
+    def GetNumberOfIterations(self):
+        return self.iterations
+
+    def GetOutput(self):
+        return self.GetOutputDataObject(0)
+
+    def SetPassBand(self, pass_band):
+        """ The frequency k_PB = 1/lambda + 1/mu below which the shape is kept, 0.1 is Taubin's usual choice."""
+        if pass_band != self.pass_band:
+            self.pass_band = pass_band
+            self.Modified()
+
+    def RequestData(self, request, in_info, out_info):
+        surface = vtk.vtkPolyData.GetData(in_info[0])
+        output = vtk.vtkPolyData.GetData(out_info)
+        output.ShallowCopy(surface)
+        if not surface.GetNumberOfPoints() or not surface.GetNumberOfPolys():
+            return 1
+
+        points = numpy_support.vtk_to_numpy(surface.GetPoints().GetData()).astype(np.float64)
+        # polygons are triangles here
+        polys = surface.GetPolys()
+        if hasattr(polys, 'GetConnectivityArray'):
+            triangles = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+        else:  # VTK 8 cell arrays are [3, a, b, c, 3, a, b, c, ...]
+            triangles = numpy_support.vtk_to_numpy(polys.GetData()).reshape(-1, 4)[:, 1:]
+        edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+        first, second = np.concatenate([edges[:, 0], edges[:, 1]]), np.concatenate([edges[:, 1], edges[:, 0]])
+        degree = np.maximum(np.bincount(first, minlength=len(points)), 1)[:, np.newaxis]
+
+        # mu from the pass band k_PB = 1 / lambda + 1 / mu, lambda = 0.5 as in Taubin's paper
+        lambda_factor = 0.5
+        mu_factor = 1.0 / (self.pass_band - 1.0 / lambda_factor)
+        for _ in range(self.iterations):
+            for factor in (lambda_factor, mu_factor):
+                neighbor_sum = np.stack([np.bincount(first, weights=points[second, axis], minlength=len(points))
+                                         for axis in range(3)], axis=1)
+                points += factor * (neighbor_sum / degree - points)
+            if self.GetAbortExecute():
+                break
+
+        smoothed = vtk.vtkPoints()
+        smoothed.SetData(numpy_support.numpy_to_vtk(points.astype(np.float32), deep=1))
+        output.SetPoints(smoothed)
+        return 1
@@ -0,0 +1,82 @@
+import gzip
+import threading
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+class TimeSeries:
+    """
+    Streams the frames of a 4D NIfTI volume (perfusion or longitudinal series) one at a time. vtkNIFTIImageReader
+    only reads the first frame, or every frame at once as scalar components. A frame is read straight from its offset
+    in the file instead, a .nii.gz is decompressed up to it and the following frames are read on from there.
+    The shown frame is the output of `output`, an image algorithm with GetOutput like the reader whose output object
+    stays the same: the slices, projection and extractors connected to it follow show without being reconnected.
+    """
+
+    def __init__(self, reader):
+        """
+        :param reader: an updated vtkNIFTIImageReader of the series, its output is the first frame
+        """
+        first = reader.GetOutput()
+        self.file_name = reader.GetFileName()
+        self.frames = reader.GetTimeDimension()
+        self.time_spacing = reader.GetTimeSpacing()
+        self.frame = 0  # index of the shown frame
+        self.extent, self.spacing, self.origin = first.GetExtent(), first.GetSpacing(), first.GetOrigin()
+        dims = first.GetDimensions()
+        self.shape = (dims[2], dims[1], dims[0])
+        self.dtype = np.dtype(numpy_support.get_vtk_to_numpy_typemap()[reader.GetDataScalarType()])
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.offset = int(reader.GetNIFTIHeader().GetVoxOffset())
+        self.swap_bytes = bool(reader.GetSwapBytes())
+        self.reverse_slices = reader.GetQFac() < 0  # the reader flips left-handed volumes along k
+        self.scalars_name = first.GetPointData().GetScalars().GetName()
+        self.file = None
+        self.lock = threading.Lock()  # frames are read on the prefetcher thread
+
+        self.source = vtk.vtkTrivialProducer()
+        self.source.SetOutput(first)
+        self.output = vtk.vtkImageChangeInformation()
+        self.output.SetInputConnection(self.source.GetOutputPort())
+        self.output.Update()
+
+    def read_frame(self, index):
+        """
+        :param index: the frame, 0 to frames - 1
+        :return: the vtkImageData of the frame, laid out like the reader output
+        """
+        voxels = np.empty(self.shape, dtype=self.dtype)
+        with self.lock:
+            if self.file is None:
+                self.file = (gzip.open if self.file_name.endswith('.gz') else open)(self.file_name, 'rb')
+            self.file.seek(self.offset + index * self.frame_bytes)  # gzip only rewinds when seeking backwards
+            read = self.file.readinto(memoryview(voxels).cast('B'))
+        if read != self.frame_bytes:
+            raise ValueError("{} ends before frame {}".format(self.file_name, index))
+        if self.swap_bytes:
+            voxels.byteswap(inplace=True)
+        if self.reverse_slices:
+            voxels = np.ascontiguousarray(voxels[::-1])
+
+        image = vtk.vtkImageData()
+        image.SetExtent(self.extent)
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(self.origin)
+        scalars = numpy_support.numpy_to_vtk(voxels.ravel(), deep=0)  # keeps a reference to the voxels
+        scalars.SetName(self.scalars_name)
+        image.GetPointData().SetScalars(scalars)
+        return image
+
+    def show(self, index, image):
+        """ Makes a frame (see read_frame) the output of the series."""
+        self.frame = index
+        self.source.SetOutput(image)
+        self.output.Update()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
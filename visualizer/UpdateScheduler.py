@@ -0,0 +1,69 @@
+import collections
+import time
+
+import PyQt5.QtCore as Qt
+
+
+class UpdateScheduler(Qt.QObject):
+    """
+    Coalesces bursts of parameter changes into one update. Each change schedules an update function under a key,
+    a later change with the same key replaces the pending one. Pending updates run together once no change arrived
+    for `interval` milliseconds (single shot QTimer, nothing blocks the event loop), followed by after_update.
+    A deferred update only starts background work (e.g. a SurfaceRebuilder job), its time runs until finish is called
+    with its key once the result is shown.
+    """
+    updated = Qt.pyqtSignal(list, float)  # keys applied, seconds taken
+
+    def __init__(self, interval, after_update=None, history=100):
+        Qt.QObject.__init__(self)
+        self.after_update = after_update
+        self.pending = collections.OrderedDict()
+        self.deferred = set()  # keys of the pending updates that finish later
+        self.started = {}  # key -> perf_counter time a deferred update was applied at, until it finishes
+        self.timings = collections.deque(maxlen=history)  # (keys, seconds) of the last applied updates
+        self.timer = Qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.apply)
+
+    def set_interval(self, interval):
+        self.timer.setInterval(interval)
+
+    def schedule(self, key, update, deferred=False):
+        """
+        :param key: identifies what is updated, e.g. 'brain_surface'
+        :param update: function without arguments applying the change
+        :param deferred: the change shows up later, finish(key) is called then
+        """
+        self.pending[key] = update
+        if deferred:
+            self.deferred.add(key)
+        self.timer.start()  # restarts the debounce interval
+
+    def apply(self):
+        self.timer.stop()
+        pending, self.pending = self.pending, collections.OrderedDict()
+        deferred, self.deferred = self.deferred, set()
+        if not pending:
+            return
+        start = time.perf_counter()
+        for key in deferred:
+            self.started[key] = start  # before the update, it may finish right away
+        for update in pending.values():
+            update()
+        if self.after_update:
+            self.after_update()
+        seconds = time.perf_counter() - start
+        keys = [key for key in pending if key not in deferred]
+        if keys:
+            self.record(keys, seconds)
+
+    def finish(self, key):
+        """ The result of a deferred update is shown, records the time since it was applied."""
+        start = self.started.pop(key, None)
+        if start is not None:
+            self.record([key], time.perf_counter() - start)
+
+    def record(self, keys, seconds):
+        self.timings.append((keys, seconds))
+        self.updated.emit(keys, seconds)
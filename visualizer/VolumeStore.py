@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+class VolumeStore:
+    """
+    Decompresses each NIfTI volume once into an uncompressed cache file and memory-maps it on later opens.
+    The voxels start at offset 0 of their own .raw file (page aligned) and are wrapped zero-copy as the scalars of
+    a vtkImageData, so reopening a study only maps pages and processes opening the same volume share them.
+    The geometry is kept next to it in a .json file, which is written last and marks the entry as complete.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(file_name):
+        """ Identifies a volume by path, size and modification time, hashing the content would inflate it again."""
+        stat = os.stat(file_name)
+        description = '{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def paths(self, key):
+        return os.path.join(self.directory, key + '.raw'), os.path.join(self.directory, key + '.json')
+
+    def open(self, file_name, read_nifti):
+        """
+        :param file_name: the NIfTI file (.nii or .nii.gz)
+        :param read_nifti: function reading the file with a vtkNIFTIImageReader, used the first time only
+        :return: an updated vtkImageAlgorithm whose output is the memory mapped vtkImageData
+        """
+        key = self.key(file_name)
+        raw_path, header_path = self.paths(key)
+        if not os.path.exists(header_path):
+            self.store(read_nifti(file_name).GetOutput(), raw_path, header_path)
+            self.evict(keep=key)
+
+        with open(header_path) as f:
+            header = json.load(f)
+        os.utime(header_path)  # last access time for LRU eviction
+
+        voxels = np.memmap(raw_path, dtype=np.dtype(header['dtype']), mode='r')
+        if header['components'] > 1:
+            voxels = voxels.reshape(-1, header['components'])
+        image = vtk.vtkImageData()
+        image.SetExtent(header['extent'])
+        image.SetSpacing(header['spacing'])
+        image.SetOrigin(header['origin'])
+        scalars = numpy_support.numpy_to_vtk(voxels, deep=0)  # keeps a reference to the memmap
+        scalars.SetName(header['name'])
+        image.GetPointData().SetScalars(scalars)
+
+        source = vtk.vtkTrivialProducer()
+        source.SetOutput(image)
+        # an image algorithm with GetOutput like the reader, passes the scalars
+        output = vtk.vtkImageChangeInformation()
+        output.SetInputConnection(source.GetOutputPort())
+        output.Update()
+        return output
+
+    @staticmethod
+    def store(image, raw_path, header_path):
+        scalars = image.GetPointData().GetScalars()
+        voxels = numpy_support.vtk_to_numpy(scalars)
+        # unique per thread too, the case browser may store a volume shared by two cases from two readers at once
+        partial_path = '{}.{}.{}.partial'.format(raw_path, os.getpid(), threading.get_ident())
+        voxels.tofile(partial_path)
+        os.replace(partial_path, raw_path)
+
+        header = {
+            'extent': list(image.GetExtent()),
+            'spacing': list(image.GetSpacing()),
+            'origin': list(image.GetOrigin()),
+            'dtype': voxels.dtype.str,
+            'components': scalars.GetNumberOfComponents(),
+            'name': scalars.GetName() or 'scalars',
+        }
+        partial_path = '{}.{}.{}.partial'.format(header_path, os.getpid(), threading.get_ident())
+        with open(partial_path, 'w') as f:
+            json.dump(header, f)
+        os.replace(partial_path, header_path)
+
+    def entries(self):
+        """ (last access, size, key) of the stored volumes, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                key = name[:-len('.json')]
+                raw_path, header_path = self.paths(key)
+                try:
+                    entries.append((os.stat(header_path).st_mtime, os.stat(raw_path).st_size, key))
+                except FileNotFoundError:
+                    continue
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total_size -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+
+    def remove(self, key):
+        for path in reversed(self.paths(key)):  # header first, the entry is incomplete without it
+            try:
+                os.remove(path)
+            except OSError:  # already removed, or still mapped on Windows
+                pass
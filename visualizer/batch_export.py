@@ -0,0 +1,160 @@
+import concurrent.futures
+import csv
+import glob
+import json
+import os
+import time
+
+import vtkUtils
+from vtkUtils import *
+
+MESH_WRITERS = {
+    'stl': vtk.vtkSTLWriter,
+    'ply': vtk.vtkPLYWriter,
+    'vtp': vtk.vtkXMLPolyDataWriter,
+}
+
+
+def find_subjects(subjects_dir, mask_name):
+    """
+    A subject is a directory holding the segmentation mask (mask_name) next to its modalities, like
+    sample_data/10labels_example. subjects_dir may be a single subject or a directory of subjects.
+    :return: the subject directories, sorted
+    """
+    if os.path.exists(os.path.join(subjects_dir, mask_name)):
+        return [subjects_dir]
+    return sorted(os.path.dirname(mask) for mask in glob.glob(os.path.join(subjects_dir, '*', mask_name)))
+
+
+def find_modalities(subject_dir, mask_name):
+    return sorted(file for file in glob.glob(os.path.join(subject_dir, '*.nii*'))
+                  if os.path.basename(file) != mask_name)
+
+
+def read_cases(source, mask_name='mask.nii.gz'):
+    """
+    The case list of the case browser, either the subjects of a directory (see find_subjects) or the rows of a CSV
+    file with a 'brain' column (co-registered modalities separated by ';'), a 'mask' column and an optional 'name'
+    column. Relative paths in the CSV file are relative to its directory.
+    :return: a list of (name, brain files, mask file), subjects without any modality are left out
+    """
+    if os.path.isdir(source):
+        cases = [(os.path.basename(os.path.normpath(subject_dir)), find_modalities(subject_dir, mask_name),
+                  os.path.join(subject_dir, mask_name)) for subject_dir in find_subjects(source, mask_name)]
+        return [case for case in cases if case[1]]
+    base_dir = os.path.dirname(os.path.abspath(source))
+    cases = []
+    with open(source, newline='') as f:
+        for row in csv.DictReader(f):
+            brain_files = [os.path.join(base_dir, file.strip()) for file in row['brain'].split(';') if file.strip()]
+            mask_file = os.path.join(base_dir, row['mask'].strip())
+            name = (row.get('name') or '').strip() or os.path.basename(os.path.dirname(mask_file))
+            if brain_files:
+                cases.append((name, brain_files, mask_file))
+    return cases
+
+
+def write_mesh(surface, file_name, mesh_format):
+    writer = MESH_WRITERS[mesh_format]()
+    writer.SetFileName(file_name)
+    writer.SetInputData(surface)
+    if mesh_format == 'stl':
+        writer.SetFileTypeToBinary()
+    writer.Write()
+
+
+def export_surface(surface, output_dir, subject_name, mesh_name, mesh_format):
+    """
+    :return: the manifest entry of the written mesh
+    """
+    relative_name = os.path.join(subject_name, '{}.{}'.format(mesh_name, mesh_format))
+    write_mesh(surface, os.path.join(output_dir, relative_name), mesh_format)
+    return {
+        'file': relative_name,
+        'points': surface.GetNumberOfPoints(),
+        'cells': surface.GetNumberOfCells(),
+    }
+
+
+def export_subject(subject_dir, output_dir, mask_name, mesh_format, skip_brain, statistics=False):
+    """
+    Runs the load_case extraction for one subject and writes one mesh per surface, and with statistics the
+    label_statistics.csv of its mask (see collect_label_statistics). The mask shares the triangle budget with the
+    first modality, every modality with the mask, as the viewer shows them.
+    Executed in a worker process, errors are reported in the manifest entry instead of raised.
+    :return: the manifest entry of the subject
+    """
+    subject_name = os.path.basename(os.path.normpath(subject_dir))
+    entry = {'subject': subject_name, 'meshes': []}
+    start = time.time()
+    try:
+        os.makedirs(os.path.join(output_dir, subject_name), exist_ok=True)
+
+        mask = open_mask(os.path.join(subject_dir, mask_name), pyramid=False)
+        modality_files = [] if skip_brain else find_modalities(subject_dir, mask_name)
+        brain = open_brain(modality_files[0], pyramid=False) if modality_files else None
+        share_triangle_budget([brain, mask] if brain else [mask], vtkUtils.triangle_budget)
+        extract_surfaces(mask)
+        for label in mask.labels:
+            surface = get_label_surface(label)
+            if surface:
+                mesh = export_surface(surface, output_dir, subject_name, 'label_{}'.format(label.value), mesh_format)
+                mesh.update(source=mask_name, label=label.value)
+                entry['meshes'].append(mesh)
+        if statistics:
+            entry['statistics'] = os.path.join(subject_name, 'label_statistics.csv')
+            write_label_statistics(os.path.join(output_dir, entry['statistics']), collect_label_statistics(mask))
+
+        for i, modality_file in enumerate(modality_files):
+            if i:  # the modalities are read one at a time, the mask keeps the shares it was extracted with
+                brain = open_brain(modality_file, pyramid=False)
+                share_triangle_budget([brain], get_budget_left(mask, vtkUtils.triangle_budget))
+            extract_surfaces(brain)
+            modality = get_modality_name(modality_file)
+            surface = get_label_surface(brain.labels[0])
+            if surface:
+                mesh = export_surface(surface, output_dir, subject_name, modality + '_brain', mesh_format)
+                mesh.update(source=os.path.basename(modality_file), threshold=brain.labels[0].value)
+                entry['meshes'].append(mesh)
+    except Exception as e:
+        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+    entry['seconds'] = round(time.time() - start, 3)
+    return entry
+
+
+def init_worker(cache_dir, cache_size, triangle_budget):
+    vtkUtils.mesh_cache = MeshCache(cache_dir, cache_size) if cache_dir else None
+    vtkUtils.triangle_budget = triangle_budget
+
+
+def export_subjects(subjects_dir, output_dir, mask_name='mask.nii.gz', mesh_format='stl', workers=None,
+                    skip_brain=False, cache_dir=None, cache_size=MESH_CACHE_SIZE, triangle_budget=TRIANGLE_BUDGET,
+                    statistics=False):
+    """
+    Headless batch export: extracts every subject in parallel on a process pool and writes the meshes
+    together with a manifest.json describing them to output_dir.
+    :param workers: number of worker processes, defaults to the number of CPU cores
+    :param cache_dir: the mesh cache directory shared by the workers, None disables the cache
+    :param triangle_budget: the triangles of each subject, shared by the mask and a modality, None for
+                            TARGET_REDUCTION
+    :param statistics: also write the label statistics of every subject as CSV
+    :return: the manifest
+    """
+    subjects = find_subjects(subjects_dir, mask_name)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {'format': mesh_format, 'subjects': []}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                initargs=(cache_dir, cache_size, triangle_budget)) as pool:
+        futures = [pool.submit(export_subject, subject_dir, output_dir, mask_name, mesh_format, skip_brain, statistics)
+                   for subject_dir in subjects]
+        for future in concurrent.futures.as_completed(futures):
+            entry = future.result()
+            manifest['subjects'].append(entry)
+            print('{} {} ({} meshes, {:.1f}s)'.format('FAILED' if 'error' in entry else 'done', entry['subject'],
+                                                      len(entry['meshes']), entry['seconds']))
+
+    manifest['subjects'].sort(key=lambda entry: entry['subject'])
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
@@ -0,0 +1,150 @@
+import concurrent.futures
+import json
+import os
+import time
+
+import numpy as np
+
+from batch_export import *
+
+
+def init_render_worker(cache_dir, cache_size, triangle_budget):
+    """
+    Mesa renders in software (llvmpipe) with this set, no GPU is needed. Without a display VTK 9 creates EGL render
+    windows, VTK 8 needs to be built with OSMesa for offscreen rendering.
+    """
+    os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    init_worker(cache_dir, cache_size, triangle_budget)
+
+
+def create_offscreen_window(width, height):
+    """
+    :return: (renderer, render window) rendering into an offscreen buffer
+    """
+    renderer = vtk.vtkRenderer()
+    # multisampling multiplies the fragment work of software rendering (4x slower at the default 8 samples),
+    # FXAA smooths the edges in a single cheap pass instead
+    renderer.UseFXAAOn()
+    render_window = vtk.vtkRenderWindow()
+    render_window.SetMultiSamples(0)
+    render_window.SetOffScreenRendering(1)
+    render_window.SetSize(width, height)
+    render_window.AddRenderer(renderer)
+    return renderer, render_window
+
+
+def write_png(render_window, file_name):
+    window_image = vtk.vtkWindowToImageFilter()
+    window_image.SetInput(render_window)
+    window_image.ReadFrontBufferOff()  # the offscreen frame is in the back buffer
+    writer = vtk.vtkPNGWriter()
+    writer.SetFileName(file_name)
+    writer.SetInputConnection(window_image.GetOutputPort())
+    writer.Write()
+
+
+def render_frame(render_window, output_dir, subject_name, frame_name):
+    """
+    Renders the scene and writes it as PNG.
+    :return: the manifest entry of the frame, its seconds are the render time only (PNG encoding excluded)
+    """
+    start = time.perf_counter()
+    render_window.Render()
+    seconds = time.perf_counter() - start
+    relative_name = os.path.join(subject_name, frame_name + '.png')
+    write_png(render_window, os.path.join(output_dir, relative_name))
+    return {'file': relative_name, 'seconds': round(seconds, 4)}
+
+
+def select_brain_file(subject_dir, mask_name, modality):
+    """
+    :param modality: the modality name (see get_modality_name), None for the first one
+    :return: the brain file of the subject to render
+    """
+    modalities = find_modalities(subject_dir, mask_name)
+    if modality:
+        modalities = [file for file in modalities if get_modality_name(file) == modality]
+    if not modalities:
+        raise ValueError("no {} modality in {}".format(modality or 'brain', subject_dir))
+    return modalities[0]
+
+
+def render_subject(subject_dir, output_dir, mask_name, modality, views, turntable_frames, turntable_view, size):
+    """
+    Renders the surfaces of one subject offscreen, as setup_case shows them in the viewer: one snapshot
+    per camera view (<view>.png) and a turntable image sequence (turntable_000.png, ...) circling the head from
+    turntable_view in turntable_frames steps.
+    Executed in a worker process, errors are reported in the manifest entry instead of raised.
+    :return: the manifest entry of the subject, with the render time of every frame
+    """
+    subject_name = os.path.basename(os.path.normpath(subject_dir))
+    entry = {'subject': subject_name, 'frames': []}
+    start = time.time()
+    try:
+        os.makedirs(os.path.join(output_dir, subject_name), exist_ok=True)
+        brain_file = select_brain_file(subject_dir, mask_name, modality)
+        entry['source'] = os.path.basename(brain_file)
+        renderer, render_window = create_offscreen_window(*size)
+        setup_case(renderer, brain_file, os.path.join(subject_dir, mask_name))
+
+        for view in views:
+            set_camera_view(renderer, view)
+            entry['frames'].append(render_frame(render_window, output_dir, subject_name, view))
+        if turntable_frames:
+            set_camera_view(renderer, turntable_view)
+            camera = renderer.GetActiveCamera()
+            camera.OrthogonalizeViewUp()  # the turntable axis
+            for i in range(turntable_frames):
+                entry['frames'].append(render_frame(render_window, output_dir, subject_name,
+                                                    'turntable_{:03d}'.format(i)))
+                camera.Azimuth(360.0 / turntable_frames)
+        render_window.Finalize()
+    except Exception as e:
+        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+    entry['seconds'] = round(time.time() - start, 3)
+    return entry
+
+
+def summarize_frame_times(entry):
+    """ Mean and maximum render time of the frames of a subject, the first frame includes the OpenGL setup."""
+    seconds = [frame['seconds'] for frame in entry['frames']]
+    return {'mean': float(np.mean(seconds)), 'max': max(seconds)} if seconds else None
+
+
+def render_subjects(subjects_dir, output_dir, mask_name='mask.nii.gz', modality=None, views=tuple(CAMERA_VIEWS),
+                    turntable_frames=TURNTABLE_FRAMES, turntable_view='sagittal', size=SNAPSHOT_SIZE, workers=None,
+                    cache_dir=None, cache_size=MESH_CACHE_SIZE, triangle_budget=TRIANGLE_BUDGET):
+    """
+    Headless batch rendering: renders every subject (see find_subjects) in parallel on a process pool and writes
+    the frames together with a manifest.json listing them and their render times to output_dir.
+    :param modality: the modality shown with the mask, None for the first modality of each subject
+    :param views: the CAMERA_VIEWS snapshots
+    :param turntable_frames: frames of the 360 degree turntable, 0 for none
+    :param size: (width, height) of the frames in pixels
+    :param workers: number of worker processes, defaults to the number of CPU cores
+    :param cache_dir: the mesh cache directory shared by the workers, None disables the cache
+    :param triangle_budget: the triangles of each subject (brain and mask), None for TARGET_REDUCTION
+    :return: the manifest
+    """
+    subjects = find_subjects(subjects_dir, mask_name)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {'size': list(size), 'views': list(views), 'turntable_frames': turntable_frames, 'subjects': []}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker,
+                                                initargs=(cache_dir, cache_size, triangle_budget)) as pool:
+        futures = [pool.submit(render_subject, subject_dir, output_dir, mask_name, modality, views, turntable_frames,
+                               turntable_view, size) for subject_dir in subjects]
+        for future in concurrent.futures.as_completed(futures):
+            entry = future.result()
+            entry['frame_seconds'] = summarize_frame_times(entry)
+            manifest['subjects'].append(entry)
+            frame_times = ', {:.0f} ms per frame (max {:.0f} ms)'.format(
+                entry['frame_seconds']['mean'] * 1000, entry['frame_seconds']['max'] * 1000) \
+                if entry['frame_seconds'] else ''
+            print('{} {} ({} frames{}, {:.1f}s)'.format('FAILED' if 'error' in entry else 'done', entry['subject'],
+                                                       len(entry['frames']), frame_times, entry['seconds']))
+
+    manifest['subjects'].sort(key=lambda entry: entry['subject'])
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
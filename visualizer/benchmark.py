@@ -0,0 +1,231 @@
+"""
+Headless benchmark of the loading and extraction pipeline over sample_data.
+
+    python visualizer/benchmark.py --save                 # record benchmarks/baseline.json
+    python visualizer/benchmark.py --tolerance 20         # fail if anything regressed by more than 20%
+    python visualizer/benchmark.py --smoothing            # compare the smoothing methods instead
+    python visualizer/benchmark.py --triangle-budget 200000 --output budget.json   # a triangle budget run
+
+Each case runs in a fresh process so its peak RSS is not polluted by the previous cases.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+from vtk.util import numpy_support
+
+import vtkUtils
+from vtkUtils import *
+from PipelineProfiler import *
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SAMPLE_DATA = os.path.join(ROOT, 'sample_data')
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+CASES = {
+    'flair': ('flair.nii.gz', 'truth.nii.gz'),
+    '10labels': ('10labels_example/T1CE.nii.gz', '10labels_example/mask.nii.gz'),
+    'zScored': ('zScoredExample/Brats17_CBICA_ARF_1_t1ce.nii.gz',
+                'zScoredExample/Brats17_CBICA_ARF_1_seg_4c.nii.gz'),
+}
+
+
+def peak_rss_kib():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS, KiB elsewhere
+
+
+def setup_surfaces(renderer, nii_object):
+    extract_surfaces(nii_object)
+    for label in nii_object.labels:
+        renderer.AddActor(label.actor)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run_case(brain_file, mask_file, triangle_budget=None):
+    """
+    Times the opening (read_volume and label discovery, see open_brain and open_mask) and the surface extraction of
+    the brain and the mask, and every profiled pipeline stage of one case. Both volumes are opened before either is
+    extracted, so they share one triangle budget like in the viewer (setup_brain and setup_mask each spend all of it).
+    :param triangle_budget: the triangles of the case (see share_triangle_budget), None for TARGET_REDUCTION
+    :return: dict with the 'seconds', 'peak_rss_kib' and 'triangles' of the case
+    """
+    vtkUtils.mesh_cache = None
+    vtkUtils.profiler = PipelineProfiler()
+    vtkUtils.triangle_budget = triangle_budget
+    renderer = vtk.vtkRenderer()
+    seconds = {}
+
+    brain, seconds['open_brain'] = timed(open_brain, brain_file, False)
+    mask, seconds['open_mask'] = timed(open_mask, mask_file, False)
+    share_triangle_budget([brain, mask], triangle_budget)
+    _, seconds['extract_brain'] = timed(setup_surfaces, renderer, brain)
+    _, seconds['extract_mask'] = timed(setup_surfaces, renderer, mask)
+    for stage, (_, stage_seconds) in vtkUtils.profiler.summary().items():
+        seconds['stage.' + stage] = stage_seconds
+
+    triangles = {'brain': get_label_surface(brain.labels[0]).GetNumberOfCells()}
+    for label in mask.labels:
+        surface = get_label_surface(label)
+        triangles['label_{:g}'.format(label.value)] = surface.GetNumberOfCells() if surface else 0
+
+    return {'seconds': seconds, 'peak_rss_kib': peak_rss_kib(), 'triangles': triangles}
+
+
+def run_cases(case_names, triangle_budget=None):
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in case_names:
+        brain_file, mask_file = (os.path.join(SAMPLE_DATA, file) for file in CASES[name])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = pool.submit(run_case, brain_file, mask_file, triangle_budget).result()
+        seconds = results[name]['seconds']
+        print('{:<10} open {:.2f}s  extract_brain {:.2f}s  extract_mask {:.2f}s  peak {} KiB'.format(
+            name, seconds['open_brain'] + seconds['open_mask'], seconds['extract_brain'], seconds['extract_mask'],
+            results[name]['peak_rss_kib']))
+    return results
+
+
+def mean_distance(surface, reference):
+    """ Mean absolute distance from the points of surface to the reference surface."""
+    distance = vtk.vtkDistancePolyDataFilter()
+    distance.SetInputData(0, surface)
+    distance.SetInputData(1, reference)
+    distance.ComputeSecondDistanceOff()
+    distance.Update()
+    distances = numpy_support.vtk_to_numpy(distance.GetOutput().GetPointData().GetArray('Distance'))
+    return float(np.abs(distances).mean())
+
+
+def compare_smoothing(brain_file, mask_file, smoothness):
+    """
+    Smooths the decimated brain and label surfaces of a case with every SMOOTHING_METHODS entry at the same
+    smoothness. Volume and area are relative to the unsmoothed surface (a volume below 1 is shrinkage, a lower area
+    means a smoother surface), the deviation is the mean distance to the Laplacian result.
+    :return: dict surface -> method -> {'seconds', 'iterations', 'volume', 'area', 'deviation'}
+    """
+    vtkUtils.mesh_cache = None
+    reduced = {}
+    brain = open_brain(brain_file)
+    reduced['brain'] = create_polygon_reducer(brain.labels[0].extractor)
+    mask = open_mask(mask_file)
+    for label in mask.labels:
+        reduced['label_{:g}'.format(label.value)] = create_polygon_reducer(label.extractor)
+
+    results = {}
+    for name, reducer in reduced.items():
+        reducer.Update()
+        volume, area = measure_surface(reducer.GetOutput())
+        results[name] = {}
+        for smoothing in SMOOTHING_METHODS:
+            smoother = create_smoother(create_source(reducer.GetOutput()), smoothness, smoothing)
+            _, seconds = timed(smoother.Update)
+            surface = smoother.GetOutputDataObject(0)
+            smoothed_volume, smoothed_area = measure_surface(surface)
+            results[name][smoothing] = {
+                'seconds': seconds,
+                'iterations': smoother.GetNumberOfIterations(),
+                'volume': smoothed_volume / volume,
+                'area': smoothed_area / area,
+                'deviation': mean_distance(surface, results[name]['laplacian']['surface'])
+                if smoothing != 'laplacian' else 0.0,
+                'surface': surface,
+            }
+        for smoothing_result in results[name].values():
+            del smoothing_result['surface']
+    return results
+
+
+def print_smoothing(case_name, results):
+    for name, methods in results.items():
+        for smoothing, result in methods.items():
+            print('{:<10} {:<10} {:<14} {:>4} it {:>7.3f}s  volume {:.3f}  area {:.3f}  deviation {:.3f}'.format(
+                case_name, name, smoothing, result['iterations'], result['seconds'], result['volume'],
+                result['area'], result['deviation']))
+
+
+def compare_results(baseline, results, tolerance, min_seconds=0.25):
+    """
+    :param tolerance: allowed regression in percent
+    :param min_seconds: timings below this in both runs are too noisy to compare
+    :return: a list of regression messages, empty when nothing regressed
+    """
+    regressions = []
+    limit = 1.0 + tolerance / 100.0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        for metric, value in result['seconds'].items():
+            base = expected['seconds'].get(metric)
+            if base is not None and max(base, value) >= min_seconds and value > base * limit:
+                regressions.append('{}: {} took {:.2f}s, baseline {:.2f}s'.format(name, metric, value, base))
+        base_rss = expected.get('peak_rss_kib')
+        if base_rss and result['peak_rss_kib'] and result['peak_rss_kib'] > base_rss * limit:
+            regressions.append('{}: peak RSS {} KiB, baseline {} KiB'.format(name, result['peak_rss_kib'], base_rss))
+        for surface, count in result['triangles'].items():
+            base = expected['triangles'].get(surface)
+            if base is not None and abs(count - base) > base * tolerance / 100.0:
+                regressions.append('{}: {} has {} triangles, baseline {}'.format(name, surface, count, base))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the extraction pipeline over sample_data.')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=sorted(CASES), help='cases to run')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='the JSON baseline to compare with')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='allowed regression in percent')
+    parser.add_argument('--min-seconds', type=float, default=0.25, help='ignore timings shorter than this')
+    parser.add_argument('--output', help='also write the results of this run to a JSON file')
+    parser.add_argument('--smoothing', action='store_true', help='compare the time, shrinkage and deviation of the '
+                                                                 'smoothing methods instead')
+    parser.add_argument('--triangle-budget', type=int, help='reduce the surfaces to a triangle budget')
+    parser.add_argument('--smoothness', type=int, default=MASK_SMOOTHNESS, help='the smoothness compared')
+    args = parser.parse_args()
+
+    if args.smoothing:
+        comparison = {}
+        for name in args.cases:
+            brain_file, mask_file = (os.path.join(SAMPLE_DATA, file) for file in CASES[name])
+            comparison[name] = compare_smoothing(brain_file, mask_file, args.smoothness)
+            print_smoothing(name, comparison[name])
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(comparison, f, indent=2)
+        sys.exit(0)
+
+    results = run_cases(args.cases, args.triangle_budget)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('baseline saved to {}'.format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print('no baseline at {}, run with --save first'.format(args.baseline))
+        sys.exit(0)
+    with open(args.baseline) as f:
+        regressions = compare_results(json.load(f), results, args.tolerance, args.min_seconds)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    sys.exit(1 if regressions else 0)
@@ -2,7 +2,14 @@ import argparse
 import sys
 import os
 
-from MainWindow import *
+import vtk
+import vtkUtils
+from config import *
+from MeshCache import *
+from VolumeStore import *
+from batch_export import *
+from batch_render import *
+from PipelineProfiler import *
 
 
 def redirect_vtk_messages():
@@ -18,17 +25,100 @@ def redirect_vtk_messages():
 
 def verify_type(file):
     ext = os.path.basename(file).split(os.extsep, 1)
-    if ext[1] != 'nii.gz':
-        parser.error("File doesn't end with 'nii.gz'. Found: {}".format(ext[1]))
+    if len(ext) < 2 or ext[1] not in ('nii.gz', 'nii'):
+        parser.error("File doesn't end with 'nii.gz' or 'nii'. Found: {}".format(ext[-1]))
     return file
 
 
+def export(args, mesh_cache):
+    """ Headless batch export of the surfaces of a directory of subjects, see batch_export.py"""
+    manifest = export_subjects(args.subjects, args.output, mask_name=args.mask_name, mesh_format=args.format,
+                               workers=args.workers, skip_brain=args.skip_brain,
+                               cache_dir=mesh_cache.directory if mesh_cache else None,
+                               triangle_budget=args.triangle_budget, statistics=args.statistics)
+    failed = [entry['subject'] for entry in manifest['subjects'] if 'error' in entry]
+    return 1 if failed else 0
+
+
+def render(args, mesh_cache):
+    """ Headless offscreen snapshots and turntables of a directory of subjects, see batch_render.py"""
+    manifest = render_subjects(args.subjects, args.output, mask_name=args.mask_name, modality=args.modality,
+                               views=args.views, turntable_frames=args.turntable, size=args.size,
+                               workers=args.workers, cache_dir=mesh_cache.directory if mesh_cache else None,
+                               triangle_budget=args.triangle_budget)
+    failed = [entry['subject'] for entry in manifest['subjects'] if 'error' in entry]
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Reads Nii.gz Files and renders them in 3D.')
-    parser.add_argument('-i', type=lambda fn: verify_type(fn), help='an mri scan (nii.gz)')
-    parser.add_argument('-m', type=lambda fn: verify_type(fn), help='the segmentation mask (nii.gz)')
+    parser.add_argument('-i', type=lambda fn: verify_type(fn), nargs='+',
+                        help='an mri scan (nii.gz or nii), or several co-registered modalities of the case')
+    parser.add_argument('-m', type=lambda fn: verify_type(fn), help='the segmentation mask (nii.gz or nii)')
+    parser.add_argument('--study', metavar='DIR', help='load every modality of a subject directory (like '
+                                                       'sample_data/10labels_example), the mask defaults to '
+                                                       'DIR/mask.nii.gz')
+    parser.add_argument('--cases', metavar='DIR_OR_CSV',
+                        help='browse the cases of a directory of subjects, or of a CSV file with brain (modalities '
+                             'separated by ;), mask and optional name columns')
+    parser.add_argument('--prefetch-previous', action='store_true', default=CASE_PREFETCH_PREVIOUS,
+                        help='also keep the previous case ready, not only the next one')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always decompress the volumes and recompute the surfaces')
+    parser.add_argument('--clear-cache', action='store_true', help='delete every cached surface and volume')
+    parser.add_argument('--triangle-budget', type=int, default=TRIANGLE_BUDGET, metavar='TRIANGLES',
+                        help='reduce the surfaces to this many triangles in total instead of by a fixed fraction')
+    parser.add_argument('--profile', metavar='REPORT', help='write per stage pipeline timings to REPORT (.json/.csv)')
+    parser.add_argument('--profile-overlay', action='store_true', help='show the pipeline timings in the view')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='write the surfaces of many subjects to mesh files (headless)')
+    export_parser.add_argument('subjects', help='a subject directory (modalities and mask) or a directory of them')
+    export_parser.add_argument('-o', '--output', required=True, help='the output directory')
+    export_parser.add_argument('--format', choices=['stl', 'ply', 'vtp'], default='stl', help='the mesh file format')
+    export_parser.add_argument('--workers', type=int, help='number of worker processes (default: all cores)')
+    export_parser.add_argument('--mask-name', default='mask.nii.gz', help='the mask file name of each subject')
+    export_parser.add_argument('--skip-brain', action='store_true', help='only export the mask labels')
+    export_parser.add_argument('--statistics', action='store_true',
+                               help='also write the volume, area, centroid and bounding box of every label as CSV')
+    render_parser = commands.add_parser('render', help='render snapshots and turntables of many subjects to PNG '
+                                                       '(headless, software OpenGL)')
+    render_parser.add_argument('subjects', help='a subject directory (modalities and mask) or a directory of them')
+    render_parser.add_argument('-o', '--output', required=True, help='the output directory')
+    render_parser.add_argument('--modality', help='the modality shown with the mask (default: the first one)')
+    render_parser.add_argument('--views', nargs='*', choices=sorted(CAMERA_VIEWS), default=sorted(CAMERA_VIEWS),
+                               help='the camera views to snapshot')
+    render_parser.add_argument('--turntable', type=int, default=TURNTABLE_FRAMES, metavar='FRAMES',
+                               help='frames of the 360 degree turntable, 0 for none')
+    render_parser.add_argument('--size', type=int, nargs=2, default=SNAPSHOT_SIZE, metavar=('WIDTH', 'HEIGHT'),
+                               help='frame size in pixels')
+    render_parser.add_argument('--workers', type=int, help='number of worker processes (default: all cores)')
+    render_parser.add_argument('--mask-name', default='mask.nii.gz', help='the mask file name of each subject')
     args = parser.parse_args()
 
+    mesh_cache = MeshCache(MESH_CACHE_DIR, MESH_CACHE_SIZE)
+    if args.clear_cache:
+        mesh_cache.clear()
+        VolumeStore(VOLUME_CACHE_DIR, VOLUME_CACHE_SIZE).clear()
+        if not args.i and not args.study and not args.cases and not args.command:
+            sys.exit(0)
+    if args.no_cache:
+        mesh_cache = None
+    vtkUtils.mesh_cache = mesh_cache
+    vtkUtils.triangle_budget = args.triangle_budget
+
+    if args.command == 'export':
+        sys.exit(export(args, mesh_cache))
+    if args.command == 'render':
+        sys.exit(render(args, mesh_cache))
+
+    if not args.no_cache:
+        vtkUtils.volume_store = VolumeStore(VOLUME_CACHE_DIR, VOLUME_CACHE_SIZE)
+
+    if args.profile or args.profile_overlay:
+        vtkUtils.profiler = PipelineProfiler()
+
+    from MainWindow import *
+
     redirect_vtk_messages()
     app = QtWidgets.QApplication(sys.argv)
 
@@ -36,7 +126,19 @@ if __name__ == "__main__":
     #     read_css = css.read()
     #     app.setStyleSheet(read_css)
 
-    app.BRAIN_FILE = args.i
-    app.MASK_FILE = args.m
+    if args.study:
+        args.m = args.m or os.path.join(args.study, 'mask.nii.gz')
+        args.i = find_modalities(args.study, os.path.basename(args.m))
+    if args.cases:
+        app.CASES = read_cases(args.cases)
+        if not app.CASES:
+            parser.error("No cases found in {}".format(args.cases))
+    else:
+        app.CASES = [(os.path.basename(os.path.dirname(os.path.abspath(args.m))), args.i, args.m)]
+    app.PREFETCH_PREVIOUS = args.prefetch_previous
+    app.PROFILE_OVERLAY = args.profile_overlay
     window = MainWindow(app)
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+    if args.profile:
+        vtkUtils.profiler.write(args.profile)
+    sys.exit(exit_code)
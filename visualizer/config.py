@@ -1,8 +1,15 @@
+import os
+
 # default brain settings
 APPLICATION_TITLE = "Theia – NIfTI (nii.gz) 3D Visualizer"
 BRAIN_SMOOTHNESS = 500
 BRAIN_OPACITY = 0.2
 BRAIN_COLORS = [(1.0, 0.9, 0.9)]  # RGB percentages
+BRAIN_HISTOGRAM_BINS = 1024  # bins of the intensity histogram behind the threshold picker
+BRAIN_THRESHOLD_PERCENTILE = 25.0  # percent of the foreground voxels below the suggested percentile threshold
+BRAIN_THRESHOLD_COLOR = (1.0, 0.5, 0.0)  # tint of the slice voxels above a threshold that is not applied yet
+BRAIN_SPECULATIVE_STEPS = 1  # threshold steps on each side of the applied one precomputed in the background
+BRAIN_SURFACE_MEMORY = 256 * 1024 * 1024  # bytes of brain surfaces kept in memory for instant threshold changes
 
 # default mask settings
 MASK_SMOOTHNESS = 500
@@ -16,3 +23,56 @@ MASK_COLORS = [(1, 0, 0),
                 (0.5, 1, 0.5),
                 (0.5, 0.5, 1)]  # RGB percentages
 MASK_OPACITY = 1.0
+MASK_SINGLE_PASS = True  # extract every label in one pass over the mask instead of one pass per label
+
+# default pipeline settings
+TARGET_REDUCTION = 0.5  # fraction of triangles removed by vtkDecimatePro
+# triangles of the whole scene shared by its surfaces, each is reduced from its extracted triangles to its share
+# (see BudgetReducer). None removes TARGET_REDUCTION of every surface instead.
+TRIANGLE_BUDGET = None
+QUADRIC_CLUSTERING_CELLS = 300000  # extracted triangles above which the budget is met by quadric clustering
+SURFACE_ESTIMATE_VOXELS = 256 ** 3  # voxels counted to predict the extracted triangles, larger volumes are sampled
+FEATURE_ANGLE = 60.0  # vtkPolyDataNormals feature angle
+SMOOTHING_METHODS = ['laplacian', 'windowed_sinc', 'taubin']  # see vtkUtils.create_smoother
+SMOOTHING_METHOD = 'windowed_sinc'
+# iterations run per unit of smoothness, the smoothness pickers stay in Laplacian iterations for every method
+SMOOTHING_ITERATION_SCALE = {'laplacian': 1.0, 'windowed_sinc': 0.06, 'taubin': 0.06}
+SMOOTHING_PASS_BAND = 0.01  # windowed sinc and Taubin pass band, lower is smoother
+
+# interface settings
+UPDATE_DEBOUNCE_INTERVAL = 150  # ms without further changes before the pending picker changes are applied
+PREVIEW_SHRINK_FACTOR = 2  # subsampling of the volumes for the coarse surfaces shown while loading
+
+# level of detail settings
+LOD_DIVISIONS = [96, 48]  # quadric clustering bins per axis of each interactive level, empty disables LOD
+LOD_DESIRED_UPDATE_RATE = 15.0  # frames per second aimed for while interacting
+LOD_CELL_RENDER_TIME = 4e-7  # seconds per triangle with software OpenGL, picks the level fitting the update rate
+
+# multi resolution settings
+PYRAMID_COARSE_VOXELS = 256 ** 3  # larger volumes get a pyramid of halved levels down to this size
+# voxels of the finest level the surfaces are extracted from, a 700^3 scan stops at 350^3
+PYRAMID_EXTRACTION_VOXELS = 384 ** 3
+# bytes of voxels a volume keeps in memory: its pyramid levels, and its full resolution level unless it is memory
+# mapped from the volume cache. Finer levels over it are released, the surfaces stay at the coarser ones.
+PYRAMID_MEMORY_BUDGET = 512 * 1024 * 1024
+PYRAMID_REFINE_DELAY = 1500  # ms without interaction before the surfaces are refined to the next finer level
+PYRAMID_PIXELS_PER_VOXEL = 2.0  # zooming in until a voxel covers more pixels refines the surfaces right away
+
+# time series settings
+TIME_SERIES_FRAME_RATE = 10.0  # frames per second played, a frame that is not extracted yet holds the previous one
+TIME_SERIES_BUFFER_FRAMES = 8  # frames (volume and brain surface) prefetched ahead of the playhead
+
+# case browser settings
+CASE_PREFETCH_PREVIOUS = False  # also keep the case before the shown one read and extracted, not only the next one
+
+# batch render settings
+SNAPSHOT_SIZE = (800, 800)  # pixels of the offscreen rendered frames
+TURNTABLE_FRAMES = 36  # frames of a 360 degree turntable, 10 degrees apart
+
+# mesh cache settings
+MESH_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.theia', 'mesh_cache')
+MESH_CACHE_SIZE = 1024 * 1024 * 1024  # bytes, least recently used meshes are evicted past this size
+
+# volume cache settings
+VOLUME_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.theia', 'volume_cache')
+VOLUME_CACHE_SIZE = 4 * 1024 * 1024 * 1024  # bytes of decompressed voxels, least recently opened volumes are evicted
@@ -1,2 +1,536 @@
+import glob
+import os
+import shutil
+import threading
+
+import pytest
+
+import vtkUtils
+from vtkUtils import *
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sample_data')
+MASK_FILE = os.path.join(SAMPLE_DATA, 'truth.nii.gz')
+
+
 def test_read_volume():
-    assert True
+    image = read_volume(MASK_FILE).GetOutput()
+    assert image.GetDimensions() == (240, 240, 155)
+    assert image.GetScalarRange() == (0.0, 4.0)
+    assert get_image_array(image).shape == (155, 240, 240)
+
+
+def test_single_pass_mask_matches_per_label_extraction():
+    mask = NiiObject()
+    mask.reader = read_volume(MASK_FILE)
+    combined = create_multi_label_extractor(mask, [1, 2, 4])
+    combined.Update()
+    for label_value in [1, 2, 4]:
+        per_label = create_mask_extractor(mask)
+        per_label.SetValue(0, label_value)
+        per_label.Update()
+        split = create_label_splitter(combined, label_value)
+        split.Update()
+        assert split.GetOutput().GetNumberOfCells() == per_label.GetOutput().GetNumberOfCells()
+
+
+def test_background_label_filters_match_live_pipeline():
+    mask = load_mask(MASK_FILE)
+    values = [label.value for label in mask.labels]
+    combined = create_multi_label_filters(mask.reader.GetOutput(), values, merge_extents(
+        [label.extent for label in mask.labels]))
+    combined[-1].Update()
+    for label in mask.labels:
+        filters = create_split_label_filters(combined[-1].GetOutput(), label.value, label.smoothness)
+        filters[-1].Update()
+        assert filters[-1].GetOutput().GetNumberOfCells() == get_label_surface(label).GetNumberOfCells()
+
+
+def test_shrink_free_smoothers_keep_the_volume():
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(64)
+    sphere.SetPhiResolution(64)
+    sphere.Update()
+    noisy = create_source(sphere.GetOutput()).GetOutputDataObject(0)
+    points = numpy_support.vtk_to_numpy(noisy.GetPoints().GetData())
+    noisy_points = vtk.vtkPoints()
+    noisy_points.SetData(numpy_support.numpy_to_vtk(points * np.random.RandomState(0).uniform(
+        0.98, 1.02, (len(points), 1)), deep=1))
+    noisy.SetPoints(noisy_points)
+
+    volumes = {}
+    for smoothing in ['windowed_sinc', 'taubin']:
+        smoother = create_smoother(create_source(noisy), 500, smoothing)
+        smoother.Update()
+        mass = vtk.vtkMassProperties()
+        mass.SetInputData(smoother.GetOutputDataObject(0))
+        mass.Update()
+        volumes[smoothing] = mass.GetVolume()
+    sphere_volume = 4.0 / 3.0 * np.pi * 0.5 ** 3
+    assert abs(volumes['windowed_sinc'] - sphere_volume) < 0.05 * sphere_volume
+    assert abs(volumes['taubin'] - sphere_volume) < 0.05 * sphere_volume
+
+
+def test_budget_reducer_meets_the_triangle_budget(monkeypatch):
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(256)
+    sphere.SetPhiResolution(256)
+    for clustering_cells, tolerance in [(None, 0.01), (0, 0.5)]:  # vtkDecimatePro, quadric clustering
+        reducer = BudgetReducer()
+        reducer.SetInputConnection(sphere.GetOutputPort())
+        reducer.SetTriangleBudget(10000)
+        reducer.SetClusteringCells(clustering_cells)
+        reducer.Update()
+        assert abs(reducer.GetOutput().GetNumberOfCells() - 10000) <= tolerance * 10000
+    reducer.SetTriangleBudget(10 ** 6)
+    reducer.Update()
+    assert reducer.GetTargetReduction() == 0.0
+    assert reducer.GetOutput().GetNumberOfCells() == sphere.GetOutput().GetNumberOfCells()
+
+    assert not any(label.cell_count for label in open_mask(MASK_FILE).labels)  # not predicted without a budget
+    monkeypatch.setattr(vtkUtils, 'triangle_budget', 30000)
+    mask = open_mask(MASK_FILE)
+    for label in mask.labels:  # predicted within a few percent
+        label.extractor.Update()
+        assert abs(label.cell_count - label.extractor.GetOutput().GetNumberOfCells()) <= 0.05 * label.cell_count
+    brain = open_brain(MASK_FILE)
+    share_triangle_budget([brain, mask], 30000)
+    labels = brain.labels + mask.labels
+    assert sum(label.triangle_budget for label in labels) == 30000
+    fractions = [label.triangle_budget / label.cell_count for label in labels]
+    assert max(fractions) - min(fractions) < 0.01  # every surface reduced alike
+    share_triangle_budget([brain, mask], 10 ** 7)
+    assert all(label.triangle_budget >= label.cell_count for label in labels)
+    assert sum(label.triangle_budget for label in labels) == 10 ** 7  # the unused shares go to the largest label
+    share_triangle_budget([mask], None)
+    assert all(label.triangle_budget is None for label in mask.labels)
+
+
+def test_brain_views_start_hidden_instead_of_transparent():
+    brain = open_brain(MASK_FILE)
+    create_brain_table(brain)
+    renderer = vtk.vtkRenderer()
+    for prop in setup_slicer(renderer, brain) + [setup_projection(brain, renderer)]:
+        assert not prop.GetVisibility()
+        assert prop.GetProperty().GetOpacity() == 1.0
+
+
+def test_slices_are_colored_by_the_brain_table():
+    brain = open_brain(os.path.join(SAMPLE_DATA, 'flair.nii.gz'))
+    create_brain_table(brain)
+    renderer = vtk.vtkRenderer()
+    props = setup_slicer(renderer, brain) + [setup_projection(brain, renderer)]
+    for prop in props:
+        assert prop.GetProperty().GetLookupTable() is brain.lookup_table
+        assert prop.GetProperty().GetUseLookupTableScalarRange()
+        assert prop.GetMapper().GetInputConnection(0, 0).GetProducer() is brain.reader  # no colored copy
+
+    def slice_colors(prop):
+        # what the slice mapper displays: the intensities of the slice mapped through the table of the property
+        voi = vtk.vtkExtractVOI()
+        voi.SetInputConnection(brain.reader.GetOutputPort())
+        voi.SetVOI(*prop.GetDisplayExtent())
+        to_colors = vtk.vtkImageMapToColors()
+        to_colors.SetInputConnection(voi.GetOutputPort())
+        to_colors.SetLookupTable(prop.GetProperty().GetLookupTable())
+        to_colors.Update()
+        return get_image_array(voi.GetOutput()).ravel(), \
+            numpy_support.vtk_to_numpy(to_colors.GetOutput().GetPointData().GetScalars())[:, :3] / 255.0
+
+    axial = props[0]
+    update_brain_table(brain, 0.5)  # the window of the intensity picker
+    intensities, colors = slice_colors(axial)
+    assert np.all(colors[:, 0] == colors[:, 1]) and np.all(colors[:, 1] == colors[:, 2])
+    assert colors.max() <= 0.5 + 1 / 255.0
+    assert colors[intensities.argmax()].max() > colors[intensities.argmin()].max()
+
+    threshold = np.percentile(intensities, 95)
+    update_brain_table(brain, 1.0, threshold)
+    intensities, colors = slice_colors(axial)
+    tinted = intensities > threshold + 2  # clear of the table bin the threshold falls in
+    assert tinted.any() and (intensities < threshold - 2).any()
+    assert np.all(colors[tinted, 0] > colors[tinted, 2])  # BRAIN_THRESHOLD_COLOR is orange
+    assert np.all(colors[tinted].min(axis=1) >= 0.5 * min(BRAIN_THRESHOLD_COLOR) - 1 / 255.0)
+    gray = colors[intensities < threshold - 2]
+    assert np.all(gray[:, 0] == gray[:, 2])
+
+
+def test_study_modalities_share_one_geometry(tmp_path):
+    files = sorted(file for file in glob.glob(os.path.join(SAMPLE_DATA, '10labels_example', '*.nii.gz'))
+                   if not file.endswith('mask.nii.gz'))
+    brains = open_study(files)
+    assert [get_modality_name(brain.file) for brain in brains] == ['FLAIR', 'T1', 'T1CE', 'T2']
+    assert len({brain.extent for brain in brains}) == 1
+    with pytest.raises(ValueError):
+        open_study([files[0], os.path.join(SAMPLE_DATA, 'flair.nii.gz')])
+
+    # same voxels, extent and spacing, but placed elsewhere in the scanner
+    reader = read_nifti(files[1])
+    shifted = vtk.vtkMatrix4x4()
+    shifted.DeepCopy(reader.GetSFormMatrix())
+    shifted.SetElement(0, 3, shifted.GetElement(0, 3) + 10.0)
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputConnection(reader.GetOutputPort())
+    writer.SetSFormMatrix(shifted)
+    writer.SetQFormMatrix(shifted)
+    writer.SetFileName(str(tmp_path / 'T1.nii'))
+    writer.Write()
+    with pytest.raises(ValueError, match='world matrix'):
+        open_study([files[0], str(tmp_path / 'T1.nii')])
+
+
+def test_mesh_cache_round_trip_and_eviction(tmp_path):
+    cache = MeshCache(str(tmp_path), max_size=1)
+    key = cache.key(MASK_FILE, value=1, smoothness=500)
+    assert key != cache.key(MASK_FILE, value=2, smoothness=500)
+    assert cache.load(key) is None
+    copy = str(tmp_path / 'truth.nii.gz')
+    shutil.copyfile(MASK_FILE, copy)
+    copy_key = cache.key(copy, value=1, smoothness=500)
+    os.utime(copy, ns=(0, 0))  # a rewritten file is extracted again
+    assert cache.key(copy, value=1, smoothness=500) != copy_key
+
+    sphere = vtk.vtkSphereSource()
+    sphere.Update()
+    cache.store(key, sphere.GetOutput())
+    assert cache.load(key) is None  # larger than max_size, evicted right away
+
+    cache.max_size = 1 << 20
+    cache.store(key, sphere.GetOutput())
+    assert cache.load(key).GetNumberOfCells() == sphere.GetOutput().GetNumberOfCells()
+
+
+def test_volume_store_maps_the_decompressed_volume(tmp_path):
+    store = VolumeStore(str(tmp_path), max_size=1 << 30)
+    reader = read_nifti(MASK_FILE)
+    first = store.open(MASK_FILE, read_nifti)
+    second = store.open(MASK_FILE, lambda file_name: None)  # served from the store, never read again
+    for source in (first, second):
+        image = source.GetOutput()
+        assert image.GetExtent() == reader.GetOutput().GetExtent()
+        assert image.GetSpacing() == reader.GetOutput().GetSpacing()
+        assert (get_image_array(image) == get_image_array(reader.GetOutput())).all()
+    assert [size for _, size, _ in store.entries()] == [get_image_array(reader.GetOutput()).nbytes]
+
+    # two case readers storing the same volume at once write their own partial files
+    paths, errors = store.paths('shared'), []
+
+    def store_shared():
+        try:
+            VolumeStore.store(reader.GetOutput(), *paths)
+        except OSError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=store_shared) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors and os.path.exists(paths[1])
+
+
+def test_surface_memory_keeps_recent_surfaces_within_size():
+    sphere = vtk.vtkSphereSource()
+    sphere.Update()
+    size = sphere.GetOutput().GetActualMemorySize() * 1024
+    memory = SurfaceMemory(max_size=2 * size)
+    for threshold in (100, 105, 110):
+        memory.put((threshold, 500), sphere.GetOutput())
+    assert (100, 500) not in memory  # least recently used
+    assert memory.get((105, 500)) is sphere.GetOutput()
+    memory.put((115, 500), sphere.GetOutput())
+    assert (105, 500) in memory and (110, 500) not in memory
+
+
+def test_levels_of_detail_computed_ahead_are_attached_as_is():
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(64)
+    sphere.SetPhiResolution(64)
+    sphere.Update()
+    lod_surfaces = create_lod_surfaces(sphere.GetOutput())
+    assert len(lod_surfaces) == len(LOD_DIVISIONS)
+    label = NiiLabel([1, 1, 1], 1.0, 0, 0)
+    attach_surface(label, None, sphere.GetOutput(), lod_surfaces)
+    assert [label.actor.GetLODMapper(lod_id).GetInput() for lod_id in label.lod_ids[1:]] == lod_surfaces
+
+    sphere.SetThetaResolution(32)
+    sphere.Update()
+    surface = vtk.vtkPolyData()
+    surface.DeepCopy(sphere.GetOutput())
+    set_label_surface(label, surface)  # decimated again when first drawn
+    lod_mapper = label.actor.GetLODMapper(label.lod_ids[1])
+    lod_mapper.Update()
+    assert 0 < lod_mapper.GetInput().GetNumberOfCells() <= surface.GetNumberOfCells()
+    assert lod_mapper.GetInput() is not lod_surfaces[0]
+
+    label.deferred = True  # extracted by a prefetch, the levels computed ahead are swapped in later
+    set_lod_surfaces(label, lod_surfaces)
+    assert label.actor.GetLODMapper(label.lod_ids[1]).GetInput() is lod_surfaces[0]
+    set_label_surface(label, surface)
+    assert not label.deferred
+
+
+def test_pyramid_levels_average_images_and_keep_labels():
+    image = vtk.vtkImageData()
+    image.SetDimensions(4, 4, 5)  # the odd last plane is dropped
+    image.SetSpacing(1.0, 1.0, 2.0)
+    voxels = np.zeros((5, 4, 4), dtype=np.int16)
+    voxels[0:2, 0:2, 0:2] = [[[0, 1], [1, 1]], [[2, 2], [3, 3]]]  # four 1s and two 2s, 1 wins
+    voxels[2, 2:4, 2:4] = 7  # half the block, the tie with the background goes to the label
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.ravel(), deep=1))
+
+    averaged = get_image_array(downsample_volume(image, discrete=False))
+    assert averaged.shape == (2, 2, 2)
+    assert averaged[0, 0, 0] == 2  # (0 + 1 * 3 + 2 * 2 + 3 * 2) / 8 rounded
+    labels = downsample_volume(image, discrete=True)
+    assert get_image_array(labels)[0, 0, 0] == 1
+    assert get_image_array(labels)[1, 1, 1] == 7
+    assert labels.GetSpacing() == (2.0, 2.0, 4.0)
+    assert labels.GetOrigin() == (0.5, 0.5, 1.0)
+
+    pyramid = build_pyramid(read_volume(MASK_FILE).GetOutput(), discrete=True, coarse_voxels=200000)
+    assert [level.GetDimensions() for level in pyramid] == [(240, 240, 155), (120, 120, 77), (60, 60, 38)]
+    assert select_finest_level(pyramid, max_voxels=120 * 120 * 77) == 1
+    assert select_finest_level(pyramid) == 0
+    large = []
+    for size in (700, 350, 175):  # the dimensions alone, nothing is allocated
+        large.append(vtk.vtkImageData())
+        large[-1].SetDimensions(size, size, size)
+    assert select_finest_level(large) == 1
+
+    # 240*240*155 + 120*120*77 + 60*60*38 bytes, within the budget the coarsest levels are kept first
+    kept = build_pyramid(pyramid[0], discrete=True, coarse_voxels=200000, memory_budget=60 * 60 * 38 + 1000)
+    assert kept[0] is pyramid[0] and kept[1] is None and kept[2].GetDimensions() == (60, 60, 38)
+    assert select_finest_level(kept, max_voxels=120 * 120 * 77) == 2
+    mask = NiiObject()
+    mask.pyramid, mask.level, mask.finest_level = kept, 2, 0
+    assert get_finer_level(mask) == 0  # the released level is skipped
+    assert build_pyramid(pyramid[0], discrete=True, coarse_voxels=200000, memory_budget=0)[2] is not None
+    assert scale_extent((99, 140, 88, 166, 78, 117), 2, pyramid[2].GetExtent()) == (24, 35, 22, 41, 19, 29)
+
+
+def test_time_series_frames_stream_from_the_file(tmp_path):
+    grid = np.mgrid[0:16, 0:18, 0:20]
+    radius = np.sqrt((grid[0] - 8) ** 2 + (grid[1] - 9) ** 2 + (grid[2] - 10) ** 2)
+    frames = np.stack([(100 * (radius < 3 + t)).astype(np.int16).ravel() for t in range(5)], axis=-1)
+    image = vtk.vtkImageData()
+    image.SetDimensions(20, 18, 16)
+    image.SetSpacing(1.5, 1.5, 2.0)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(frames, deep=1))
+    for file_name in (str(tmp_path / 'series.nii.gz'), str(tmp_path / 'series.nii')):
+        writer = vtk.vtkNIFTIImageWriter()
+        writer.SetInputData(image)
+        writer.SetTimeDimension(5)
+        writer.SetFileName(file_name)
+        writer.Write()
+
+        brain = open_brain(file_name)
+        series = brain.time_series
+        assert series.frames == 5 and len(brain.pyramid) == 1
+        assert np.array_equal(get_image_array(series.read_frame(0)), get_image_array(brain.reader.GetOutput()))
+        for t in (3, 1, 4):  # backwards and forwards
+            assert np.array_equal(get_image_array(series.read_frame(t)).ravel(), frames[:, t])
+        series.show(2, series.read_frame(2))
+        assert np.array_equal(get_image_array(get_level_image(brain)).ravel(), frames[:, 2])
+        series.close()
+    assert open_brain(MASK_FILE).time_series is None
+
+
+def test_camera_presets_keep_the_scene_centered():
+    renderer = vtk.vtkRenderer()
+    cube = vtk.vtkCubeSource()
+    cube.SetCenter(10.0, 20.0, 30.0)
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputConnection(cube.GetOutputPort())
+    renderer.AddActor(create_actor(mapper, create_property(1.0, (1.0, 1.0, 1.0))))
+    camera = renderer.GetActiveCamera()
+    for view in CAMERA_VIEWS:
+        set_camera_view(renderer, view)
+        assert camera.GetFocalPoint() == pytest.approx((10.0, 20.0, 30.0))
+    set_camera_view(renderer, 'axial')  # looking down the z axis, y up
+    assert np.subtract(camera.GetPosition(), camera.GetFocalPoint())[:2] == pytest.approx((0.0, 0.0))
+    assert camera.GetViewUp() == pytest.approx((0.0, 1.0, 0.0))
+
+
+def test_world_positions_probe_their_voxels():
+    image = read_volume(MASK_FILE).GetOutput()
+    array = get_image_array(image)
+    k, j, i = (int(axis[0]) for axis in np.nonzero(array == 4))
+    origin, spacing = image.GetOrigin(), image.GetSpacing()
+    # anywhere within half a voxel of its center
+    position = [o + (index + 0.4) * s for o, index, s in zip(origin, (i, j, k), spacing)]
+    assert world_to_voxel(image, position) == (i, j, k)
+    assert probe_voxel(image, (i, j, k)) == 4
+    assert world_to_voxel(image, [o - s for o, s in zip(origin, spacing)]) is None
+
+
+def test_case_list_reads_subject_directories_and_csv(tmp_path):
+    from batch_export import read_cases
+    cases = read_cases(SAMPLE_DATA)
+    assert [(name, [get_modality_name(file) for file in brain_files]) for name, brain_files, _ in cases] == \
+        [('10labels_example', ['FLAIR', 'T1', 'T1CE', 'T2'])]
+    assert cases[0][2] == os.path.join(SAMPLE_DATA, '10labels_example', 'mask.nii.gz')
+
+    case_list = tmp_path / 'cases.csv'
+    case_list.write_text('name,brain,mask\n'
+                         'first,a/T1.nii.gz; a/T2.nii.gz,a/mask.nii.gz\n'
+                         ',{},b/mask.nii.gz\n'
+                         'empty,,c/mask.nii.gz\n'.format(MASK_FILE))
+    cases = read_cases(str(case_list))
+    assert cases == [('first', [str(tmp_path / 'a' / 'T1.nii.gz'), str(tmp_path / 'a' / 'T2.nii.gz')],
+                      str(tmp_path / 'a' / 'mask.nii.gz')),
+                     ('b', [MASK_FILE], str(tmp_path / 'b' / 'mask.nii.gz'))]
+
+
+def test_label_extents_are_padded_bounding_boxes():
+    image = vtk.vtkImageData()
+    image.SetDimensions(10, 8, 6)
+    image.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    array = get_image_array(image)
+    array[:] = 0
+    array[2:4, 3:5, 1:2] = 1  # z, y, x
+    array[5, 7, 9] = 2
+
+    extents = compute_label_extents(image, [1, 2, 3])
+    assert extents[1] == (0, 2, 2, 5, 1, 4)
+    assert extents[2] == (8, 9, 6, 7, 4, 5)
+    assert 3 not in extents
+    assert merge_extents(extents.values()) == (0, 9, 2, 7, 1, 5)
+
+
+def test_discover_labels_finds_present_values_only():
+    for scalar_type in [vtk.VTK_UNSIGNED_CHAR, vtk.VTK_SHORT, vtk.VTK_FLOAT]:
+        image = vtk.vtkImageData()
+        image.SetDimensions(4, 4, 4)
+        image.AllocateScalars(scalar_type, 1)
+        array = get_image_array(image)
+        array[:] = 0
+        array[0, 0, :3] = 1
+        array[1, 1, 1] = 4
+        array[3, 3, 3] = 120
+        assert discover_labels(image) == [(1, 3), (4, 1), (120, 1)]
+
+
+def test_intensity_histogram_threshold_queries():
+    image = vtk.vtkImageData()
+    image.SetDimensions(10, 10, 10)
+    image.AllocateScalars(vtk.VTK_SHORT, 1)
+    array = get_image_array(image)
+    array[:] = 0
+    array[2:8, 2:8, 2:8] = 100  # a bright cube in a dark background
+    array[4:6, 4:6, 4:6] = 200
+    image.Modified()
+
+    histogram = compute_intensity_histogram(image)
+    assert fraction_above(histogram, 0) == 1.0
+    assert fraction_above(histogram, 100) == (array >= 100).mean()
+    assert fraction_above(histogram, 200) == (array >= 200).mean()
+    assert 0 < otsu_threshold(histogram) <= 100
+    assert 100 <= percentile_threshold(histogram, 50) < 101  # half of the foreground is 100, interpolated in its bin
+
+
+def test_label_statistics_match_a_per_label_computation(tmp_path):
+    mask = load_mask(MASK_FILE)
+    image = mask.reader.GetOutput()
+    array = get_image_array(image)
+    rows = collect_label_statistics(mask)
+    assert [row['label'] for row in rows] == [1, 2, 4]
+    for row in rows:
+        z, y, x = np.nonzero(array == row['label'])
+        assert row['voxels'] == len(x)
+        assert row['volume_ml'] == pytest.approx(len(x) * np.prod(image.GetSpacing()) / 1000.0)
+        assert row['centroid_x'] == pytest.approx(image.GetOrigin()[0] + x.mean() * image.GetSpacing()[0])
+        assert row['z_max'] == pytest.approx(image.GetOrigin()[2] + z.max() * image.GetSpacing()[2])
+        assert row['area_mm2'] > 0
+
+    write_label_statistics(str(tmp_path / 'statistics.csv'), rows)
+    lines = (tmp_path / 'statistics.csv').read_text().splitlines()
+    assert lines[0].split(',') == LABEL_STATISTICS_FIELDS
+    assert len(lines) == 4
+
+
+def test_label_palette_extends_mask_colors():
+    palette = create_label_palette(len(MASK_COLORS) + 5)
+    assert palette[:len(MASK_COLORS)] == MASK_COLORS
+    assert len(set(palette)) == len(palette)
+
+    mask = open_mask(MASK_FILE)  # labels 1, 2 and 4, label 3 is missing
+    assert [label.value for label in mask.labels] == [1, 2, 4]
+    assert mask.labels[2].color == MASK_COLORS[3] == get_label_color(4)
+    assert get_label_color(len(MASK_COLORS) + 2) == palette[len(MASK_COLORS) + 1]
+
+
+def test_surface_rebuilder_applies_the_newest_surface_only():
+    import time
+    import PyQt5.QtCore as Qt
+    from SurfaceRebuilder import SurfaceRebuilder
+    app = Qt.QCoreApplication.instance() or Qt.QCoreApplication([])
+    rebuilder = SurfaceRebuilder()
+    applied = []
+    release = threading.Event()
+
+    def wait_for_release(surface):
+        release.wait(10)
+        return surface
+
+    stale, newest = vtk.vtkSphereSource(), vtk.vtkSphereSource()
+    stale.SetThetaResolution(8)
+    newest.SetThetaResolution(16)
+    rebuilder.rebuild('brain', [stale], applied.append, work=wait_for_release)
+    rebuilder.rebuild('brain', [newest], applied.append)  # the stale job is still in its work function
+    assert stale.GetAbortExecute()
+    release.set()
+
+    deadline = time.time() + 10
+    while rebuilder.threads and time.time() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    app.processEvents()
+    assert not rebuilder.is_busy() and not rebuilder.threads
+    assert applied == [newest.GetOutput()]
+
+
+def test_deferred_updates_are_timed_until_they_finish():
+    import time
+    from UpdateScheduler import UpdateScheduler
+    scheduler = UpdateScheduler(150)
+    scheduler.schedule('brain_opacity', lambda: None)
+    scheduler.schedule('brain_surface', lambda: None, deferred=True)
+    scheduler.apply()
+    assert [keys for keys, _ in scheduler.timings] == [['brain_opacity']]
+    time.sleep(0.05)  # the rebuild job runs
+    scheduler.finish('brain_surface')
+    scheduler.finish('brain_surface')  # only the first surface after the change counts
+    assert [keys for keys, _ in scheduler.timings] == [['brain_opacity'], ['brain_surface']]
+    assert scheduler.timings[-1][1] >= 0.05
+
+
+def test_profiler_totals_outlive_the_record_cap():
+    import vtkUtils
+    from PipelineProfiler import PipelineProfiler
+    profiler = PipelineProfiler(max_records=2)
+    shrink = vtk.vtkImageShrink3D()
+    profiler.observe(shrink, 'preview')
+    shrink.SetInputData(read_volume(MASK_FILE).GetOutput())
+    for factor in (2, 3, 4):
+        shrink.SetShrinkFactors(factor, factor, factor)
+        shrink.Update()
+    assert len(profiler.records) == 2
+    assert profiler.summary()['preview'][0] == 3
+
+    vtkUtils.profiler = profiler
+    try:
+        mapper = create_mapper(create_source(vtk.vtkPolyData()))
+    finally:
+        vtkUtils.profiler = None
+    assert not mapper.HasObserver('EndEvent')  # mappers execute on every render
+
+
+def test_benchmark_comparison_flags_regressions_only():
+    from benchmark import compare_results
+    baseline = {'flair': {'seconds': {'extract_mask': 1.0, 'stage.voi': 0.001}, 'peak_rss_kib': 1000,
+                          'triangles': {'label_1': 100}}}
+    faster = {'flair': {'seconds': {'extract_mask': 0.5, 'stage.voi': 0.01}, 'peak_rss_kib': 900,
+                        'triangles': {'label_1': 105}}}
+    slower = {'flair': {'seconds': {'extract_mask': 1.5, 'stage.voi': 0.01}, 'peak_rss_kib': 1500,
+                        'triangles': {'label_1': 50}}}
+    assert compare_results(baseline, faster, tolerance=20) == []
+    assert len(compare_results(baseline, slower, tolerance=20)) == 3
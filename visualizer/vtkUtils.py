@@ -1,10 +1,43 @@
+import colorsys
+import csv
+import math
+import os
+
+import numpy as np
 import vtk
+from vtk.util import numpy_support
+from BudgetReducer import *
 from ErrorObserver import *
 from NiiObject import *
 from config import *
 from NiiLabel import *
+from MeshCache import *
+from TaubinSmoother import *
+from TimeSeries import *
+from VolumeStore import *
 
 error_observer = ErrorObserver()
+mesh_cache = None  # a MeshCache, set by the application unless caching is disabled
+profiler = None  # a PipelineProfiler, set by the application when profiling
+volume_store = None  # a VolumeStore, set by the application unless caching is disabled
+triangle_budget = TRIANGLE_BUDGET  # triangles of the scene, set by the application (see share_triangle_budget)
+
+
+def observe_stage(vtk_filter, stage):
+    """
+    Lets the profiler (if any) time every execution of a pipeline stage.
+    :return: vtk_filter
+    """
+    if profiler:
+        profiler.observe(vtk_filter, stage)
+    return vtk_filter
+
+
+def set_stage_label(label_name, *vtk_filters):
+    """ Attributes the profiled executions of the filters to a label."""
+    if profiler:
+        for vtk_filter in vtk_filters:
+            profiler.set_label(vtk_filter, label_name)
 
 '''
 VTK Pipeline:   reader ->
@@ -16,12 +49,12 @@ VTK Pipeline:   reader ->
 '''
 
 
-def read_volume(file_name):
+def read_nifti(file_name):
     """
-    :param file_name: The filename of type 'nii.gz'
+    :param file_name: The filename of type 'nii.gz' or 'nii'
     :return: vtkNIFTIImageReader (https://www.vtk.org/doc/nightly/html/classvtkNIFTIImageReader.html)
     """
-    reader = vtk.vtkNIFTIImageReader()
+    reader = observe_stage(vtk.vtkNIFTIImageReader(), 'reader')
     reader.SetFileNameSliceOffset(1)
     reader.SetDataByteOrderToBigEndian()
     reader.SetFileName(file_name)
@@ -29,6 +62,452 @@ def read_volume(file_name):
     return reader
 
 
+def read_volume(file_name):
+    """
+    Reads a volume through the volume store when there is one (decompressed once, memory mapped afterwards).
+    :param file_name: The filename of type 'nii.gz' or 'nii'
+    :return: an updated vtkAlgorithm whose output is the vtkImageData
+    """
+    if volume_store:
+        return volume_store.open(file_name, read_nifti)
+    return read_nifti(file_name)
+
+
+def read_time_series(file_name):
+    """
+    :param file_name: The filename of type 'nii.gz' or 'nii'
+    :return: a TimeSeries streaming the frames of a 4D volume, None for a 3D volume
+    """
+    header = vtk.vtkNIFTIImageReader()
+    header.SetFileName(file_name)
+    header.UpdateInformation()  # reads the header only
+    return TimeSeries(read_nifti(file_name)) if header.GetTimeDimension() > 1 else None
+
+
+def read_world_matrix(file_name):
+    """
+    The voxel to world (scanner) matrix of a NIfTI header, where the reader leaves the position and orientation of
+    a scan (its output origin is 0). The voxels are not read.
+    :param file_name: The filename of type 'nii.gz' or 'nii'
+    :return: the sform, else the qform, as a 4x4 numpy array, None if the header has neither
+    """
+    header = vtk.vtkNIFTIImageReader()
+    header.SetFileName(file_name)
+    header.UpdateInformation()  # reads the header only
+    matrix = header.GetSFormMatrix() or header.GetQFormMatrix()
+    if matrix is None:
+        return None
+    return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+
+def get_image_array(image):
+    """
+    :param image: a single component vtkImageData
+    :return: a zero-copy numpy view of the scalars indexed [z, y, x]
+    """
+    dims = image.GetDimensions()
+    return numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(dims[2], dims[1], dims[0])
+
+
+def world_to_voxel(image, position):
+    """
+    Maps a world position to the voxel nearest to it with the image geometry alone, no pipeline executes.
+    :param image: a vtkImageData
+    :param position: (x, y, z) in world coordinates
+    :return: the (i, j, k) structured index of the voxel, None outside of the image
+    """
+    origin, spacing, extent = image.GetOrigin(), image.GetSpacing(), image.GetExtent()
+    index = []
+    for axis in range(3):
+        i = int(round((position[axis] - origin[axis]) / spacing[axis]))
+        if not extent[2 * axis] <= i <= extent[2 * axis + 1]:
+            return None
+        index.append(i)
+    return tuple(index)
+
+
+def probe_voxel(image, index):
+    """
+    :param image: a single component vtkImageData
+    :param index: an (i, j, k) structured index of world_to_voxel
+    :return: the value of the voxel, read from the scalars array
+    """
+    extent = image.GetExtent()
+    return get_image_array(image)[index[2] - extent[4], index[1] - extent[2], index[0] - extent[0]].item()
+
+
+def discover_labels(image):
+    """
+    Finds the label values actually present in a mask and their voxel counts in one vectorized pass
+    (bincount for 8 and 16 bit masks, unique otherwise). The background (0) is left out.
+    :param image: the mask vtkImageData
+    :return: a list of (label value, voxel count) sorted by label value
+    """
+    array = get_image_array(image).ravel()
+    if array.dtype.kind in 'ui' and array.dtype.itemsize <= 2:
+        # at most 65536 bins, signed masks are shifted so their minimum lands in the first bin
+        offset = int(array.min()) if array.dtype.kind == 'i' else 0
+        counts = np.bincount(np.subtract(array, offset, dtype=np.int32) if offset else array)
+        values = np.nonzero(counts)[0]
+        counts = counts[values]
+        values = values + offset
+    else:
+        values, counts = np.unique(array, return_counts=True)
+    present = values != 0
+    return list(zip(values[present].tolist(), counts[present].tolist()))
+
+
+def compute_intensity_histogram(image, bins=BRAIN_HISTOGRAM_BINS):
+    """
+    Counts the intensities of a volume once, so the threshold picker can query it instead of extracting surfaces.
+    Integer volumes are counted exactly, one bin per value (bincount, several times faster than np.histogram).
+    :param image: a single component vtkImageData
+    :param bins: the number of bins of floating point volumes
+    :return: (edges, above) where above[i] is the number of voxels >= edges[i], above[-1] is 0
+    """
+    array = get_image_array(image).ravel()
+    low, high = image.GetScalarRange()
+    if array.dtype.kind in 'iu' and high - low < 1 << 16:
+        counts = np.bincount((array - np.int64(low)) if low else array, minlength=int(high - low) + 1)
+        edges = np.arange(low, high + 2)
+    else:
+        counts, edges = np.histogram(array, bins=bins, range=(low, high))
+    above = np.append(np.cumsum(counts[::-1])[::-1], 0)
+    return edges, above
+
+
+def fraction_above(histogram, threshold):
+    """
+    :return: the fraction of the voxels >= threshold, linearly interpolated within a bin
+    """
+    edges, above = histogram
+    return float(np.interp(threshold, edges, above)) / max(above[0], 1)
+
+
+def otsu_threshold(histogram):
+    """
+    Otsu's threshold, the intensity maximizing the variance between the voxels below and above it.
+    (https://en.wikipedia.org/wiki/Otsu%27s_method)
+    """
+    edges, above = histogram
+    counts = above[:-1] - above[1:]
+    centers = (edges[:-1] + edges[1:]) / 2
+    below = np.cumsum(counts)[:-1].astype(np.float64)
+    upper = above[0] - below
+    below_sum = np.cumsum(counts * centers)[:-1]
+    mean_below = below_sum / np.maximum(below, 1)
+    mean_upper = (np.sum(counts * centers) - below_sum) / np.maximum(upper, 1)
+    between_variance = below * upper * (mean_below - mean_upper) ** 2
+    return float(edges[np.argmax(between_variance) + 1])
+
+
+def percentile_threshold(histogram, percentile=BRAIN_THRESHOLD_PERCENTILE):
+    """
+    :param percentile: the percentage of the foreground voxels below the threshold
+    :return: the threshold, the background (first bin, usually the zeros around the head) is left out
+    """
+    edges, above = histogram
+    foreground = above[1:]
+    target = foreground[0] * (1.0 - percentile / 100.0)
+    # above decreases with the intensity, np.interp needs increasing sample points
+    return float(np.interp(target, foreground[::-1], edges[1:][::-1]))
+
+
+def get_label_color(label_value):
+    """
+    The color of a mask label picked by its value, so a label keeps its color whichever labels are missing from a
+    mask and in every case of a case list: label 1 is MASK_COLORS[0] and so on, the values past MASK_COLORS get
+    evenly spread (golden ratio) hues.
+    :param label_value: the label value, a positive integer in the usual masks
+    :return: the RGB color
+    """
+    index = max(abs(int(label_value)), 1) - 1
+    if index < len(MASK_COLORS):
+        return MASK_COLORS[index]
+    golden_ratio = 0.618033988749895
+    hue = ((index - len(MASK_COLORS) + 1) * golden_ratio) % 1.0
+    saturation = 0.9 if index % 2 else 0.6
+    return colorsys.hsv_to_rgb(hue, saturation, 1.0)
+
+
+def create_label_palette(n_colors):
+    """
+    :param n_colors: the number of colors needed
+    :return: the colors of the label values 1 to n_colors, see get_label_color
+    """
+    return [get_label_color(label_value) for label_value in range(1, n_colors + 1)]
+
+
+def compute_label_extents(image, label_values, padding=1):
+    """
+    Computes the voxel bounding box of every label in one vectorized pass over the image.
+    :param image: the mask vtkImageData
+    :param label_values: the label values to locate
+    :param padding: voxels added on each side (clipped to the image extent) so surfaces touching the box stay closed
+    :return: dict label value -> extent (xmin, xmax, ymin, ymax, zmin, zmax), labels without voxels are left out
+    """
+    whole_extent = image.GetExtent()
+    array = get_image_array(image)
+    z, y, x = np.nonzero(array)
+    values = array[z, y, x]
+
+    label_values = np.asarray(sorted(label_values))
+    label_index = np.searchsorted(label_values, values).clip(0, len(label_values) - 1)
+    wanted = label_values[label_index] == values
+    label_index = label_index[wanted]
+
+    lower = np.full((len(label_values), 3), np.iinfo(np.int64).max)
+    upper = np.full((len(label_values), 3), -1)
+    for axis, coordinates in enumerate((x[wanted], y[wanted], z[wanted])):
+        np.minimum.at(lower[:, axis], label_index, coordinates)
+        np.maximum.at(upper[:, axis], label_index, coordinates)
+
+    extents = {}
+    for i, label_value in enumerate(label_values.tolist()):
+        if upper[i, 0] < 0:
+            continue
+        extent = []
+        for axis in range(3):
+            axis_min, axis_max = whole_extent[2 * axis], whole_extent[2 * axis + 1]
+            extent.append(max(axis_min, axis_min + int(lower[i, axis]) - padding))
+            extent.append(min(axis_max, axis_min + int(upper[i, axis]) + padding))
+        extents[label_value] = tuple(extent)
+    return extents
+
+
+LABEL_STATISTICS_FIELDS = ['label', 'voxels', 'volume_ml', 'area_mm2', 'centroid_x', 'centroid_y', 'centroid_z',
+                           'x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max']
+
+
+def compute_label_statistics(image, label_values):
+    """
+    Measures every label of a mask in one vectorized pass over its voxels: voxel count, volume, centroid and
+    bounding box. Positions are world coordinates (mm) of the voxel centers, like the extracted surfaces.
+    :param image: the mask vtkImageData
+    :param label_values: the label values to measure
+    :return: dict label value -> row of LABEL_STATISTICS_FIELDS without the area (see collect_label_statistics)
+    """
+    array = get_image_array(image)
+    z, y, x = np.nonzero(array)
+    values = array[z, y, x]
+
+    label_values = np.asarray(sorted(label_values))
+    label_index = np.searchsorted(label_values, values).clip(0, len(label_values) - 1)
+    wanted = label_values[label_index] == values
+    label_index = label_index[wanted]
+    counts = np.bincount(label_index, minlength=len(label_values))
+
+    origin, spacing = image.GetOrigin(), image.GetSpacing()
+    whole_extent = image.GetExtent()
+    centroids, lower, upper = [], [], []
+    for axis, coordinates in enumerate((x[wanted], y[wanted], z[wanted])):
+        positions = origin[axis] + (whole_extent[2 * axis] + coordinates) * spacing[axis]
+        centroids.append(np.bincount(label_index, weights=positions, minlength=len(label_values)) /
+                         np.maximum(counts, 1))
+        lower.append(np.full(len(label_values), np.inf))
+        upper.append(np.full(len(label_values), -np.inf))
+        np.minimum.at(lower[axis], label_index, positions)
+        np.maximum.at(upper[axis], label_index, positions)
+
+    voxel_volume = spacing[0] * spacing[1] * spacing[2]
+    statistics = {}
+    for i, label_value in enumerate(label_values.tolist()):
+        if not counts[i]:
+            continue
+        row = {'label': label_value, 'voxels': int(counts[i]), 'volume_ml': float(counts[i] * voxel_volume / 1000.0)}
+        for axis, name in enumerate('xyz'):
+            row['centroid_' + name] = float(centroids[axis][i])
+            row[name + '_min'], row[name + '_max'] = float(lower[axis][i]), float(upper[axis][i])
+        statistics[label_value] = row
+    return statistics
+
+
+def measure_surface(surface):
+    """
+    (https://www.vtk.org/doc/nightly/html/classvtkMassProperties.html)
+    :param surface: a closed triangle vtkPolyData
+    :return: (volume, area) of the surface
+    """
+    mass = vtk.vtkMassProperties()
+    mass.SetInputData(surface)
+    mass.Update()
+    return mass.GetVolume(), mass.GetSurfaceArea()
+
+
+def collect_label_statistics(mask, voxel_statistics=None):
+    """
+    The statistics table of a mask, the surface area is measured on the surface currently shown for each label.
+    :param mask: a NiiObject with the labels of a mask
+    :param voxel_statistics: the result of compute_label_statistics for the mask if already computed
+    :return: a row of LABEL_STATISTICS_FIELDS per label, the area is None for labels without a surface
+    """
+    if voxel_statistics is None:
+        voxel_statistics = compute_label_statistics(mask.reader.GetOutput(), [label.value for label in mask.labels])
+    rows = []
+    for label in mask.labels:
+        if label.value not in voxel_statistics:
+            continue
+        row = dict(voxel_statistics[label.value])
+        surface = get_label_surface(label)
+        row['area_mm2'] = measure_surface(surface)[1] if surface and surface.GetNumberOfCells() else None
+        rows.append(row)
+    return rows
+
+
+def write_label_statistics(file_name, rows):
+    """ Writes the rows of collect_label_statistics as CSV."""
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=LABEL_STATISTICS_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def merge_extents(extents):
+    """
+    :return: the smallest extent containing every extent
+    """
+    return (min(e[0] for e in extents), max(e[1] for e in extents),
+            min(e[2] for e in extents), max(e[3] for e in extents),
+            min(e[4] for e in extents), max(e[5] for e in extents))
+
+
+def downsample_volume(image, discrete, slab_size=8):
+    """
+    Halves a volume along every axis. Intensities are averaged over each 2x2x2 block, masks take the most frequent
+    label of the block with ties going to a label over the background, so thin labels survive a level longer.
+    The blocks are processed in slabs of slab_size output planes to bound the temporary memory.
+    :param image: a single component vtkImageData, a trailing odd plane along an axis is dropped
+    :param discrete: True for masks
+    :return: the vtkImageData with twice the spacing, covering the same world region
+    """
+    array = get_image_array(image)
+    shape = [size // 2 for size in array.shape]
+    blocks = array[:2 * shape[0], :2 * shape[1], :2 * shape[2]].reshape(shape[0], 2, shape[1], 2, shape[2], 2)
+    output = np.empty(shape, dtype=array.dtype)
+    for z in range(0, shape[0], slab_size):
+        slab = blocks[z:z + slab_size]
+        if discrete:
+            values = slab.transpose(0, 2, 4, 1, 3, 5).reshape(-1, 8)
+            mode = values[:, 0].copy()
+            # most blocks hold a single label, the vote only runs on the blocks at label boundaries
+            mixed = np.nonzero((values != values[:, :1]).any(axis=1))[0]
+            if len(mixed):
+                votes = values[mixed]
+                counts = (votes[:, :, np.newaxis] == votes[:, np.newaxis, :]).sum(axis=2) - 0.5 * (votes == 0)
+                mode[mixed] = votes[np.arange(len(mixed)), counts.argmax(axis=1)]
+            output[z:z + slab_size] = mode.reshape(slab.shape[0], shape[1], shape[2])
+        elif array.dtype.kind in 'iu':
+            output[z:z + slab_size] = (slab.sum(axis=(1, 3, 5), dtype=np.int64) + 4) // 8  # rounded average
+        else:
+            output[z:z + slab_size] = slab.mean(axis=(1, 3, 5), dtype=np.float64)
+
+    origin, spacing, extent = image.GetOrigin(), image.GetSpacing(), image.GetExtent()
+    downsampled = vtk.vtkImageData()
+    downsampled.SetDimensions(shape[2], shape[1], shape[0])
+    downsampled.SetSpacing([2 * s for s in spacing])
+    # the first output voxel is centered between the first two input voxels
+    downsampled.SetOrigin([o + (extent[2 * axis] + 0.5) * spacing[axis] for axis, o in enumerate(origin)])
+    scalars = numpy_support.numpy_to_vtk(output.ravel(), deep=1)
+    scalars.SetName(image.GetPointData().GetScalars().GetName())
+    downsampled.GetPointData().SetScalars(scalars)
+    return downsampled
+
+
+def build_pyramid(image, discrete, coarse_voxels=PYRAMID_COARSE_VOXELS, memory_budget=None):
+    """
+    The multi resolution levels of a volume, each halving the previous one until it has at most coarse_voxels.
+    Built once when the volume is opened, the coarse levels add at most a seventh of the volume in memory. Within a
+    memory budget the coarsest levels are kept first, a finer level over it is only built as a step towards the
+    coarser ones and released right away.
+    :param image: the vtkImageData read from the file, level 0
+    :param discrete: True for masks (label preserving mode instead of averaging, see downsample_volume)
+    :param memory_budget: bytes of voxels the levels past level 0 may take (see get_pyramid_budget), None for all
+    :return: the levels from finest to coarsest, None for the released ones (the coarsest level is always kept), a
+             volume with at most coarse_voxels is its only level
+    """
+    shapes = [image.GetDimensions()]
+    while np.prod(shapes[-1]) > coarse_voxels and min(shapes[-1]) >= 4:
+        shapes.append(tuple(size // 2 for size in shapes[-1]))  # see downsample_volume
+    kept, used = set(), 0
+    for level in range(len(shapes) - 1, 0, -1):
+        size = int(np.prod(shapes[level])) * image.GetScalarSize()
+        if kept and memory_budget is not None and used + size > memory_budget:
+            break  # the finer levels are larger still
+        kept.add(level)
+        used += size
+
+    levels, previous = [image], image
+    for level in range(1, len(shapes)):
+        previous = downsample_volume(previous, discrete)
+        levels.append(previous if level in kept else None)
+    return levels
+
+
+def get_pyramid_budget(image, mapped):
+    """
+    :param image: the vtkImageData read from the file, level 0
+    :param mapped: level 0 is memory mapped from the volume store, the system can drop its pages
+    :return: the bytes of PYRAMID_MEMORY_BUDGET left to the coarser levels of a volume (see build_pyramid)
+    """
+    resident = 0 if mapped else image.GetNumberOfPoints() * image.GetScalarSize()
+    return max(0, PYRAMID_MEMORY_BUDGET - resident)
+
+
+def select_finest_level(pyramid, max_voxels=PYRAMID_EXTRACTION_VOXELS):
+    """
+    :return: the finest pyramid level surfaces are extracted from, the first kept one with at most max_voxels, the
+             coarsest level otherwise
+    """
+    for level, image in enumerate(pyramid):
+        if image is not None and image.GetNumberOfPoints() <= max_voxels:
+            return level
+    return len(pyramid) - 1
+
+
+def get_finer_level(nii_object):
+    """ The next kept pyramid level finer than the one the surfaces of nii_object are extracted from."""
+    level = nii_object.level - 1
+    while level > nii_object.finest_level and nii_object.pyramid[level] is None:
+        level -= 1
+    return level
+
+
+def get_level_image(nii_object, level=None):
+    """
+    :param level: the pyramid level, None for the level the surfaces of nii_object are extracted from
+    :return: the vtkImageData of that level
+    """
+    return nii_object.pyramid[nii_object.level if level is None else level]
+
+
+def scale_extent(extent, level, whole_extent):
+    """
+    :param extent: a voxel extent of pyramid level 0 (see compute_label_extents)
+    :param whole_extent: the extent of the level image
+    :return: the extent covering the same voxels at the given level
+    """
+    scaled = []
+    for axis in range(3):
+        scaled.append(max(whole_extent[2 * axis], extent[2 * axis] >> level))
+        scaled.append(min(whole_extent[2 * axis + 1], extent[2 * axis + 1] >> level))
+    return tuple(scaled)
+
+
+def create_voi(nii_object, extent):
+    """
+    Restricts the volume to a sub extent so the extractors only traverse the region of interest. The output keeps
+    the original origin and spacing, the extracted surfaces stay in place.
+    (https://www.vtk.org/doc/nightly/html/classvtkExtractVOI.html)
+    :param nii_object: the NiiObject to crop
+    :param extent: the voxel extent to keep (xmin, xmax, ymin, ymax, zmin, zmax)
+    :return: the vtkExtractVOI
+    """
+    voi = observe_stage(vtk.vtkExtractVOI(), 'voi')
+    voi.SetInputConnection(nii_object.reader.GetOutputPort())
+    voi.SetVOI(*extent)
+    return voi
+
+
 def create_brain_extractor(brain):
     """
     Given the output from brain (vtkNIFTIImageReader) extract it into 3D using
@@ -36,51 +515,193 @@ def create_brain_extractor(brain):
     :param brain: a vtkNIFTIImageReader volume containing the brain
     :return: the extracted volume from vtkFlyingEdges3D
     """
-    brain_extractor = vtk.vtkFlyingEdges3D()
+    brain_extractor = observe_stage(vtk.vtkFlyingEdges3D(), 'extractor')
     brain_extractor.SetInputConnection(brain.reader.GetOutputPort())
     # brain_extractor.SetValue(0, sum(brain.scalar_range)/2)
     return brain_extractor
 
 
-def create_mask_extractor(mask):
+def create_mask_extractor(mask, extent=None):
     """
     Given the output from mask (vtkNIFTIImageReader) extract it into 3D using
     vtkDiscreteMarchingCubes algorithm (https://www.vtk.org/doc/release/5.0/html/a01331.html).
     This algorithm is specialized for reading segmented volume labels.
     :param mask: a vtkNIFTIImageReader volume containing the mask
+    :param extent: optional voxel extent the extraction is restricted to (see compute_label_extents)
     :return: the extracted volume from vtkDiscreteMarchingCubes
     """
-    mask_extractor = vtk.vtkDiscreteMarchingCubes()
-    mask_extractor.SetInputConnection(mask.reader.GetOutputPort())
+    mask_extractor = observe_stage(vtk.vtkDiscreteMarchingCubes(), 'extractor')
+    source = create_voi(mask, extent) if extent else mask.reader
+    mask_extractor.SetInputConnection(source.GetOutputPort())
     return mask_extractor
 
 
-def create_polygon_reducer(extractor):
+def create_multi_label_extractor(mask, label_values, extent=None):
+    """
+    Extract the surfaces of every label in a single traversal of the mask using vtkDiscreteMarchingCubes.
+    Each output cell is tagged with the value of the label it belongs to (ComputeScalars), which lets
+    create_label_splitter separate the combined output into one surface per label afterwards.
+    :param mask: a vtkNIFTIImageReader volume containing the mask
+    :param label_values: the label values to extract
+    :param extent: optional voxel extent the extraction is restricted to (see compute_label_extents)
+    :return: the combined extracted volume from vtkDiscreteMarchingCubes
+    """
+    mask_extractor = observe_stage(vtk.vtkDiscreteMarchingCubes(), 'extractor')
+    source = create_voi(mask, extent) if extent else mask.reader
+    mask_extractor.SetInputConnection(source.GetOutputPort())
+    for i, label_value in enumerate(label_values):
+        mask_extractor.SetValue(i, label_value)
+    mask_extractor.ComputeScalarsOn()
+    return mask_extractor
+
+
+def set_threshold_between(threshold, lower, upper):
+    """
+    ThresholdBetween was replaced by SetLowerThreshold/SetUpperThreshold in VTK 9.1 (and later removed).
+    :param threshold: a vtkThreshold
+    :param lower: the lower bound (inclusive)
+    :param upper: the upper bound (inclusive)
+    """
+    if hasattr(threshold, 'SetLowerThreshold'):
+        threshold.SetLowerThreshold(lower)
+        threshold.SetUpperThreshold(upper)
+        threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+    else:
+        threshold.ThresholdBetween(lower, upper)
+
+
+def create_label_splitter(extractor, label_value):
+    """
+    Selects the cells of a single label from the output of create_multi_label_extractor and converts them back
+    into polygons so the rest of the pipeline (decimate -> smoother -> normalizer) can run per label.
+    (https://www.vtk.org/doc/nightly/html/classvtkThreshold.html)
+    :param extractor: a multi label vtkDiscreteMarchingCubes
+    :param label_value: the label value to keep
+    :return: the polygons of the label from vtkGeometryFilter
+    """
+    threshold = observe_stage(vtk.vtkThreshold(), 'splitter')
+    threshold.SetInputConnection(extractor.GetOutputPort())
+    threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS,
+                                     vtk.vtkDataSetAttributes.SCALARS)
+    set_threshold_between(threshold, label_value, label_value)
+    label_surface = observe_stage(vtk.vtkGeometryFilter(), 'splitter')
+    label_surface.SetInputConnection(threshold.GetOutputPort())
+    return label_surface
+
+
+def estimate_extracted_cells(image, label, discrete):
+    """
+    Predicts the triangles marching cubes extracts for a label without extracting it: two per voxel edge crossing
+    the surface, within a few percent at the native resolution. Volumes over SURFACE_ESTIMATE_VOXELS are sampled
+    every few voxels and the count is scaled by the surface area, which undercounts folded surfaces a little.
+    :param image: the native vtkImageData
+    :param label: a NiiLabel, its value is the threshold of a brain or the label value of a mask
+    :param discrete: a mask label (the voxels equal to its value), otherwise a brain (the voxels >= its threshold)
+    :return: the predicted number of cells
+    """
+    array = get_image_array(image)
+    if label.extent:  # only the bounding box of a mask label is traversed
+        whole_extent = image.GetExtent()
+        array = array[tuple(slice(label.extent[2 * axis] - whole_extent[2 * axis],
+                                  label.extent[2 * axis + 1] - whole_extent[2 * axis] + 1) for axis in (2, 1, 0))]
+    stride = max(1, int(math.ceil((array.size / float(SURFACE_ESTIMATE_VOXELS)) ** (1.0 / 3.0))))
+    sampled = array[::stride, ::stride, ::stride]
+    inside = sampled == label.value if discrete else sampled >= label.value
+    crossings = (np.count_nonzero(inside[1:] != inside[:-1]) + np.count_nonzero(inside[:, 1:] != inside[:, :-1]) +
+                 np.count_nonzero(inside[:, :, 1:] != inside[:, :, :-1]))
+    return int(2 * crossings * stride ** 2)
+
+
+def share_triangle_budget(nii_objects, budget):
+    """
+    Splits the triangle budget of a scene between the labels of its NiiObjects in proportion to their extracted
+    triangles (NiiLabel.cell_count), so every surface is reduced by the same fraction. Shares are handed out from
+    the smallest label up, a label below its share keeps all of its triangles and the rest goes to the others.
+    The cell counts are only predicted when a volume is opened with a triangle_budget set, without them the budget
+    is split evenly.
+    :param nii_objects: the NiiObjects shown together
+    :param budget: the triangles of the whole scene, None to remove TARGET_REDUCTION of every surface
+    """
+    labels = sorted((label for nii_object in nii_objects for label in nii_object.labels),
+                    key=lambda label: label.cell_count)
+    remaining_budget, remaining_cells = budget, sum(label.cell_count for label in labels)
+    for i, label in enumerate(labels):
+        if not budget:
+            label.triangle_budget = None
+            continue
+        if remaining_cells:
+            share = min(remaining_budget * label.cell_count // remaining_cells, label.cell_count)
+        else:  # nothing predicted, evenly
+            share = remaining_budget // (len(labels) - i)
+        label.triangle_budget = max(1, share)
+        remaining_budget = max(0, remaining_budget - share)
+        remaining_cells -= label.cell_count
+    if budget and labels and labels[-1].cell_count:
+        labels[-1].triangle_budget += remaining_budget  # the largest label takes what the smaller ones left
+
+
+def share_study_triangle_budget(brains, mask, budget):
+    """
+    Shares the triangle budget of a case (see share_triangle_budget) whose modalities are shown one at a time with
+    the mask. The mask labels get their shares next to the first modality, every modality what the mask leaves.
+    """
+    share_triangle_budget([brains[0], mask], budget)
+    for brain in brains[1:]:
+        share_triangle_budget([brain], get_budget_left(mask, budget))
+
+
+def get_budget_left(mask, budget):
+    """ The triangles of a budget left to a modality next to a mask whose labels have their shares."""
+    return max(1, budget - sum(label.triangle_budget for label in mask.labels)) if budget else None
+
+
+def create_polygon_reducer(extractor, triangle_budget=None):
     """
     Reduces the number of polygons (triangles) in the volume. This is used to speed up rendering.
     (https://www.vtk.org/doc/nightly/html/classvtkDecimatePro.html)
     :param extractor: an extractor (vtkPolyDataAlgorithm), will be either vtkFlyingEdges3D or vtkDiscreteMarchingCubes
+    :param triangle_budget: the triangles to reduce the surface to (see BudgetReducer), None for TARGET_REDUCTION
     :return: the decimated volume
     """
-    reducer = vtk.vtkDecimatePro()
+    if triangle_budget:
+        reducer = observe_stage(BudgetReducer(), 'decimate')
+        reducer.SetInputConnection(extractor.GetOutputPort())
+        reducer.SetTriangleBudget(triangle_budget)
+        reducer.SetClusteringCells(QUADRIC_CLUSTERING_CELLS)
+        return reducer
+    reducer = observe_stage(vtk.vtkDecimatePro(), 'decimate')
     reducer.AddObserver('ErrorEvent', error_observer)  # throws an error event if there is no data to decimate
     reducer.SetInputConnection(extractor.GetOutputPort())
-    reducer.SetTargetReduction(0.5)  # magic number
+    reducer.SetTargetReduction(TARGET_REDUCTION)
     reducer.PreserveTopologyOn()
     return reducer
 
 
-def create_smoother(reducer, smoothness):
+def create_smoother(reducer, smoothness, smoothing=SMOOTHING_METHOD):
     """
-    Reorients some points in the volume to smooth the render edges.
+    Reorients some points in the volume to smooth the render edges. Laplacian smoothing needs hundreds of iterations
+    and shrinks the surface, windowed sinc and Taubin smoothing reach a similar smoothness without shrinking in a
+    few dozen (see SMOOTHING_ITERATION_SCALE and benchmark.py --smoothing).
     (https://www.vtk.org/doc/nightly/html/classvtkSmoothPolyDataFilter.html)
+    (https://www.vtk.org/doc/nightly/html/classvtkWindowedSincPolyDataFilter.html)
     :param reducer:
-    :param smoothness:
+    :param smoothness: the smoothness in Laplacian iterations
+    :param smoothing: one of SMOOTHING_METHODS
     :return:
     """
-    smoother = vtk.vtkSmoothPolyDataFilter()
+    iterations = max(1, int(round(smoothness * SMOOTHING_ITERATION_SCALE[smoothing])))
+    if smoothing == 'windowed_sinc':
+        smoother = observe_stage(vtk.vtkWindowedSincPolyDataFilter(), 'smoother')
+        smoother.SetPassBand(SMOOTHING_PASS_BAND)
+        smoother.NormalizeCoordinatesOn()
+        smoother.NonManifoldSmoothingOn()
+    elif smoothing == 'taubin':
+        smoother = observe_stage(TaubinSmoother(), 'smoother')
+        smoother.SetPassBand(SMOOTHING_PASS_BAND)
+    else:
+        smoother = observe_stage(vtk.vtkSmoothPolyDataFilter(), 'smoother')
     smoother.SetInputConnection(reducer.GetOutputPort())
-    smoother.SetNumberOfIterations(smoothness)
+    smoother.SetNumberOfIterations(iterations)
     return smoother
 
 
@@ -92,13 +713,14 @@ def create_normals(smoother):
     :param smoother:
     :return:
     """
-    brain_normals = vtk.vtkPolyDataNormals()
+    brain_normals = observe_stage(vtk.vtkPolyDataNormals(), 'normalizer')
     brain_normals.SetInputConnection(smoother.GetOutputPort())
-    brain_normals.SetFeatureAngle(60.0)  #
+    brain_normals.SetFeatureAngle(FEATURE_ANGLE)
     return brain_normals
 
 
 def create_mapper(stripper):
+    # not profiled, an OpenGL mapper fires its Start/End events on every render and would report draw time
     brain_mapper = vtk.vtkPolyDataMapper()
     brain_mapper.SetInputConnection(stripper.GetOutputPort())
     brain_mapper.ScalarVisibilityOff()
@@ -120,6 +742,102 @@ def create_actor(mapper, prop):
     return actor
 
 
+def create_lod_reducer(surface, divisions):
+    """
+    Heavily decimates a surface for interactive rendering. Quadric clustering is used because it runs in a
+    fraction of the time of vtkDecimatePro, quality matters little while the camera is moving.
+    (https://www.vtk.org/doc/nightly/html/classvtkQuadricClustering.html)
+    :param surface: the full resolution vtkPolyData
+    :param divisions: the number of clustering bins along each axis
+    :return: the vtkQuadricClustering
+    """
+    lod_reducer = observe_stage(vtk.vtkQuadricClustering(), 'lod')
+    lod_reducer.SetInputData(surface)
+    lod_reducer.SetNumberOfDivisions(divisions, divisions, divisions)
+    lod_reducer.AutoAdjustNumberOfDivisionsOn()
+    return lod_reducer
+
+
+def create_lod_surfaces(surface):
+    """
+    Computes the decimated copies of a surface for its LOD_DIVISIONS levels of detail ahead, on a worker thread
+    (see SurfaceLoader). They are otherwise computed on the GUI thread when the camera first moves.
+    :return: a vtkPolyData per level
+    """
+    lod_surfaces = []
+    for divisions in LOD_DIVISIONS:
+        lod_normals = create_normals(create_lod_reducer(surface, divisions))
+        lod_normals.Update()
+        lod_surfaces.append(lod_normals.GetOutput())
+    return lod_surfaces
+
+
+def set_lod_surfaces(label, lod_surfaces):
+    """
+    Swaps levels of detail computed ahead (see create_lod_surfaces) into a label actor drawing its levels lazily.
+    :param label: a NiiLabel with a vtkLODProp3D actor
+    """
+    for lod_id, lod_surface in zip(label.lod_ids[1:], lod_surfaces):
+        label.actor.GetLODMapper(lod_id).SetInputData(lod_surface)
+
+
+def create_lod_actor(label, mapper, prop, lod_surfaces=None):
+    """
+    A vtkLODProp3D drawing the full resolution surface when the camera is still and one of the LOD_DIVISIONS
+    decimated copies while interacting (see select_lod_levels). All levels share the same property so opacity and
+    color changes apply to every level. Sets the actor, lod_ids, lod_reducers and lod_normals of the label.
+    (https://www.vtk.org/doc/nightly/html/classvtkLODProp3D.html)
+    :param label: the NiiLabel
+    :param mapper: the full resolution mapper
+    :param prop: the vtkProperty
+    :param lod_surfaces: the levels computed ahead (see create_lod_surfaces), None to decimate when first drawn
+    """
+    actor = vtk.vtkLODProp3D()
+    actor.AutomaticLODSelectionOff()
+    label.lod_ids = [actor.AddLOD(mapper, prop, 0.0)]
+    label.lod_reducers, label.lod_normals = [], []
+    for i, divisions in enumerate(LOD_DIVISIONS):
+        lod_reducer = create_lod_reducer(mapper.GetInput(), divisions)
+        lod_normals = create_normals(lod_reducer)
+        lod_mapper = vtk.vtkPolyDataMapper()
+        lod_mapper.ScalarVisibilityOff()
+        if lod_surfaces:
+            lod_mapper.SetInputData(lod_surfaces[i])
+        else:
+            lod_mapper.SetInputConnection(lod_normals.GetOutputPort())
+        label.lod_ids.append(actor.AddLOD(lod_mapper, prop, 0.0))
+        label.lod_reducers.append(lod_reducer)
+        label.lod_normals.append(lod_normals)
+    actor.SetSelectedLODID(label.lod_ids[0])
+    label.actor = actor
+
+
+def select_lod_levels(labels, update_rate):
+    """
+    Picks for every level of detail actor the finest level that can be drawn at update_rate (frames per second),
+    assuming LOD_CELL_RENDER_TIME seconds per triangle. The frame time is shared between the visible surfaces in
+    proportion to their full resolution size. A still update rate (close to 0) selects the full resolution.
+    :param labels: the NiiLabels in the scene
+    :param update_rate: the render window's desired update rate
+    """
+    labels = [label for label in labels if label.actor and label.lod_ids and label.actor.GetVisibility()]
+    level_cells = []
+    for label in labels:
+        cells = []
+        for lod_id in label.lod_ids:
+            lod_mapper = label.actor.GetLODMapper(lod_id)
+            lod_mapper.Update()
+            cells.append(lod_mapper.GetInput().GetNumberOfCells())
+        level_cells.append(cells)
+
+    frame_cells = 1.0 / max(update_rate, 1e-9) / LOD_CELL_RENDER_TIME
+    scene_cells = max(sum(cells[0] for cells in level_cells), 1)
+    for label, cells in zip(labels, level_cells):
+        label_budget = frame_cells * cells[0] / scene_cells
+        level = next((level for level, n in enumerate(cells) if n <= label_budget), len(cells) - 1)
+        label.actor.SetSelectedLODID(label.lod_ids[level])
+
+
 def create_mask_table():
     m_mask_opacity = 1
     brain_lut = vtk.vtkLookupTable()
@@ -154,21 +872,307 @@ def create_table():
     table.SetSaturationRange(0, 0)
 
 
-def add_surface_rendering(nii_object, label_idx, label_value):
-    nii_object.labels[label_idx].extractor.SetValue(0, label_value)
-    nii_object.labels[label_idx].extractor.Update()
+def describe_label(nii_object, label):
+    """
+    :return: a short name for a label, e.g. 'mask.nii.gz 4'
+    """
+    return '{} {:g}'.format(os.path.basename(nii_object.file), label.value)
+
 
+def surface_cache_keys(nii_object, label):
+    """
+    :return: the mesh cache keys of the decimated and of the final surface of a label
+    """
+    params = dict(extractor=label.extractor.GetClassName(), value=label.value, target_reduction=TARGET_REDUCTION,
+                  triangle_budget=label.triangle_budget, clustering_cells=QUADRIC_CLUSTERING_CELLS, level=label.level)
+    if nii_object.time_series:
+        params['frame'] = nii_object.time_series.frame
+    reduced_key = mesh_cache.key(nii_object.file, stage='reduced', **params)
+    surface_key = mesh_cache.key(nii_object.file, stage='surface', smoothness=label.smoothness,
+                                 smoothing=label.smoothing, feature_angle=FEATURE_ANGLE, **params)
+    return reduced_key, surface_key
+
+
+def load_cached_surface(nii_object, label):
+    """
+    Loads the decimated and the final surface of a label from the mesh cache
+    :return: a (reduced, surface) pair of vtkPolyData, None on a miss
+    """
+    reduced_key, surface_key = surface_cache_keys(nii_object, label)
+    surface = mesh_cache.load(surface_key)
+    reduced = mesh_cache.load(reduced_key) if surface else None
+    if reduced is None:
+        return None
+    return reduced, surface
+
+
+def store_cached_surface(nii_object, label, reduced, surface):
+    """ Stores the decimated and the final surface of a label (extracted at label.smoothness) in the mesh cache."""
+    reduced_key, surface_key = surface_cache_keys(nii_object, label)
+    mesh_cache.store(reduced_key, reduced)
+    mesh_cache.store(surface_key, surface)
+
+
+def attach_surface(label, reduced, surface, lod_surfaces=None):
+    """
+    Creates the actor of a label around a surface computed outside of its live pipeline (mesh cache or
+    SurfaceLoader). The decimated surface is kept as the label reducer for later smoothness changes.
+    :param label: a NiiLabel without an actor
+    :param reduced: the decimated vtkPolyData, None if the label is never smoothed again (brain)
+    :param surface: the final vtkPolyData
+    :param lod_surfaces: its levels of detail computed ahead, see create_lod_surfaces
+    """
+    actor_mapper = vtk.vtkPolyDataMapper()
+    actor_mapper.SetInputData(surface)
+    actor_mapper.ScalarVisibilityOff()
+    actor_property = create_property(label.opacity, label.color)
+    if LOD_DIVISIONS:
+        create_lod_actor(label, actor_mapper, actor_property, lod_surfaces)
+    else:
+        label.actor = create_actor(actor_mapper, actor_property)
+    label.mapper = actor_mapper
+    label.reducer = create_source(reduced) if reduced else None
+    label.smoother = None
+    label.property = actor_property
+
+
+def get_reduced_surface(label):
+    """
+    :param label: a NiiLabel with an actor
+    :return: the decimated vtkPolyData the label surface is smoothed from
+    """
+    return label.reducer.GetOutputDataObject(0)  # the reducer is a vtkDecimatePro or, once cached, a source
+
+
+def add_surface_rendering(nii_object, label_idx, label_value=None):
+    """
+    :param nii_object: the NiiObject owning the label
+    :param label_idx: index of the label in nii_object.labels
+    :param label_value: the value to extract, None if the label extractor is already set up for its label
+                        (see open_brain and open_mask)
+    """
+    label = nii_object.labels[label_idx]
+    if label_value is not None:
+        label.extractor.SetValue(0, label_value)
+        label.value = label_value
+    set_stage_label(describe_label(nii_object, label), label.extractor)
+
+    cached = load_cached_surface(nii_object, label) if mesh_cache else None
+    if cached:
+        attach_surface(label, *cached)
+        return
+
+    label.extractor.Update()
     # if the cell size is 0 then there is no label_idx data
-    if nii_object.labels[label_idx].extractor.GetOutput().GetMaxCellSize():
-        reducer = create_polygon_reducer(nii_object.labels[label_idx].extractor)
-        smoother = create_smoother(reducer, nii_object.labels[label_idx].smoothness)
-        normals = create_normals(smoother)
-        actor_mapper = create_mapper(normals)
-        actor_property = create_property(nii_object.labels[label_idx].opacity, nii_object.labels[label_idx].color)
-        actor = create_actor(actor_mapper, actor_property)
-        nii_object.labels[label_idx].actor = actor
-        nii_object.labels[label_idx].smoother = smoother
-        nii_object.labels[label_idx].property = actor_property
+    if not label.extractor.GetOutput().GetMaxCellSize():
+        return
+    reducer = create_polygon_reducer(label.extractor, label.triangle_budget)
+    smoother = create_smoother(reducer, label.smoothness, label.smoothing)
+    normals = create_normals(smoother)
+    set_stage_label(describe_label(nii_object, label), reducer, smoother, normals)
+    actor_mapper = create_mapper(normals)
+    if mesh_cache:
+        store_cached_surface(nii_object, label, reducer.GetOutput(), normals.GetOutput())
+
+    actor_property = create_property(label.opacity, label.color)
+    if LOD_DIVISIONS:
+        create_lod_actor(label, actor_mapper, actor_property)
+    else:
+        label.actor = create_actor(actor_mapper, actor_property)
+    label.mapper = actor_mapper
+    label.reducer = reducer
+    label.smoother = smoother
+    label.property = actor_property
+
+
+def create_source(data):
+    """
+    Wraps a shallow copy of a data object in a pipeline source so the create_* helpers can be chained on it.
+    The copy keeps the standalone pipeline independent from the live one, which makes it safe to update it
+    on a worker thread (see SurfaceRebuilder).
+    :param data: a vtkImageData or vtkPolyData
+    :return: a vtkTrivialProducer
+    """
+    data_copy = data.NewInstance()
+    data_copy.ShallowCopy(data)
+    source = vtk.vtkTrivialProducer()
+    source.SetOutput(data_copy)
+    return source
+
+
+def create_brain_surface_filters(image, threshold, smoothness, smoothing=SMOOTHING_METHOD, triangle_budget=None):
+    """
+    Standalone copy of the brain pipeline: extractor -> decimate -> smoother -> normalizer
+    :param image: the brain vtkImageData
+    :param threshold: the iso value for vtkFlyingEdges3D
+    :param smoothness: the smoothness in Laplacian iterations
+    :param smoothing: the smoothing method (see create_smoother)
+    :param triangle_budget: the triangles the surface is reduced to, None for TARGET_REDUCTION
+    :return: the filters in pipeline order, the last one produces the surface
+    """
+    source = create_source(image)
+    extractor = observe_stage(vtk.vtkFlyingEdges3D(), 'extractor')
+    extractor.SetInputConnection(source.GetOutputPort())
+    extractor.SetValue(0, threshold)
+    reducer = create_polygon_reducer(extractor, triangle_budget)
+    smoother = create_smoother(reducer, smoothness, smoothing)
+    normals = create_normals(smoother)
+    return [extractor, reducer, smoother, normals]
+
+
+def create_label_surface_filters(reduced, smoothness, smoothing=SMOOTHING_METHOD):
+    """
+    Standalone copy of the end of a label pipeline: smoother -> normalizer
+    :param reduced: the decimated vtkPolyData of the label (label.reducer output)
+    :param smoothness: the smoothness in Laplacian iterations
+    :param smoothing: the smoothing method (see create_smoother)
+    :return: the filters in pipeline order, the last one produces the surface
+    """
+    smoother = create_smoother(create_source(reduced), smoothness, smoothing)
+    normals = create_normals(smoother)
+    return [smoother, normals]
+
+
+def create_mask_label_filters(image, label_value, extent, smoothness, smoothing=SMOOTHING_METHOD,
+                              triangle_budget=None):
+    """
+    Standalone copy of a per label mask pipeline: voi -> extractor -> decimate -> smoother -> normalizer
+    :param image: the mask vtkImageData
+    :param label_value: the label to extract
+    :param extent: the voxel extent of the label (see compute_label_extents)
+    :param smoothness: the smoothness in Laplacian iterations
+    :param smoothing: the smoothing method (see create_smoother)
+    :param triangle_budget: the triangles the surface is reduced to, None for TARGET_REDUCTION
+    :return: the filters in pipeline order, the last three are the reducer, smoother and normalizer
+    """
+    source = create_source(image)
+    voi = observe_stage(vtk.vtkExtractVOI(), 'voi')
+    voi.SetInputConnection(source.GetOutputPort())
+    voi.SetVOI(*extent)
+    extractor = observe_stage(vtk.vtkDiscreteMarchingCubes(), 'extractor')
+    extractor.SetInputConnection(voi.GetOutputPort())
+    extractor.SetValue(0, label_value)
+    reducer = create_polygon_reducer(extractor, triangle_budget)
+    smoother = create_smoother(reducer, smoothness, smoothing)
+    normals = create_normals(smoother)
+    return [voi, extractor, reducer, smoother, normals]
+
+
+def create_multi_label_filters(image, label_values, extent):
+    """
+    Standalone copy of the single pass mask extraction: voi -> multi label extractor
+    :param image: the mask vtkImageData
+    :param label_values: the label values to extract
+    :param extent: the voxel extent covering every label
+    :return: the filters in pipeline order, the last one produces the combined surface (see create_split_label_filters)
+    """
+    source = create_source(image)
+    voi = observe_stage(vtk.vtkExtractVOI(), 'voi')
+    voi.SetInputConnection(source.GetOutputPort())
+    voi.SetVOI(*extent)
+    extractor = observe_stage(vtk.vtkDiscreteMarchingCubes(), 'extractor')
+    extractor.SetInputConnection(voi.GetOutputPort())
+    for i, label_value in enumerate(label_values):
+        extractor.SetValue(i, label_value)
+    extractor.ComputeScalarsOn()
+    return [voi, extractor]
+
+
+def create_split_label_filters(combined, label_value, smoothness, smoothing=SMOOTHING_METHOD, triangle_budget=None):
+    """
+    Standalone copy of the end of a single pass label pipeline: splitter -> decimate -> smoother -> normalizer
+    :param combined: the vtkPolyData of create_multi_label_filters
+    :param label_value: the label to keep
+    :param smoothness: the smoothness in Laplacian iterations
+    :param smoothing: the smoothing method (see create_smoother)
+    :param triangle_budget: the triangles the surface is reduced to, None for TARGET_REDUCTION
+    :return: the filters in pipeline order, the last three are the reducer, smoother and normalizer
+    """
+    splitter = create_label_splitter(create_source(combined), label_value)
+    reducer = create_polygon_reducer(splitter, triangle_budget)
+    smoother = create_smoother(reducer, smoothness, smoothing)
+    normals = create_normals(smoother)
+    return [splitter, reducer, smoother, normals]
+
+
+def create_preview_filters(image, values, discrete, extent=None):
+    """
+    Coarse surface shown while the full surfaces are computed: the volume is subsampled by PREVIEW_SHRINK_FACTOR
+    along every axis and extracted without decimation or smoothing, which takes a fraction of the full pipeline.
+    (https://www.vtk.org/doc/nightly/html/classvtkImageShrink3D.html)
+    :param image: the brain or mask vtkImageData
+    :param values: the iso values (brain) or label values (mask) to extract
+    :param discrete: True for masks, labels are subsampled instead of averaged and extracted with cell scalars
+    :param extent: optional voxel extent the extraction is restricted to
+    :return: the filters in pipeline order, the last one produces the preview surface
+    """
+    source = create_source(image)
+    filters = []
+    if extent:
+        voi = observe_stage(vtk.vtkExtractVOI(), 'voi')
+        voi.SetInputConnection(source.GetOutputPort())
+        voi.SetVOI(*extent)
+        filters.append(voi)
+    shrink = observe_stage(vtk.vtkImageShrink3D(), 'preview')
+    shrink.SetInputConnection((filters[-1] if filters else source).GetOutputPort())
+    shrink.SetShrinkFactors(PREVIEW_SHRINK_FACTOR, PREVIEW_SHRINK_FACTOR, PREVIEW_SHRINK_FACTOR)
+    shrink.SetAveraging(not discrete)
+    extractor = observe_stage(vtk.vtkDiscreteMarchingCubes() if discrete else vtk.vtkFlyingEdges3D(), 'preview')
+    extractor.SetInputConnection(shrink.GetOutputPort())
+    for i, value in enumerate(values):
+        extractor.SetValue(i, value)
+    extractor.SetComputeScalars(discrete)
+    return filters + [shrink, extractor]
+
+
+def create_preview_actor(surface, opacity, colors):
+    """
+    :param surface: the vtkPolyData of create_preview_filters
+    :param opacity: the actor opacity
+    :param colors: a single color for a brain preview, a {label value: color} dict for a mask preview
+    :return: the vtkActor
+    """
+    preview_mapper = vtk.vtkPolyDataMapper()
+    preview_mapper.SetInputData(surface)
+    if isinstance(colors, dict):
+        # the cells carry the value of their label, an indexed table colors them like the label surfaces
+        table = vtk.vtkLookupTable()
+        table.IndexedLookupOn()
+        table.SetNumberOfTableValues(len(colors))
+        for i, (label_value, color) in enumerate(colors.items()):
+            table.SetTableValue(i, *color, 1.0)
+            table.SetAnnotation(vtk.vtkVariant(label_value), '{:g}'.format(label_value))
+        preview_mapper.SetLookupTable(table)
+        preview_mapper.SetScalarModeToUseCellData()
+        preview_mapper.UseLookupTableScalarRangeOn()
+        color = (1.0, 1.0, 1.0)
+    else:
+        preview_mapper.ScalarVisibilityOff()
+        color = colors
+    return create_actor(preview_mapper, create_property(opacity, color))
+
+
+def set_label_surface(label, surface):
+    """
+    Swaps a surface computed outside of the live pipeline into the existing label actor. Its levels of detail are
+    decimated when they are first drawn.
+    :param label: a NiiLabel with an actor
+    :param surface: the new vtkPolyData
+    """
+    label.mapper.SetInputData(surface)
+    for lod_id, lod_reducer, lod_normals in zip(label.lod_ids[1:], label.lod_reducers, label.lod_normals):
+        lod_reducer.SetInputData(surface)
+        label.actor.GetLODMapper(lod_id).SetInputConnection(lod_normals.GetOutputPort())
+    label.deferred = False  # nothing left to complete for the replaced surface
+
+
+def set_brain_table(image_property, brain):
+    """
+    The slice mappers map the intensities of the slices they display through the lookup table of their property,
+    no colored copy of the volume is made and a table change only recolors the visible slices.
+    """
+    image_property.SetLookupTable(brain.lookup_table)
+    image_property.UseLookupTableScalarRangeOn()
 
 
 def setup_slicer(renderer, brain):
@@ -178,31 +1182,33 @@ def setup_slicer(renderer, brain):
 
     axial = vtk.vtkImageActor()
     axial_prop = vtk.vtkImageProperty()
-    axial_prop.SetOpacity(0)
+    set_brain_table(axial_prop, brain)
     axial.SetProperty(axial_prop)
-    axial.GetMapper().SetInputConnection(brain.image_mapper.GetOutputPort())
+    axial.GetMapper().SetInputConnection(brain.reader.GetOutputPort())
     axial.SetDisplayExtent(0, x, 0, y, int(z/2), int(z/2))
     axial.InterpolateOn()
     axial.ForceOpaqueOn()
 
     coronal = vtk.vtkImageActor()
     cor_prop = vtk.vtkImageProperty()
-    cor_prop.SetOpacity(0)
+    set_brain_table(cor_prop, brain)
     coronal.SetProperty(cor_prop)
-    coronal.GetMapper().SetInputConnection(brain.image_mapper.GetOutputPort())
+    coronal.GetMapper().SetInputConnection(brain.reader.GetOutputPort())
     coronal.SetDisplayExtent(0, x, int(y/2), int(y/2), 0, z)
     coronal.InterpolateOn()
     coronal.ForceOpaqueOn()
 
     sagittal = vtk.vtkImageActor()
     sag_prop = vtk.vtkImageProperty()
-    sag_prop.SetOpacity(0)
+    set_brain_table(sag_prop, brain)
     sagittal.SetProperty(sag_prop)
-    sagittal.GetMapper().SetInputConnection(brain.image_mapper.GetOutputPort())
+    sagittal.GetMapper().SetInputConnection(brain.reader.GetOutputPort())
     sagittal.SetDisplayExtent(int(x/2), int(x/2), 0, y, 0, z)
     sagittal.InterpolateOn()
     sagittal.ForceOpaqueOn()
 
+    for image_actor in (axial, coronal, sagittal):
+        image_actor.VisibilityOff()  # hidden actors are skipped when rendering, opacity 0 would still draw them
     renderer.AddActor(axial)
     renderer.AddActor(coronal)
     renderer.AddActor(sagittal)
@@ -218,55 +1224,295 @@ def setup_projection(brain, renderer):
     slice_mapper.BorderOff()
 
     brain_image_prop = vtk.vtkImageProperty()
-    brain_image_prop.SetOpacity(0.0)
     brain_image_prop.SetInterpolationTypeToLinear()
+    set_brain_table(brain_image_prop, brain)
     image_slice = vtk.vtkImageSlice()
     image_slice.SetMapper(slice_mapper)
     image_slice.SetProperty(brain_image_prop)
-    image_slice.GetMapper().SetInputConnection(brain.image_mapper.GetOutputPort())
+    image_slice.VisibilityOff()
     renderer.AddViewProp(image_slice)
-    return brain_image_prop
+    return image_slice
 
 
-def setup_brain(renderer, file):
+# camera presets of the view buttons and of batch_render: the camera position as a function of the focal point fp and
+# of the distance d ResetCamera left it at, the view up vector and the zoom
+CAMERA_VIEWS = {
+    'axial': (lambda fp, d: (fp[0], fp[1], fp[2] + d), (0.0, 1.0, 0.0), 1.8),
+    'coronal': (lambda fp, d: (fp[0], fp[2] - d, fp[1]), (0.0, 0.5, 0.5), 1.8),
+    'sagittal': (lambda fp, d: (fp[2] + d, fp[0], fp[1]), (0.0, 0.0, 1.0), 1.6),
+}
+
+
+def set_camera_view(renderer, view):
+    """
+    Frames the visible props of a renderer from one of the CAMERA_VIEWS presets.
+    :param view: 'axial', 'coronal' or 'sagittal'
+    """
+    position, view_up, zoom = CAMERA_VIEWS[view]
+    renderer.ResetCamera()
+    camera = renderer.GetActiveCamera()
+    fp = camera.GetFocalPoint()
+    p = camera.GetPosition()
+    dist = math.sqrt((p[0] - fp[0]) ** 2 + (p[1] - fp[1]) ** 2 + (p[2] - fp[2]) ** 2)
+    camera.SetPosition(*position(fp, dist))
+    camera.SetViewUp(*view_up)
+    camera.Zoom(zoom)
+
+
+def set_pyramid(nii_object, pyramid):
+    """ Sets the pyramid of a NiiObject, its surfaces start at the coarsest level and are refined from there."""
+    nii_object.pyramid = pyramid
+    nii_object.finest_level = select_finest_level(pyramid)
+    nii_object.level = len(pyramid) - 1
+
+
+def open_brain(file, pyramid=True):
+    """
+    Reads the brain without extracting its surface, see load_brain and SurfaceLoader
+    :param file: the brain scan file name
+    :param pyramid: build the multi resolution levels of a large brain (see build_pyramid)
+    :return: a NiiObject with one label (no actor yet) at the default threshold, a 4D brain shows its first frame
+    """
     brain = NiiObject()
     brain.file = file
-    brain.reader = read_volume(brain.file)
-    brain.labels.append(NiiLabel(BRAIN_COLORS[0], BRAIN_OPACITY, BRAIN_SMOOTHNESS))
+    brain.time_series = read_time_series(brain.file)
+    # the views and extractors of a time series are connected to the shown frame
+    brain.reader = brain.time_series.output if brain.time_series else read_volume(brain.file)
+    brain.labels.append(NiiLabel(BRAIN_COLORS[0], BRAIN_OPACITY, BRAIN_SMOOTHNESS, SMOOTHING_METHOD))
     brain.labels[0].extractor = create_brain_extractor(brain)
-    brain.extent = brain.reader.GetDataExtent()
+    brain.extent = brain.reader.GetOutput().GetExtent()
+    brain.scalar_range = brain.reader.GetOutput().GetScalarRange()
+    image = brain.reader.GetOutput()
+    # the frames of a time series are extracted at their native resolution
+    if pyramid and not brain.time_series:
+        set_pyramid(brain, build_pyramid(image, discrete=False,
+                                         memory_budget=get_pyramid_budget(image, mapped=volume_store is not None)))
+    else:
+        set_pyramid(brain, [image])
+    brain.labels[0].level = brain.level
+    brain.labels[0].value = sum(brain.scalar_range) / 2  # default extractor value
+    brain.labels[0].extractor.SetValue(0, brain.labels[0].value)
+    if triangle_budget:  # only needed to share the budget
+        brain.labels[0].cell_count = estimate_extracted_cells(image, brain.labels[0], discrete=False)
+    share_triangle_budget([brain], triangle_budget)
+    return brain
+
+
+def extract_surfaces(nii_object):
+    """ Extracts the surface of every label of an opened NiiObject without creating any view (headless safe)"""
+    for label_idx in range(len(nii_object.labels)):
+        add_surface_rendering(nii_object, label_idx)
 
-    scalar_range = brain.reader.GetOutput().GetScalarRange()
+
+def load_brain(file):
+    """
+    Reads the brain and extracts its surface without creating any view (headless safe)
+    :param file: the brain scan file name
+    :return: a NiiObject with the brain surface as its only label
+    """
+    brain = open_brain(file, pyramid=False)  # the live pipelines extract at the native resolution
+    extract_surfaces(brain)
+    return brain
+
+
+def open_study(files):
+    """
+    Reads the co-registered modalities (FLAIR, T1, T1CE, T2, ...) of one case, see open_brain. They share one
+    voxel geometry, so the slicer, the projection and the mask surfaces are reused when switching between them.
+    :param files: the brain scan file names
+    :return: a NiiObject per modality, in the order of files
+    """
+    brains = [open_brain(file) for file in files]
+    reference = get_volume_geometry(brains[0])
+    for brain in brains[1:]:
+        geometry = get_volume_geometry(brain)
+        for name, value in geometry.items():
+            if value is not None and reference[name] is not None and \
+                    not np.allclose(value, reference[name], rtol=1e-5, atol=1e-4):
+                raise ValueError("{} does not share the voxel geometry ({}) of {}".format(brain.file, name,
+                                                                                          brains[0].file))
+    return brains
+
+
+def get_volume_geometry(nii_object):
+    """
+    :return: dict with the extent, spacing, origin and direction of the vtkImageData of a volume and the world matrix
+             of its NIfTI header (see read_world_matrix). What is not available is None (the direction before VTK 9).
+    """
+    image = nii_object.reader.GetOutput()
+    direction = image.GetDirectionMatrix() if hasattr(image, 'GetDirectionMatrix') else None
+    return {'extent': image.GetExtent(), 'spacing': image.GetSpacing(), 'origin': image.GetOrigin(),
+            'direction': [direction.GetElement(i, j) for i in range(3) for j in range(3)] if direction else None,
+            'world matrix': read_world_matrix(nii_object.file)}
+
+
+def get_modality_name(file):
+    """ The modality of a case file, its name without the extensions (sample_data/10labels_example/T1CE.nii.gz)."""
+    return os.path.basename(file).split(os.extsep, 1)[0]
+
+
+def create_brain_table(brain):
+    """
+    The gray level table of the slicer and projection views (see set_brain_table), sets brain.lookup_table
+    """
     bw_lut = vtk.vtkLookupTable()
-    bw_lut.SetTableRange(scalar_range)
+    bw_lut.SetNumberOfTableValues(BRAIN_HISTOGRAM_BINS)
+    bw_lut.SetTableRange(brain.scalar_range)
     bw_lut.SetSaturationRange(0, 0)
     bw_lut.SetHueRange(0, 0)
     bw_lut.SetValueRange(0, 2)
     bw_lut.Build()
+    brain.lookup_table = bw_lut
 
-    view_colors = vtk.vtkImageMapToColors()
-    view_colors.SetInputConnection(brain.reader.GetOutputPort())
-    view_colors.SetLookupTable(bw_lut)
-    view_colors.Update()
-    brain.image_mapper = view_colors
-    brain.scalar_range = scalar_range
 
-    add_surface_rendering(brain, 0, sum(scalar_range)/2)  # render index, default extractor value
+def update_brain_table(brain, intensity, threshold=None):
+    """
+    Rebuilds the gray level table of the slices. With a threshold the intensities at or above it are tinted with
+    BRAIN_THRESHOLD_COLOR, a live preview on the displayed slices of what a brain surface extraction would enclose.
+    :param intensity: the upper value of the gray ramp (image intensity picker)
+    :param threshold: the previewed threshold, None to show the plain gray levels
+    """
+    table = brain.lookup_table
+    table.SetValueRange(0.0, intensity)
+    table.ForceBuild()  # SetTableValue below would keep Build from overwriting a previous tint
+    table.Modified()  # ForceBuild alone does not tell the slice mappers to recolor
+    if threshold is None:
+        return
+    low, high = table.GetTableRange()
+    n_values = table.GetNumberOfTableValues()
+    first = int(np.clip(np.ceil((threshold - low) / (high - low) * n_values), 0, n_values))
+    for i in range(first, n_values):
+        gray = table.GetTableValue(i)
+        table.SetTableValue(i, *[0.5 * (g + c) for g, c in zip(gray, BRAIN_THRESHOLD_COLOR)], 1.0)
+
+
+def setup_brain(renderer, file):
+    brain = load_brain(file)
+    create_brain_table(brain)
     renderer.AddActor(brain.labels[0].actor)
     return brain
 
 
-def setup_mask(renderer, file):
+def open_mask(file, pyramid=True):
+    """
+    Reads the mask and discovers its labels without extracting their surfaces, see load_mask and SurfaceLoader
+    :param file: the mask file name
+    :param pyramid: build the multi resolution levels of a large mask (see build_pyramid)
+    :return: a NiiObject with one label (no actor yet) per mask label
+    """
     mask = NiiObject()
     mask.file = file
     mask.reader = read_volume(mask.file)
-    mask.extent = mask.reader.GetDataExtent()
-    n_labels = int(mask.reader.GetOutput().GetScalarRange()[1])
-    n_labels = n_labels if n_labels <= 10 else 10
-
-    for label_idx in range(n_labels):
-        mask.labels.append(NiiLabel(MASK_COLORS[label_idx], MASK_OPACITY, MASK_SMOOTHNESS))
-        mask.labels[label_idx].extractor = create_mask_extractor(mask)
-        add_surface_rendering(mask, label_idx, label_idx + 1)
-        renderer.AddActor(mask.labels[label_idx].actor)
+    mask.extent = mask.reader.GetOutput().GetExtent()
+    image = mask.reader.GetOutput()
+    set_pyramid(mask, build_pyramid(image, discrete=True,
+                                    memory_budget=get_pyramid_budget(image, mapped=volume_store is not None))
+                if pyramid else [image])
+    present_labels = discover_labels(mask.reader.GetOutput())
+    label_values = [label_value for label_value, _ in present_labels]
+    # labels usually cover a small part of the volume, only their bounding boxes are traversed
+    label_extents = compute_label_extents(mask.reader.GetOutput(), label_values)
+
+    if MASK_SINGLE_PASS and label_extents:
+        # one traversal of the mask for all labels, split into per label surfaces afterwards. The extractor only
+        # executes once, when the first label without a cached surface pulls its output.
+        mask_extractor = create_multi_label_extractor(mask, label_values, merge_extents(label_extents.values()))
+
+    for label_idx, (label_value, voxel_count) in enumerate(present_labels):
+        mask.labels.append(NiiLabel(get_label_color(label_value), MASK_OPACITY, MASK_SMOOTHNESS, SMOOTHING_METHOD))
+        mask.labels[label_idx].value = label_value
+        mask.labels[label_idx].voxel_count = voxel_count
+        mask.labels[label_idx].extent = label_extents[label_value]
+        mask.labels[label_idx].level = mask.level
+        if triangle_budget:  # only needed to share the budget
+            mask.labels[label_idx].cell_count = estimate_extracted_cells(image, mask.labels[label_idx], discrete=True)
+        if MASK_SINGLE_PASS:
+            mask.labels[label_idx].extractor = create_label_splitter(mask_extractor, label_value)
+        else:
+            mask.labels[label_idx].extractor = create_mask_extractor(mask, label_extents[label_value])
+            mask.labels[label_idx].extractor.SetValue(0, label_value)
+    share_triangle_budget([mask], triangle_budget)
     return mask
+
+
+def load_mask(file):
+    """
+    Reads the mask and extracts the surface of each label without creating any view (headless safe)
+    :param file: the mask file name
+    :return: a NiiObject with one label per mask label
+    """
+    mask = open_mask(file, pyramid=False)
+    extract_surfaces(mask)
+    return mask
+
+
+def setup_mask(renderer, file):
+    mask = load_mask(file)
+    for label in mask.labels:
+        renderer.AddActor(label.actor)
+    return mask
+
+
+def load_case(brain_file, mask_file):
+    """
+    Reads a brain and its mask and extracts their surfaces without creating any view (headless safe). Unlike
+    load_brain and load_mask, which each spend the whole triangle budget, the two share it like in the viewer.
+    :return: (brain, mask)
+    """
+    brain, mask = open_brain(brain_file, pyramid=False), open_mask(mask_file, pyramid=False)
+    share_triangle_budget([brain, mask], triangle_budget)
+    extract_surfaces(brain)
+    extract_surfaces(mask)
+    return brain, mask
+
+
+def setup_case(renderer, brain_file, mask_file):
+    brain, mask = load_case(brain_file, mask_file)
+    create_brain_table(brain)
+    for label in brain.labels + mask.labels:
+        renderer.AddActor(label.actor)
+    return brain, mask
+
+
+def pick_world_position(renderer, x, y):
+    """
+    The world position of the opaque geometry under a display position, from one depth buffer value of the last
+    render. The cell and prop pickers intersect every surface or render again, which takes far too long to run on
+    every mouse move. Translucent surfaces (the brain) do not write depth, the mask labels and slices behind them
+    are picked.
+    :return: (x, y, z), None if there is no geometry under the position
+    """
+    z = renderer.GetZ(x, y)
+    if z >= 1.0:  # the far clipping plane, background
+        return None
+    renderer.SetDisplayPoint(x, y, z)
+    renderer.DisplayToWorld()
+    world = renderer.GetWorldPoint()
+    return tuple(c / world[3] for c in world[:3])
+
+
+def create_profile_overlay(renderer):
+    """
+    On screen summary of the profiled pipeline stages, see update_profile_overlay
+    :return: the vtkTextActor
+    """
+    overlay = vtk.vtkTextActor()
+    overlay.GetTextProperty().SetFontFamilyToCourier()
+    overlay.GetTextProperty().SetFontSize(12)
+    overlay.GetTextProperty().SetColor(1.0, 1.0, 0.0)
+    overlay.SetDisplayPosition(10, 10)
+    renderer.AddViewProp(overlay)
+    return overlay
+
+
+def update_profile_overlay(overlay):
+    if profiler:
+        overlay.SetInput(profiler.summary_text())
+
+
+def get_label_surface(label):
+    """
+    :param label: a NiiLabel
+    :return: the vtkPolyData currently rendered for the label, None if the label has no data
+    """
+    return label.mapper.GetInput() if label.actor else None